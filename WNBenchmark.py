@@ -0,0 +1,286 @@
+from pathlib import Path
+import numpy as np
+import gdal
+import osr
+import torch
+import os
+import gc
+import sys
+import time
+import json
+import tempfile
+import platform
+import tracemalloc
+import subprocess
+
+from WNInputOutput import WNSatImage, WNPatchProcessor, array2raster, create_custom_patches, predict_image
+
+
+# Synthetic Sentinel-2 products, in the THEIA naming layout (WNSatImage.dicS2_THEIA)
+theia_10m_bands = ['B2', 'B3', 'B4', 'B8']
+theia_20m_bands = ['B5', 'B6', 'B7', 'B8A', 'B11', 'B12']
+
+# typical reflectances (x 10000) of water and land in each band
+water_reflectance = {'B2': 700, 'B3': 800, 'B4': 500, 'B5': 400, 'B6': 300, 'B7': 250, 'B8': 200, 'B8A': 180,
+                     'B11': 100, 'B12': 80}
+land_reflectance = {'B2': 500, 'B3': 800, 'B4': 900, 'B5': 1400, 'B6': 2200, 'B7': 2600, 'B8': 2800, 'B8A': 2900,
+                    'B11': 2200, 'B12': 1500}
+
+
+def synthetic_water_mask(size, water_fraction=0.3, seed=0):
+    # smooth random field thresholded at the water fraction quantile, so the water has realistic blobs
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((size // 32 + 2, size // 32 + 2)).astype('float32')
+    field = np.kron(coarse, np.ones((32, 32), dtype='float32'))[:size, :size]
+    field += rng.random((size, size)).astype('float32') * 0.2
+
+    return (field < np.quantile(field, water_fraction)).astype(np.uint8)
+
+
+def create_theia_product(path, size=1024, tile='T31TCJ', date='20180101-105435-457', water_fraction=0.3,
+                         nodata_fraction=0.1, seed=0):
+    """
+    Creates a synthetic THEIA L2A product (int16 SRE_*.tif bands, the 20m bands with half the size) and its water
+    mask (uint8, 1 for water) in path. The last columns of the scene are nodata (-10000), as in the swath edges.
+    Returns the product directory and the label file.
+    """
+    rng = np.random.default_rng(seed)
+    name = f'SENTINEL2A_{date}_L2A_{tile}_C_V2-2'
+    product = Path(path) / name
+    product.mkdir(parents=True, exist_ok=True)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32631)
+    projection = srs.ExportToWkt()
+
+    mask = synthetic_water_mask(size, water_fraction, seed)
+    valid_cols = size - int(size * nodata_fraction)
+
+    for bands, res in [(theia_10m_bands, 10), (theia_20m_bands, 20)]:
+        factor = res // 10
+        band_mask = mask[::factor, ::factor]
+        geo_transform = (300000., float(res), 0., 5000040., 0., -float(res))
+
+        for band in bands:
+            array = np.where(band_mask == 1, water_reflectance[band], land_reflectance[band]).astype('int16')
+            array += rng.normal(0, 50, array.shape).astype('int16')
+            array[:, valid_cols // factor:] = -10000
+
+            array2raster(str(product / f'{name}_SRE_{band}.tif'), array, geo_transform, projection,
+                         nodatavalue=-10000, dtype=gdal.GDT_Int16)
+
+    label = Path(path) / f'{tile}_{date}_water_mask.tif'
+    array2raster(str(label), mask, (300000., 10., 0., 5000040., 0., -10.), projection, nodatavalue=255,
+                 dtype=gdal.GDT_Byte)
+
+    return product, label
+
+
+####################################################################################
+class WNBenchmark:
+    """
+    CPU benchmark of the pipeline stages over a synthetic THEIA product: band reading (get_raster), patches creation,
+    save/load of the patches (npy and shards), assembly and inference. Each stage is timed `repeat` times (the best
+    and the median are reported) and run once more under tracemalloc for its peak memory. The results are dicts that
+    can be saved as JSON and compared across commits (see compare_results).
+    """
+
+    stages = ['get_raster', 'create_patches', 'create_patches_view', 'save_patches_npy', 'load_patches_npy',
+              'save_patches_shard', 'load_patches_shard', 'assembly_patches', 'predict_image']
+
+    def __init__(self, path=None, size=1024, patch_size=256, shift=128, bands=['mndwi', 'ndwi', 'B11', 'B2'],
+                 repeat=3, bs=16, threads=None, seed=0):
+        self.path = Path(path) if path is not None else Path(tempfile.mkdtemp(prefix='wn_benchmark_'))
+        self.size, self.patch_size, self.shift, self.bands = size, patch_size, shift, bands
+        self.repeat, self.bs, self.seed = repeat, bs, seed
+
+        if threads is not None:
+            torch.set_num_threads(threads)
+
+        self.product, self.label = None, None
+        self.results = []
+        self.state_ = {}
+
+    def setup(self):
+        if self.product is None:
+            self.product, self.label = create_theia_product(self.path / 'products', self.size, seed=self.seed)
+
+    def open_img(self):
+        img = WNSatImage(self.product, verbose=False)
+        img.clear()
+        return img
+
+    def measure(self, stage, run, setup=None, items=None, unit='patches'):
+        # run(state) is timed, setup() (not timed) prepares its state. items(state) is the number of processed units
+        times = []
+        state = None
+        for _ in range(self.repeat):
+            state = setup() if setup is not None else None
+            gc.collect()
+
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+
+        state = setup() if setup is not None else None
+        gc.collect()
+        tracemalloc.start()
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        n = items(state) if items is not None else None
+        best = min(times)
+        result = {'stage': stage, 'best': best, 'median': float(np.median(times)), 'repeat': self.repeat,
+                  'items': n, 'unit': unit, 'throughput': n / best if n is not None and best > 0 else None,
+                  'peak_memory': peak / 2**20}
+
+        self.results.append(result)
+        print(f'{stage}: {best:.3f}s' + (f' ({result["throughput"]:.1f} {unit}/s)' if n is not None else '') +
+              f' peak {result["peak_memory"]:.0f}Mb')
+
+        return result
+
+    def patches_proc(self, as_view=False):
+        proc = create_custom_patches(self.open_img(), self.bands, self.patch_size, self.shift, as_view=as_view)
+        return proc
+
+    def stage_get_raster(self):
+        bands = theia_10m_bands + theia_20m_bands
+
+        def run(img):
+            for band in bands:
+                img[band]
+
+        self.measure('get_raster', run, setup=self.open_img, items=lambda img: len(bands) * self.size ** 2,
+                     unit='pixels')
+
+    def stage_create_patches(self):
+        self.measure('create_patches', lambda state: state.update(proc=self.patches_proc()), setup=dict,
+                     items=lambda state: len(state['proc']))
+
+    def stage_create_patches_view(self):
+        self.measure('create_patches_view', lambda state: state.update(proc=self.patches_proc(as_view=True)),
+                     setup=dict, items=lambda state: len(state['proc']))
+
+    def stage_save_patches(self, ext):
+        proc = self.patches_proc()
+        out = self.path / f'patches_{ext}'
+
+        def setup():
+            # the shards are appended, so the directory is cleaned before each run
+            for file in out.glob('*') if out.exists() else []:
+                file.unlink()
+            return proc
+
+        self.measure(f'save_patches_{ext}', lambda p: p.save_patches(out, 'bench', ext=ext), setup=setup,
+                     items=lambda p: len(p))
+        self.state_[ext] = out
+
+    def stage_load_patches(self, ext):
+        out = self.state_.get(ext)
+        if out is None:
+            self.stage_save_patches(ext)
+            out = self.state_[ext]
+
+        def run(state):
+            # loads the index and reads all the patches
+            proc = WNPatchProcessor(patches_path=out)
+            state['n'] = sum(1 for _ in proc.iter_batches(self.bs))
+            state['proc'] = proc
+
+        self.measure(f'load_patches_{ext}', run, setup=dict, items=lambda state: len(state['proc']))
+
+    def stage_assembly_patches(self):
+        proc = self.patches_proc()
+        proc.set_format(self.bands, self.patch_size, self.shift, True,
+                        ppr=self.open_img().patches_grid(self.patch_size, self.shift)[1])
+
+        self.measure('assembly_patches', lambda p: p.assembly_patches(), setup=lambda: proc, items=lambda p: len(p))
+
+    def stage_predict_image(self):
+        torch.manual_seed(self.seed)
+        model = torch.nn.Sequential(torch.nn.Conv2d(len(self.bands), 16, 3, padding=1), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(16, 2, 3, padding=1))
+        model.eval()
+
+        grid = self.open_img().patches_grid(self.patch_size, self.shift)
+
+        self.measure('predict_image',
+                     lambda img: predict_image(img, model, self.bands, self.patch_size, self.shift, bs=self.bs),
+                     setup=self.open_img, items=lambda img: grid[0] * grid[1])
+
+    def run(self, stages=None):
+        stages = self.stages if stages is None else stages
+        self.setup()
+
+        for stage in stages:
+            if stage.endswith('_npy') or stage.endswith('_shard'):
+                name, ext = stage.rsplit('_', 1)
+                getattr(self, f'stage_{name}')(ext)
+            else:
+                getattr(self, f'stage_{stage}')()
+
+        return self.report()
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self):
+        meta = {'commit': self.git_commit(), 'time': time.time(), 'python': platform.python_version(),
+                'numpy': np.__version__, 'torch': torch.__version__, 'gdal': gdal.__version__,
+                'cpus': os.cpu_count(), 'torch_threads': torch.get_num_threads(), 'size': self.size,
+                'patch_size': self.patch_size, 'shift': self.shift, 'bands': self.bands, 'repeat': self.repeat,
+                'bs': self.bs}
+
+        return {'meta': meta, 'results': self.results}
+
+    def save(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return fn
+
+
+def compare_results(base, new):
+    # speedup (base time / new time) of each stage present in both results (dicts or JSON files)
+    base, new = [json.load(open(r)) if not isinstance(r, dict) else r for r in (base, new)]
+    base_times = {r['stage']: r['best'] for r in base['results']}
+
+    return {r['stage']: base_times[r['stage']] / r['best'] for r in new['results']
+            if r['stage'] in base_times and r['best'] > 0}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='CPU benchmark of the WaterNet pipeline over synthetic scenes')
+    parser.add_argument('--size', type=int, default=1024, help='size (pixels) of the 10m bands')
+    parser.add_argument('--patch-size', type=int, default=256)
+    parser.add_argument('--shift', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--bs', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=None, help='torch threads')
+    parser.add_argument('--stages', nargs='*', default=None, choices=WNBenchmark.stages)
+    parser.add_argument('--path', default=None, help='working directory (a temporary one by default)')
+    parser.add_argument('--out', default=None, help='JSON file with the results (stdout by default)')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    bench = WNBenchmark(args.path, size=args.size, patch_size=args.patch_size, shift=args.shift, repeat=args.repeat,
+                        bs=args.bs, threads=args.threads)
+    report = bench.run(args.stages)
+
+    if args.out is not None:
+        bench.save(args.out)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare is not None:
+        for stage, speedup in compare_results(args.compare, report).items():
+            print(f'{stage}: {speedup:.2f}x')
@@ -7,6 +7,27 @@ sys.path.reverse()
 from fastai.vision import *
 
 
+def array_as_tensor(item, compact=False):
+    # By default, the items are widened to float32 when opened (a single conversion from the array, memory mapped or
+    # not), as the fastai item transforms (ex. the affine ones, with grid_sample) do not support uint8 or float16.
+    # With compact, the tensor shares the memory with the array, with no copies, and keeps the dtype it has on disk
+    # (ex. uint8 labels, float16 images). This only works with the item transforms disabled, and the batches have to
+    # be widened (see widen_batch). uint16 is not supported by all the torch versions, so it is always converted
+    if not compact:
+        return torch.from_numpy(np.asarray(item, dtype='float32'))
+
+    if item.dtype == np.uint16:
+        item = item.astype('int32')
+    return torch.from_numpy(item)
+
+
+def widen_batch(b):
+    # converts a batch of compact items to float images and long labels, once per batch (and on the device, when
+    # used as a DataBunch transform: data.add_tfm(widen_batch)). Needed when the item lists have compact = True
+    x, y = b
+    return x.float(), y.long()
+
+
 class MSImage(Image):
     """
     This class is used by MSSegmentationItemList. It displays correctly a MS image using the first 3 bands
@@ -17,23 +38,29 @@ class MSImage(Image):
             # Use the first (1 or 3) channels to display the image
             chnls = 3 if self.px.shape[0] >= 3 else 1
 
-            plt.imsave(str_buffer, image2np(self.px[0:chnls, :, :]), format=format_str)
+            plt.imsave(str_buffer, image2np(self.px[0:chnls, :, :].float()), format=format_str)
             return str_buffer.getvalue()
 
     def show(self, ax: plt.Axes = None, figsize: tuple = (3, 3), title: Optional[str] = None, hide_axis: bool = True,
              cmap: str = None, y: Any = None, bright=1., **kwargs):
         # when displaying a MSImage we actually create a "fake" Image with 1 or 3 channels only and call the original SHOW
         chnls = 3 if self.px.shape[0] >= 3 else 1
-        img = Image(self.px[0:chnls, :, :]*bright)
+        img = Image(self.px[0:chnls, :, :].float()*bright)
         img.show(ax, figsize, title, hide_axis, cmap, y, **kwargs)
 
 
 class MSSegmentationLabelList(SegmentationLabelList):
+    # The labels are memory mapped copy-on-write ('c'), so they are only read when used and the transforms can still
+    # modify them. None reads the whole file
+    mmap_mode = 'c'
+
+    # keeps the stored dtype (see array_as_tensor). Only with the item transforms disabled
+    compact = False
 
     def open(self, fn):
-        item = np.load(fn).astype('float32')
+        item = np.load(fn, mmap_mode=self.mmap_mode)
         # item = torch.load(fn).astype('float32')
-        return ImageSegment(torch.tensor(item[np.newaxis, ...]))
+        return ImageSegment(array_as_tensor(item[np.newaxis, ...], self.compact))
 
 
 #         return ImageSegment(torch.tensor(np.expand_dims(item, 0)))
@@ -42,18 +69,46 @@ class MSSegmentationLabelList(SegmentationLabelList):
 class MSSegmentationItemList(SegmentationItemList):
     _label_cls = MSSegmentationLabelList
 
+    # see MSSegmentationLabelList.mmap_mode and compact
+    mmap_mode = 'c'
+    compact = False
+
     def open(self, fn):
-        item = np.load(fn).astype('float32')
+        item = np.load(fn, mmap_mode=self.mmap_mode)
         #         pdb.set_trace()
         # item = torch.load(fn).astype('float32')
         #         print (f'Passing SegmentationItemList {fn} shape: {item.shape}')
         #         return MSImage(item)
-        return MSImage(torch.tensor(item))
+        return MSImage(array_as_tensor(item, self.compact))
 
     def reconstruct(self, t: Tensor): return MSImage(t.float().clamp(min=0, max=1))
 
 
+# label of each image patch, filled by create_lbl_map
+lbl_fns = {}
+
+
+def create_lbl_map(imgs_path: Path, lbls_path: Path = None, img_bands='n_mndwin_ndwin_B11B2', lbl_bands='water_mask'):
+    # Maps each image patch to its label, listing each directory once, so get_lbl_fn is a dict lookup.
+    # The labels are matched by name (without the extension), as in get_lbl_fn
+    imgs_path = Path(imgs_path)
+    lbls_path = imgs_path.parent / 'labels' if lbls_path is None else Path(lbls_path)
+
+    lbls = {fn.stem: fn for fn in lbls_path.iterdir()}
+
+    for fn in imgs_path.iterdir():
+        lbl_fn = lbls.get(fn.stem.replace(img_bands, lbl_bands))
+        if lbl_fn is not None:
+            lbl_fns[fn] = lbl_fn
+
+    return lbl_fns
+
+
 def get_lbl_fn(img_fn: Path):
+    lbl_fn = lbl_fns.get(img_fn)
+    if lbl_fn is not None:
+        return lbl_fn
+
     lbl_path = img_fn.parent.parent / 'labels'
     lbl_name = img_fn.name.replace('n_mndwin_ndwin_B11B2', 'water_mask')
     return (lbl_path / lbl_name).with_suffix('.torch')
\ No newline at end of file
@@ -1,11 +1,23 @@
 from pathlib import Path
+from collections import OrderedDict
 import numpy as np
 import gdal
 import math
 import torch
 from torch.utils import data
+import os
 import time
 import pickle
+import json
+import queue
+import sqlite3
+import tempfile
+import hashlib
+import threading
+import itertools
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from PIL import Image as PilImg
 import WNFastaiClasses
 
@@ -67,21 +79,20 @@ def open_gdal_ds(paths: list, key, name, recursive=False):
     return {}
 
 
-def array2raster(filename, array, geo_transform, projection, nodatavalue=0, dtype=gdal.GDT_Float32):
+def array2raster(filename, array, geo_transform, projection, nodatavalue=0, dtype=gdal.GDT_Float32, **options):
+    # array can be (rows, cols) or (bands, rows, cols). The options are passed to WNRasterWriter
+    # (compress, predictor, tiled, block_size, threads, bigtiff, cog...)
+    array = np.asarray(array)
 
-    cols = array.shape[1]
-    rows = array.shape[0]
+    cols = array.shape[-1]
+    rows = array.shape[-2]
+    n_bands = 1 if array.ndim == 2 else array.shape[0]
 
     print('Saving image: ' + filename)
 
-    driver = gdal.GetDriverByName('GTiff')
-    out_raster = driver.Create(filename, cols, rows, 1, dtype, options=['COMPRESS=PACKBITS'])
-    out_raster.SetGeoTransform(geo_transform)
-    out_raster.SetProjection(projection)
-    outband = out_raster.GetRasterBand(1)
-    outband.SetNoDataValue(nodatavalue)
-    outband.WriteArray(array)
-    outband.FlushCache()
+    with WNRasterWriter(filename, rows, cols, n_bands, geo_transform, projection, dtype=dtype,
+                        nodatavalue=nodatavalue, **options) as writer:
+        writer.write(array)
     return
 
 
@@ -138,30 +149,104 @@ def create_training_patches_old(train_imgs, out_path, channels_first=True, ext='
         pproc.clear()
 
 
-def create_custom_patches(img, bands, size, shift, bands_math={}, chnls_first=True):
-    # function
+def create_custom_patches(img, bands, size, shift, bands_math={}, chnls_first=True, as_view=False, valid=None):
+    # with valid=True, the bands read for the band math are loaded first, so they are read once for the band math
+    # and the validity mask (see WNPatchProcessor.create_patches)
+    for key, value in bands_math.items():
+        img.set_band_math(key, value)
+
+    if valid is True:
+        # the reductions first, as they may load whole bands the window takes its region from
+        img.prepare_reductions(list(bands_math.keys()))
+        img.load_bands(img.source_bands(bands + list(bands_math.keys())))
+
     for key, value in bands_math.items():
         img.band_math(key, value)
 
     pproc = WNPatchProcessor(img)
 
-    pproc.create_patches(bands+list(bands_math.keys()), size, shift, chnls_first)
+    pproc.create_patches(bands+list(bands_math.keys()), size, shift, chnls_first, as_view=as_view, valid=valid)
 
     return pproc
 
 
 def create_train_patches(img, lbl, out_path, size, shift, bands, bands_math={}, chnls_first=True, ext='npy',
-                         base_name='', proc_label={}, fill_nan=None):
+                         base_name='', proc_label={}, fill_nan=None, window_rows=None, first_row=None, last_row=None,
+                         telemetry=None, quantize=None, quantize_label=None, skip_invalid=False):
+    # if window_rows is given, the images are processed in windows of `window_rows` rows of patches,
+    # so the memory is bounded by the window and not by the scene.
+    # first_row and last_row restrict the processing to a range of rows of patches (windowed), keeping
+    # the same patches names as if the whole scene were processed.
+    # telemetry (WNTelemetry) receives a 'patches' event for each window (or scene) with the create and save times.
+    # quantize and quantize_label are the storage quantization of the images and labels (see save_patches). Given as
+    # a dtype, they use the fixed ranges (WNQuantizer.fixed), so all the windows and scenes share the same range
+    # with skip_invalid, the patches that are fully invalid in the image (NaN or nodata) are not saved, for the
+    # images nor for the labels. The mask is calculated from the bands read for the images patches (see
+    # WNPatchProcessor.create_patches), and reused for the labels
 
     out_path = Path(out_path)
+    windowed = window_rows is not None or first_row is not None or last_row is not None
+
+    # mask of the rows of patches from valid_first, filled by the images (processed first)
+    skip_invalid = skip_invalid and img is not None
+    valid, valid_first = None, 0
+
+    for i, path_name, maths, quant in zip([img, lbl], ['images', 'labels'], [bands_math, proc_label],
+                                          [quantize, quantize_label]):
+        if quant is not None and not isinstance(quant, WNQuantizer):
+            quant = WNQuantizer.fixed(quant, integral=path_name == 'labels')
 
-    for i, path_name, maths in zip([img, lbl], ['images', 'labels'], [bands_math, proc_label]):
         if i is not None:
             path = out_path / path_name
 
             bands = bands if path_name == 'images' else [0]
 
-            img_proc = create_custom_patches(i, bands, size, shift, maths, chnls_first=chnls_first)
+            if windowed:
+                first_row = 0 if first_row is None else first_row
+                start = first_row * i.patches_grid(size, shift)[1]
+
+                # ranges of rows are saved in their own shards, so they can be written concurrently
+                part = f'{first_row:05d}' if (first_row > 0 or last_row is not None) else None
+
+                # the shards indices, stats and manifest are written once, after all the windows
+                masks = []
+                with WNSaveSession() as session:
+                    for window in i.iter_patch_windows(size, shift, window_rows, first_row, last_row):
+                        win_valid = True if skip_invalid and i is img else None
+                        if skip_invalid and i is not img:
+                            win_first = window.yoff // shift - valid_first
+                            win_valid = valid[win_first:win_first + window.patches_grid(size, shift)[0]]
+
+                        t_start = time.perf_counter()
+                        win_proc = create_custom_patches(window, bands, size, shift, maths, chnls_first=chnls_first,
+                                                         valid=win_valid)
+                        # the manifest records the grid of the scene, not of the window
+                        win_proc.format_.update({'patches_per_column': i.patches_grid(size, shift)[0]})
+                        t_created = time.perf_counter()
+                        win_proc.save_patches(path, base_name, ext, fill_nan=fill_nan, start=start, part=part,
+                                              quantize=quant, session=session)
+
+                        if telemetry is not None:
+                            telemetry.emit('patches', scene=base_name, kind=path_name, start=start,
+                                           patches=len(win_proc), create=t_created - t_start,
+                                           save=time.perf_counter() - t_created, peak_memory=telemetry.peak_memory())
+
+                        if skip_invalid and i is img:
+                            masks.append(win_proc.valid_.reshape(-1, i.patches_grid(size, shift)[1]))
+
+                        start += len(win_proc)
+                        win_proc.clear()
+
+                if len(masks) > 0:
+                    valid, valid_first = np.concatenate(masks), first_row
+                continue
+
+            t_start = time.perf_counter()
+            img_valid = (True if i is img else valid) if skip_invalid else None
+            img_proc = create_custom_patches(i, bands, size, shift, maths, chnls_first=chnls_first, valid=img_valid)
+            if skip_invalid and i is img:
+                valid = img_proc.valid_
+            t_created = time.perf_counter()
 
             # else:
             #     if len(proc_label) == 0:
@@ -169,28 +254,160 @@ def create_train_patches(img, lbl, out_path, size, shift, bands, bands_math={},
             #     else:
             #         img_proc = create_custom_patches(i, list(proc_label.keys())[0], size, shift, bands_math=proc_label)
 
-            img_proc.save_patches(path, base_name, ext, fill_nan=fill_nan)
+            img_proc.save_patches(path, base_name, ext, fill_nan=fill_nan, quantize=quant)
+
+            if telemetry is not None:
+                telemetry.emit('patches', scene=base_name, kind=path_name, start=0, patches=len(img_proc),
+                               create=t_created - t_start, save=time.perf_counter() - t_created,
+                               peak_memory=telemetry.peak_memory())
+
             img_proc.clear()
 
     return 'Processing completed'
 
 
+def open_train_images(value, shape):
+    if 'img' in value:
+        img = WNSatImage(value['img'])
+        img.shape = shape
+    else:
+        img = None
+
+    if 'lbl' in value:
+        lbl = WNImage(value['lbl'])
+        lbl.shape = shape
+    else:
+        lbl = None
+
+    return img, lbl
+
+
+# parameters of the parallel patches creation, set in each worker process by init_patches_worker
+patches_job = {}
+
+
+def init_patches_worker(job, max_memory=None):
+    # With the fork start method the job is inherited and not pickled, so the band math can have lambdas.
+    # max_memory (bytes) caps the data segment (heap and private mappings) of the worker. The address space
+    # (RLIMIT_AS) is not capped, as it counts the reserved memory of the threads and libraries that is never used
+    global patches_job
+    patches_job = job
+
+    if max_memory is not None:
+        import resource
+        hard = resource.getrlimit(resource.RLIMIT_DATA)[1]
+        soft = max_memory if hard == resource.RLIM_INFINITY else min(max_memory, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (soft, hard))
+
+
+def train_patches_task(task):
+    # task is (scene key, first_row, last_row). The rows are None to process the whole scene
+    key, first_row, last_row = task
+    job = patches_job
+    start = time.time()
+
+    img, lbl = open_train_images(job['imgs_dict'][key], job['shape'])
+
+    create_train_patches(
+        img,
+        lbl,
+        out_path=job['out_path'],
+        size=job['size'],
+        shift=job['shift'],
+        bands=job['bands'],
+        bands_math=job['bands_math'],
+        chnls_first=True,
+        base_name=key,
+        proc_label=job['proc_label'],
+        window_rows=job['window_rows'],
+        ext=job['ext'],
+        quantize=job.get('quantize'),
+        quantize_label=job.get('quantize_label'),
+        skip_invalid=job.get('skip_invalid', False),
+        first_row=first_row,
+        last_row=last_row
+    )
+
+    return key, first_row, time.time() - start
+
+
+def parallel_train_patches_creation(imgs_dict, job, workers, max_memory=None, split_windows=False, progress=None,
+                                    telemetry=None):
+    # creates the tasks: one per scene or, with split_windows, one per window of each scene
+    tasks = []
+    for key, value in imgs_dict.items():
+        if not split_windows:
+            tasks.append((key, None, None))
+            continue
+
+        img, lbl = open_train_images(value, job['shape'])
+        ref = img if img is not None else lbl
+        num_rows = ref.patches_grid(job['size'], job['shift'])[0]
+        rows = job['window_rows'] if job['window_rows'] is not None else ref.default_window_rows(job['shift'])
+        img, lbl, ref = None, None, None
+
+        tasks += [(key, row, row + rows) for row in range(0, num_rows, rows)]
+
+    # the fork context does not need to pickle the job (that can have lambdas)
+    ctx = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+    results, failures = [], []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init_patches_worker,
+                             initargs=(job, max_memory)) as pool:
+        futures = {pool.submit(train_patches_task, task): task for task in tasks}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            task = futures[future]
+            try:
+                key, first_row, elapsed = future.result()
+                results.append((key, first_row, elapsed))
+                rows = '' if first_row is None else f' (rows {task[1]}-{task[2]})'
+                print(f'[{done}/{len(tasks)}] {key}{rows} completed in {elapsed:.1f}s. '
+                      f'Total time: {time.time() - start:.0f}s')
+                if telemetry is not None:
+                    telemetry.emit('patches_task', scene=key, first_row=task[1], last_row=task[2], seconds=elapsed,
+                                   ok=True)
+            except Exception as e:
+                failures.append((task, e))
+                print(f'[{done}/{len(tasks)}] {task[0]} failed: {e!r}')
+                if telemetry is not None:
+                    telemetry.emit('patches_task', scene=task[0], first_row=task[1], last_row=task[2], ok=False,
+                                   error=repr(e))
+
+            if progress is not None:
+                progress(done, len(tasks), task)
+
+    # the other tasks are completed before reporting the failed ones
+    if failures:
+        msg = '\n'.join(f'{task[0]}' + ('' if task[1] is None else f' (rows {task[1]}-{task[2]})') + f': {e!r}'
+                        for task, e in failures)
+        raise RuntimeError(f'{len(failures)} of {len(tasks)} patches tasks failed:\n{msg}') from failures[0][1]
+
+    return sorted(results, key=lambda r: (r[0], -1 if r[1] is None else r[1]))
+
+
 def auto_train_patches_creation(imgs_dict, out_path, bands, size, shift, bands_math={}, proc_label={},
-                                shape=(10980, 10980)):
+                                shape=(10980, 10980), window_rows=None, ext='npy', workers=None, max_memory=None,
+                                split_windows=False, progress=None, telemetry=None, quantize=None, quantize_label=None,
+                                skip_invalid=False):
+    # With workers > 1, the scenes (or the windows of each scene, if split_windows) are distributed in a process pool.
+    # max_memory is the memory cap (bytes) of each worker and progress(done, total, task) is called after each task.
+    # If any task fails, a RuntimeError listing the failed tasks is raised once all the tasks are done.
+    # The names of the patches are the same in the sequential and parallel modes.
+    # telemetry (WNTelemetry) receives the 'patches' events (or a 'patches_task' event per task, in parallel).
+    # quantize and quantize_label are passed to create_train_patches (dtypes use the fixed ranges).
+    # With skip_invalid, the fully invalid patches are not saved
+    if workers is not None and workers > 1:
+        job = {'imgs_dict': imgs_dict, 'out_path': out_path, 'bands': bands, 'size': size, 'shift': shift,
+               'bands_math': bands_math, 'proc_label': proc_label, 'shape': shape, 'window_rows': window_rows,
+               'ext': ext, 'quantize': quantize, 'quantize_label': quantize_label, 'skip_invalid': skip_invalid}
+        return parallel_train_patches_creation(imgs_dict, job, workers, max_memory, split_windows, progress, telemetry)
+
     for key, value in imgs_dict.items():
         print(f'Creating patches for {key}')
 
-        if 'img' in value:
-            img = WNSatImage(value['img'])
-            img.shape = shape
-        else:
-            img = None
-
-        if 'lbl' in value:
-            lbl = WNImage(value['lbl'])
-            lbl.shape = shape
-        else:
-            lbl = None
+        img, lbl = open_train_images(value, shape)
 
         create_train_patches(
             img,
@@ -202,36 +419,937 @@ def auto_train_patches_creation(imgs_dict, out_path, bands, size, shift, bands_m
             bands_math=bands_math,
             chnls_first=True,
             base_name=key,
-            proc_label=proc_label
+            proc_label=proc_label,
+            window_rows=window_rows,
+            ext=ext,
+            telemetry=telemetry,
+            quantize=quantize,
+            quantize_label=quantize_label,
+            skip_invalid=skip_invalid
         )
 
 
-def predict_patches(proc, learn):
-    lst_img = []
-    lst_mask = []
+def fastai_transform(learn):
+    # returns a function that applies the fastai data transforms (ex. normalization) on a batch, if there is any
+    data_loader = getattr(getattr(learn, 'data', None), 'valid_dl', None)
+    tfms = getattr(data_loader, 'tfms', None)
+    if not tfms:
+        return None
+
+    tfms = tfms if isinstance(tfms, list) else [tfms]
+
+    def transform(x):
+        for tfm in tfms:
+            x, _ = tfm((x, None))
+        return x
+
+    return transform
+
+
+def predict_patches(proc, learn, bs=32, device=None):
+    # learn can be a fastai Learner, a WNLearner or a torch model.
+    # Returns the masks (N, H, W) and the probabilities (N, classes, H, W) as contiguous arrays
+    model = learn.model if hasattr(learn, 'model') else learn
+
+    predictor = WNPredictor(model, bs=bs, device=device, transform=fastai_transform(learn))
+
+    return predictor.predict_proc(proc)
+
+
+def prefetch(iterable, size=1):
+    # runs the iterable in a background thread, keeping at most `size` items ready
+    items = queue.Queue(maxsize=size)
+
+    def producer():
+        try:
+            for item in iterable:
+                items.put(('item', item))
+            items.put(('end', None))
+        except BaseException as e:
+            items.put(('error', e))
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    while True:
+        kind, item = items.get()
+        if kind == 'end':
+            return
+        elif kind == 'error':
+            raise item
+        yield item
+
+
+def predict_image(img, learn, bands, size, shift, bands_math={}, bs=32, out_file=None, window_rows=None,
+                  probs=False, prefetch_windows=1, telemetry=None, skip_invalid=True, nodata=0, **options):
+    # Streaming pipeline: windows of rows of patches are read and processed (band math and patches) in a background
+    # thread, predicted in batches, and the overlapping probabilities are assembled row by row. The finished rows are
+    # written to out_file (GeoTIFF) if it is given, otherwise the result is returned as an array.
+    # The result is the mask (uint8) or, with probs=True, the probabilities of each class.
+    # The options are passed to WNRasterWriter (compress, tiled, cog...).
+    # telemetry (WNTelemetry) receives a 'predict_window' event per window, with the time waiting for the patches,
+    # the inference and the assembly/write times, and a final 'predict_image' event.
+    # With skip_invalid, the patches that are fully invalid (NaN or nodata, see WNImage.valid_patches) are not
+    # predicted, and the pixels no valid patch covers get nodata. The validity is calculated from the bands read for
+    # each window, with no other pass over the scene
+    model = learn.model if hasattr(learn, 'model') else learn
+    predictor = WNPredictor(model, bs=bs, transform=fastai_transform(learn))
+
+    num_rows, num_cols = img.patches_grid(size, shift)
+
+    def windows_patches():
+        for window in img.iter_patch_windows(size, shift, window_rows):
+            proc = create_custom_patches(window, bands, size, shift, bands_math, as_view=True,
+                                         valid=True if skip_invalid else None)
+
+            # window with no valid patches
+            if proc.valid_ is not None and not proc.valid_.any():
+                proc.clear()
+                proc = None
+
+            yield window.yoff // shift, window.patches_grid(size, shift)[0], proc
+
+    assembler, out_raster, result = None, None, None
+
+    # rows of patches before the first prediction (the number of classes is unknown until there)
+    pending_rows = 0
+
+    def write(chunks):
+        for first_row, rows in chunks:
+            # the pixels not covered by any (valid) patch are NaN in the assembly
+            invalid = np.isnan(rows[0])
+            pred = rows if probs else rows.argmax(axis=0)[np.newaxis].astype(np.uint8)
+            pred[:, invalid] = nodata
+
+            if out_raster is not None:
+                out_raster.write(pred, 0, first_row)
+            else:
+                result[:, first_row:first_row + pred.shape[1], :pred.shape[2]] = pred
+
+    start = t_wait = time.perf_counter()
+    num_patches = 0
+
+    for first, n, proc in prefetch(windows_patches(), prefetch_windows):
+        timing = {'data_wait': time.perf_counter() - t_wait, 'inference': 0., 'write': 0.}
+
+        if proc is None:
+            # window with no valid patches
+            if assembler is None:
+                pending_rows += n
+            else:
+                for _ in range(n):
+                    write(assembler.add_row(None))
+
+            if telemetry is not None:
+                telemetry.emit('predict_window', patches=0, patches_per_s=0., skipped=n * num_cols, **timing)
+
+            t_wait = time.perf_counter()
+            continue
+
+        for row in range(n):
+            row_valid = None if proc.valid_ is None else proc.valid_[row * num_cols:(row + 1) * num_cols]
+            if row_valid is not None and not row_valid.any():
+                if assembler is None:
+                    pending_rows += 1
+                else:
+                    write(assembler.add_row(None))
+                continue
+
+            idxs = np.arange(row * num_cols, (row + 1) * num_cols)
+            idxs = idxs if row_valid is None else idxs[row_valid]
+            batch = proc.take(idxs)
+
+            t_start = time.perf_counter()
+            _, row_probs = predictor.predict((batch[i:i + bs] for i in range(0, len(batch), bs)), len(batch))
+            timing['inference'] += time.perf_counter() - t_start
+            t_start = time.perf_counter()
+
+            if row_valid is not None:
+                row_probs = WNPredictor.scatter(row_probs, np.flatnonzero(row_valid), num_cols)
+
+            if assembler is None:
+                classes = row_probs.shape[1]
+                assembler = WNPatchAssembler(num_cols, size, shift, channels=classes, dtype='float32', fill=np.nan)
+
+                n_bands = classes if probs else 1
+                dtype = np.float32 if probs else np.uint8
+                if out_file is not None:
+                    out_raster = WNRasterWriter(str(out_file), img.shape[0], img.shape[1], n_bands,
+                                                img.scaled_geo_transform, img.projection,
+                                                dtype=gdal.GDT_Float32 if probs else gdal.GDT_Byte,
+                                                nodatavalue=nodata, **options)
+                else:
+                    result = np.full((n_bands,) + tuple(img.shape), nodata, dtype=dtype)
+
+                for _ in range(pending_rows):
+                    write(assembler.add_row(None))
+
+            write(assembler.add_row(row_probs, row_valid))
+            timing['write'] += time.perf_counter() - t_start
+
+        num_patches += len(proc)
+        if telemetry is not None:
+            elapsed = time.perf_counter() - t_wait
+            telemetry.emit('predict_window', patches=len(proc), patches_per_s=len(proc) / elapsed, **timing)
+
+        proc.clear()
+        t_wait = time.perf_counter()
+
+    if assembler is None:
+        print(f'No patches to predict')
+        return None
+
+    write(assembler.finish())
+
+    if out_raster is not None:
+        out_raster.close()
+
+    if telemetry is not None:
+        elapsed = time.perf_counter() - start
+        telemetry.emit('predict_image', patches=num_patches, seconds=elapsed, patches_per_s=num_patches / elapsed,
+                       peak_memory=telemetry.peak_memory(predictor.device))
+
+    if out_raster is not None:
+        return out_file
+
+    return result.squeeze()
+
+
+def nd_offset(min_cte):
+    # constant that makes both bands positive in the normalized difference
+    return -min_cte + 0.0001 if min_cte <= 0 else 0
+
+
+####################################################################################
+class WNExpr:
+    """
+    Node of a lazy band math expression. Leaves are bands ('band') or constants ('const'), and the other nodes
+    apply fn to their children. Nodes with the same key are the same subexpression, and are calculated once.
+    The key holds the function object (not its name), so different functions (ex. lambdas) are never merged.
+    Reductions (ex. min) are calculated over the whole image before the rest of the expression.
+    """
+
+    def __init__(self, op, children=(), fn=None, value=None, combine=None):
+        self.op, self.children, self.fn, self.value, self.combine = op, tuple(children), fn, value, combine
+
+        # the type of the constants is kept in the key, as 1 and 1. do not give the same dtype
+        leaf_value = (value, type(value)) if op == 'const' else (value,) if op == 'band' else ()
+        self.key = (op, fn) + leaf_value + tuple(child.key for child in self.children)
+
+    @staticmethod
+    def wrap(value):
+        # Only scalars are constants. Arrays would have to match the chunks, so they raise an error and the
+        # formula is evaluated eagerly (see WNImage.band_expr)
+        if isinstance(value, WNExpr):
+            return value
+
+        if np.ndim(value) > 0:
+            raise TypeError(f'Only scalar constants are supported in lazy expressions, not {type(value).__name__}')
+
+        return WNExpr('const', value=value[()] if isinstance(value, np.ndarray) else value)
+
+    @property
+    def is_reduction(self):
+        return self.combine is not None
+
+    def bands(self):
+        # names of the bands in the leaves
+        result = {self.value} if self.op == 'band' else set()
+        for child in self.children:
+            result |= child.bands()
+        return result
+
+    def reductions(self):
+        # all the reductions in the expression, by key
+        result = {}
+        for child in self.children:
+            result.update(child.reductions())
+        if self.is_reduction:
+            result[self.key] = self
+        return result
+
+    def min(self):
+        return WNExpr('min', [self], fn=np.min, combine=np.minimum)
+
+    def max(self):
+        return WNExpr('max', [self], fn=np.max, combine=np.maximum)
+
+    def apply(self, fn, name=None):
+        # applies a function of one argument (array or scalar)
+        return WNExpr(name if name is not None else fn.__name__, [self], fn=fn)
+
+    def __add__(self, other):
+        return WNExpr('add', [self, self.wrap(other)], fn=np.add)
+
+    def __radd__(self, other):
+        return WNExpr('add', [self.wrap(other), self], fn=np.add)
+
+    def __sub__(self, other):
+        return WNExpr('sub', [self, self.wrap(other)], fn=np.subtract)
+
+    def __rsub__(self, other):
+        return WNExpr('sub', [self.wrap(other), self], fn=np.subtract)
+
+    def __mul__(self, other):
+        return WNExpr('mul', [self, self.wrap(other)], fn=np.multiply)
+
+    def __rmul__(self, other):
+        return WNExpr('mul', [self.wrap(other), self], fn=np.multiply)
+
+    def __truediv__(self, other):
+        return WNExpr('div', [self, self.wrap(other)], fn=np.true_divide)
+
+    def __rtruediv__(self, other):
+        return WNExpr('div', [self.wrap(other), self], fn=np.true_divide)
+
+    def __pow__(self, other):
+        return WNExpr('pow', [self, self.wrap(other)], fn=np.power)
+
+    def __neg__(self):
+        return WNExpr('neg', [self], fn=np.negative)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # numpy ufuncs (ex. np.sqrt, np.minimum) called with expressions create new nodes
+        if method != '__call__' or len(kwargs) > 0:
+            return NotImplemented
+        return WNExpr(ufunc.__name__, [self.wrap(i) for i in inputs], fn=ufunc)
+
+    def __repr__(self):
+        if self.op in ('band', 'const'):
+            return f'{self.op}({self.value})'
+        return f'{self.op}({", ".join(repr(child) for child in self.children)})'
+
+
+class WNExprBuilder:
+    """
+    Stand-in for a WNImage when building lazy expressions: img[band] returns the expression of the band.
+    The calculated bands that have lazy formulas are inlined, so their subexpressions can be shared.
+    """
+
+    def __init__(self, img):
+        self.img = img
+
+    def __getitem__(self, bands):
+        if type(bands) is list:
+            return [self[band] for band in bands]
+
+        if bands not in self.img.available_bands:
+            raise KeyError(f'Band {bands} not available')
+
+        if bands in self.img.calc_bands:
+            expr = self.img.band_expr(bands)
+            if expr is not None:
+                return expr
+
+        return WNExpr('band', value=bands)
+
+    def get_raster(self, band, factor=None):
+        return self[band]
+
+    def normalized_difference(self, b1, b2, name=None):
+        b1, b2 = self[b1], self[b2]
+        min_cte = np.minimum(b1.min(), b2.min()).apply(nd_offset)
+
+        return ((b1 + min_cte) - (b2 + min_cte)) / ((b1 + min_cte) + (b2 + min_cte))
+
+
+####################################################################################
+class WNBandCache:
+    """
+    Process-wide cache of the bands loaded by all the WNImages, with a budget in bytes (None for no limit).
+    When the budget is exceeded, the least recently used bands that are not pinned are evicted or, if spill_path
+    is given, saved to disk and read back memory mapped.
+    """
+
+    def __init__(self, max_bytes=None, spill_path=None):
+        self.max_bytes, self.spill_path = max_bytes, spill_path
+
+        self.items_ = OrderedDict()
+        self.spilled_, self.pins_ = {}, {}
+        self.nbytes, self.hits, self.misses, self.evictions, self.spills = 0, 0, 0, 0, 0
+
+        self.owners_ = itertools.count()
+        self.lock_ = threading.RLock()
+
+    def configure(self, max_bytes=None, spill_path=None):
+        with self.lock_:
+            self.max_bytes = max_bytes
+            self.spill_path = Path(spill_path) if spill_path is not None else None
+            if self.spill_path is not None:
+                self.spill_path.mkdir(parents=True, exist_ok=True)
+            self.evict()
+
+    def new_owner(self):
+        return next(self.owners_)
+
+    def get(self, key, count=True):
+        # count=False looks the band up (ex. to check if it is loaded) without counting it in the statistics
+        with self.lock_:
+            if key in self.items_:
+                if count:
+                    self.items_.move_to_end(key)
+                    self.hits += 1
+                return self.items_[key]
+
+            if key in self.spilled_:
+                self.hits += count
+                return np.load(self.spilled_[key], mmap_mode='c')
+
+            self.misses += count
+            return None
+
+    def put(self, key, value):
+        with self.lock_:
+            self.remove(key)
+            if value is None:
+                return
+
+            self.items_[key] = value
+            self.nbytes += value.nbytes
+            self.evict()
+
+    def remove(self, key):
+        with self.lock_:
+            if key in self.items_:
+                self.nbytes -= self.items_.pop(key).nbytes
+
+            if key in self.spilled_:
+                fn = self.spilled_.pop(key)
+                if os.path.exists(fn):
+                    os.remove(fn)
+
+    def contains(self, key):
+        return key in self.items_ or key in self.spilled_
+
+    def keys_of(self, owner):
+        with self.lock_:
+            return [key[1] for key in list(self.items_) + list(self.spilled_) if key[0] == owner]
+
+    def remove_owner(self, owner):
+        with self.lock_:
+            for band in self.keys_of(owner):
+                self.remove((owner, band))
+            for key in [key for key in self.pins_ if key[0] == owner]:
+                self.pins_.pop(key)
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+
+        with self.lock_:
+            for key in list(self.items_):
+                if self.nbytes <= self.max_bytes:
+                    break
+
+                if self.pins_.get(key, 0) > 0:
+                    continue
+
+                value = self.items_.pop(key)
+                self.nbytes -= value.nbytes
+                self.evictions += 1
+
+                if self.spill_path is not None:
+                    fd, fn = tempfile.mkstemp(suffix='.npy', dir=str(self.spill_path))
+                    with os.fdopen(fd, 'wb') as f:
+                        np.save(f, value, allow_pickle=False)
+                    self.spilled_[key] = fn
+                    self.spills += 1
+
+    @contextmanager
+    def pinned(self, keys):
+        with self.lock_:
+            for key in keys:
+                self.pins_[key] = self.pins_.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock_:
+                for key in keys:
+                    self.pins_[key] = self.pins_.get(key, 1) - 1
+                    if self.pins_[key] <= 0:
+                        self.pins_.pop(key)
+                self.evict()
+
+    @property
+    def occupancy(self):
+        return self.nbytes / self.max_bytes if self.max_bytes else 0.
+
+    @property
+    def stats(self):
+        return {'bands': len(self.items_), 'spilled': len(self.spilled_), 'pinned': len(self.pins_),
+                'nbytes': self.nbytes, 'max_bytes': self.max_bytes, 'occupancy': self.occupancy,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'spills': self.spills}
+
+    def __repr__(self):
+        limit = f'{self.max_bytes/1024/1024:.1f}' if self.max_bytes is not None else 'unlimited'
+        return (f'WNBandCache with {len(self.items_)} bands ({self.nbytes/1024/1024:.1f}/{limit} Mb), '
+                f'{len(self.spilled_)} spilled to disk and {len(self.pins_)} pinned')
+
+
+# cache shared by all the images. Use band_cache.configure(max_bytes, spill_path) to set the budget
+band_cache = WNBandCache()
+
+
+class WNDtypePolicy:
+    """
+    dtypes of the pipeline. The bands are scaled and the band math is calculated in the compute dtype, and the bands,
+    patches and assembled scenes are kept in the storage dtype (float16 halves the memory of float32). Integer bands
+    read with no factor (ex. labels) keep their dtype.
+    """
+
+    def __init__(self, compute='float32', storage='float32'):
+        self.compute, self.storage = np.dtype(compute), np.dtype(storage)
+
+    def configure(self, compute=None, storage=None):
+        if compute is not None:
+            self.compute = np.dtype(compute)
+        if storage is not None:
+            self.storage = np.dtype(storage)
+
+    @property
+    def accumulator(self):
+        # dtype of the sums (ex. assembly), never narrower than the compute dtype
+        return np.promote_types(self.storage, self.compute)
+
+    def storage_dtype(self, dtype):
+        return self.storage if np.dtype(dtype).kind == 'f' else np.dtype(dtype)
+
+    def to_compute(self, arr):
+        if isinstance(arr, np.ndarray) and arr.dtype.kind in 'fiu' and arr.dtype != self.compute:
+            return arr.astype(self.compute)
+        return arr
+
+    def to_storage(self, arr):
+        if isinstance(arr, np.ndarray) and arr.dtype.kind == 'f' and arr.dtype != self.storage:
+            return arr.astype(self.storage)
+        return arr
+
+    def scale(self, arr, factor=1):
+        # applies the factor in the compute dtype (in place, no float64 temporaries) and returns the storage dtype
+        if arr is None or (factor == 1 and arr.dtype.kind in 'iub'):
+            return arr
+
+        arr = arr.astype(self.compute)
+        if factor != 1:
+            arr *= self.compute.type(factor)
 
-    for idx in range(len(proc)):
-        ms_img = WNFastaiClasses.MSImage(torch.tensor(proc[idx]).float())
-        pred_img, mask, probs = learn.predict(ms_img)
+        return self.to_storage(arr)
 
-        # array = np.array(mask[0].data).squeeze()[:,:,np.newaxis]
-        array = np.array(mask[0].data).squeeze()
+    def __repr__(self):
+        return f'WNDtypePolicy compute={self.compute.name} storage={self.storage.name}'
+
+
+# dtypes used by all the images and patches. Ex: dtype_policy.configure(storage='float16')
+dtype_policy = WNDtypePolicy()
+
+
+class WNLoadedBands:
+    """
+    Dict-like view of the bands of one image inside the band cache. The bands may disappear when evicted,
+    and are then loaded again by get_raster.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = band_cache if cache is None else cache
+        self.owner = self.cache.new_owner()
+
+    def get(self, band, default=None, count=True):
+        value = self.cache.get((self.owner, band), count=count)
+        return default if value is None else value
+
+    def keys(self):
+        return self.cache.keys_of(self.owner)
+
+    def update(self, bands):
+        for band, value in bands.items():
+            self[band] = value
+
+    def clear(self):
+        self.cache.remove_owner(self.owner)
+
+    def pinned(self, bands):
+        return self.cache.pinned([(self.owner, band) for band in bands])
+
+    def __contains__(self, band):
+        return self.cache.contains((self.owner, band))
+
+    def __getitem__(self, band):
+        value = self.get(band)
+        if value is None:
+            raise KeyError(band)
+        return value
+
+    def __setitem__(self, band, value):
+        self.cache.put((self.owner, band), value)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
+####################################################################################
+class WNRasterWriter:
+    """
+    GeoTIFF writer for incremental (window by window) writes of one or more bands. By default it writes a tiled,
+    DEFLATE compressed file with the appropriate predictor, compressing with all the CPUs, and switches to BigTIFF
+    when needed. With cog=True, the overviews are built and the file is converted to a cloud optimized GeoTIFF
+    when closed.
+    """
+
+    float_types = [getattr(gdal, name) for name in ['GDT_Float32', 'GDT_Float64'] if hasattr(gdal, name)]
+
+    def __init__(self, filename, rows, cols, n_bands=1, geo_transform=None, projection=None, dtype=gdal.GDT_Float32,
+                 nodatavalue=0, compress='DEFLATE', predictor=None, level=None, tiled=True, block_size=512,
+                 threads='ALL_CPUS', bigtiff='IF_SAFER', cog=False, overviews=False, overview_resampling='NEAREST'):
+
+        self.filename, self.rows, self.cols, self.n_bands = str(filename), rows, cols, n_bands
+        self.cog, self.overviews, self.overview_resampling = cog, overviews or cog, overview_resampling
+        self.block_size = block_size
+
+        self.options = self.creation_options(dtype, compress, predictor, level, tiled, block_size, threads, bigtiff)
+
+        # the cog is created from a temporary tiled file
+        self.path_ = self.filename + '.tmp.tif' if cog else self.filename
+
+        driver = gdal.GetDriverByName('GTiff')
+        self.ds = driver.Create(self.path_, cols, rows, n_bands, dtype, options=self.options)
+
+        if geo_transform is not None:
+            self.ds.SetGeoTransform(geo_transform)
+        if projection is not None:
+            self.ds.SetProjection(projection)
+
+        for band in range(n_bands):
+            self.ds.GetRasterBand(band + 1).SetNoDataValue(nodatavalue)
+
+    def creation_options(self, dtype, compress, predictor, level, tiled, block_size, threads, bigtiff):
+        options = [f'COMPRESS={compress}', f'BIGTIFF={bigtiff}']
+
+        if threads is not None:
+            options.append(f'NUM_THREADS={threads}')
+
+        if tiled:
+            options += ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}']
+
+        if compress in ['DEFLATE', 'ZSTD', 'LZW', 'LZMA']:
+            # horizontal differencing for integers and floating point predictor for floats
+            predictor = (3 if dtype in self.float_types else 2) if predictor is None else predictor
+            options.append(f'PREDICTOR={predictor}')
+
+        if level is not None:
+            options.append(f'ZSTD_LEVEL={level}' if compress == 'ZSTD' else f'ZLEVEL={level}')
+
+        return options
+
+    def write(self, array, xoff=0, yoff=0, band=None):
+        # array is (rows, cols), written in `band` (first band by default), or (bands, rows, cols)
+        array = np.asarray(array)
+
+        # gdal arrays have no float16
+        if array.dtype == np.float16:
+            array = array.astype(np.float32)
+
+        if array.ndim == 2:
+            self.ds.GetRasterBand(1 if band is None else band).WriteArray(array, xoff, yoff)
+        else:
+            first = 1 if band is None else band
+            for i in range(array.shape[0]):
+                self.ds.GetRasterBand(first + i).WriteArray(array[i], xoff, yoff)
+
+    def overview_levels(self):
+        levels, level = [], 2
+        while min(self.rows, self.cols) / level >= self.block_size / 2:
+            levels.append(level)
+            level *= 2
+        return levels
+
+    def close(self):
+        if getattr(self, 'ds', None) is None:
+            return
+
+        cog_driver = gdal.GetDriverByName('COG') if self.cog else None
+
+        # the COG driver creates its own overviews
+        if self.overviews and cog_driver is None and len(self.overview_levels()) > 0:
+            self.ds.BuildOverviews(self.overview_resampling, self.overview_levels())
+
+        self.ds.FlushCache()
+        self.ds = None
+
+        if self.cog:
+            if cog_driver is not None:
+                options = [o for o in self.options if o.split('=')[0] in ['COMPRESS', 'NUM_THREADS', 'BIGTIFF']]
+                options += [f'BLOCKSIZE={self.block_size}', f'RESAMPLING={self.overview_resampling}']
+                if any(o.startswith('PREDICTOR') for o in self.options):
+                    options.append('PREDICTOR=YES')
+                cog_driver.CreateCopy(self.filename, gdal.Open(self.path_), options=options)
+            else:
+                gdal.GetDriverByName('GTiff').CreateCopy(self.filename, gdal.Open(self.path_),
+                                                         options=self.options + ['COPY_SRC_OVERVIEWS=YES'])
+            os.remove(self.path_)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+####################################################################################
+class WNDiskBandCache:
+    """
+    On disk cache of decoded (and resampled) bands, stored as .npy files that are read memory mapped.
+    The key is the source file identity (path, size and modification time), the target shape and the resampling
+    method, so changes in any of them create a new entry. The least recently used entries are removed when the
+    cache exceeds max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path, self.max_bytes = Path(path), max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def band_key(ds, shape, resampling):
+        # returns None if the source is not a regular file (ex. gdal virtual files)
+        try:
+            fn = Path(ds.GetFileList()[0]).resolve()
+            st = os.stat(fn)
+        except (OSError, TypeError, IndexError):
+            return None
+
+        s = f'{fn}|{st.st_size}|{st.st_mtime_ns}|{shape[0]}x{shape[1]}|{resampling}'
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def file(self, key):
+        return self.path / f'{key}.npy'
+
+    def get(self, key):
+        fn = self.file(key)
+        if not fn.exists():
+            return None
+
+        # touch the file to keep track of the last use
+        os.utime(fn)
+        return np.load(fn, mmap_mode='r')
+
+    def create(self, key, shape, reader, rows):
+        # reader(first_row, n_rows) returns the decoded rows. The file is written under a temporary name
+        # and renamed at the end, so concurrent processes never see a partial file. If the reader fails (or returns
+        # None), the temporary file is removed
+        tmp = self.path / f'{key}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+        out = None
+
+        try:
+            for first_row in range(0, shape[0], rows):
+                arr = reader(first_row, min(rows, shape[0] - first_row))
+                if arr is None:
+                    return None
+
+                if out is None:
+                    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=arr.dtype, shape=tuple(shape))
+
+                out[first_row:first_row + arr.shape[0]] = arr
+
+            out.flush()
+            del out
+            os.replace(tmp, self.file(key))
+        finally:
+            out = None
+            if tmp.exists():
+                os.remove(tmp)
+
+        self.evict(keep=key)
+        return self.get(key)
+
+    def band(self, ds, shape, resampling, reader, rows):
+        key = self.band_key(ds, shape, resampling)
+        if key is None:
+            return None
+
+        arr = self.get(key)
+        if arr is not None:
+            self.hits += 1
+            return arr
+
+        self.misses += 1
+        return self.create(key, shape, reader, rows)
+
+    def entries(self):
+        # (last use, size, file) of the cached bands
+        entries = []
+        for fn in self.path.glob('*.npy'):
+            if fn.name.endswith('.tmp.npy'):
+                continue
+            try:
+                st = fn.stat()
+                entries.append((st.st_mtime, st.st_size, fn))
+            except OSError:
+                pass
+        return entries
+
+    @property
+    def nbytes(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+
+        entries = sorted(self.entries())
+        total = sum(entry[1] for entry in entries)
+
+        for _, size, fn in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and fn.stem == keep:
+                continue
+
+            try:
+                fn.unlink()
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, fn in self.entries():
+            fn.unlink()
+
+    @property
+    def stats(self):
+        entries = self.entries()
+        return {'bands': len(entries), 'nbytes': sum(e[1] for e in entries), 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+    def __repr__(self):
+        stats = self.stats
+        return f'WNDiskBandCache at {self.path} with {stats["bands"]} bands ({stats["nbytes"]/1024/1024:.1f} Mb)'
+
+
+####################################################################################
+class WNProductIndex:
+    """
+    List of the files of a product directory, obtained with a single walk over the tree and kept in memory for the
+    next products opened in the same process. With persist=True, the list is also saved in the product directory
+    (index_name) with the modification times of its directories, and reused while none of them changed.
+    When a name is not found, the directory is listed again if any of its directories changed since the list.
+    """
+
+    index_name = '.wn_index.json'
+
+    # file lists already read and the times of their directories, by product path
+    files_ = {}
+
+    def __init__(self, path, persist=False):
+        self.path, self.persist = Path(path), persist
+
+    @property
+    def index_path(self):
+        return self.path / self.index_name
+
+    def walk(self):
+        # returns the files and the directories (relative to the product path)
+        files, dirs = [], []
+        for root, sub_dirs, names in os.walk(self.path):
+            sub_dirs.sort()
+            rel_root = Path(root).relative_to(self.path)
+            dirs.append(rel_root.as_posix())
+            files += [(rel_root / name).as_posix() for name in sorted(names) if name != self.index_name]
+        return files, dirs
+
+    def dir_times(self, dirs):
+        # modification time of each directory (it changes when a file is added, removed or renamed in it)
+        return {folder: os.stat(self.path / folder).st_mtime_ns for folder in dirs}
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            files, times = index['files'], index['dirs']
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # the index is discarded if any of the directories changed (or is gone)
+        return (files, times) if not self.changed(times) else None
+
+    def write_index(self, files, dirs):
+        # returns the times of the directories, taken after creating the index file (that changes the product dir)
+        try:
+            self.index_path.touch()
+            times = self.dir_times(dirs)
+            with open(self.index_path, 'w') as f:
+                json.dump({'files': files, 'dirs': times}, f)
+            return times
+        except OSError as e:
+            print(f'Could not save the index of {self.path}: {e}')
+            return self.dir_times(dirs)
+
+    def changed(self, times):
+        try:
+            return self.dir_times(times) != times
+        except OSError:
+            return True
+
+    @property
+    def key(self):
+        return str(self.path.resolve())
+
+    @property
+    def files(self):
+        if self.key not in self.files_:
+            listed = self.read_index() if self.persist else None
+            if listed is None:
+                return self.refresh()
+
+            self.files_[self.key] = listed
+
+        return self.files_[self.key][0]
+
+    def refresh(self):
+        # lists the directory again, replacing the lists kept in memory and on disk
+        files, dirs = self.walk()
+        times = self.write_index(files, dirs) if self.persist else self.dir_times(dirs)
+
+        self.files_[self.key] = files, times
+        return files
+
+    def find(self, names, files):
+        # names is a dict {key: part of the file name}. Returns {key: Path} with the first file that matches
+        # each name, checking all of them in one pass
+        result = {}
+        pending = dict(names)
 
-        lst_img.append(pred_img)
-        lst_mask.append(mask.squeeze().numpy())
-        lst_probs.append(probs.numpy())
+        for file in files:
+            file_name = file.rsplit('/', 1)[-1]
+            for key, name in list(pending.items()):
+                if name in file_name:
+                    result[key] = self.path / file
+                    pending.pop(key)
 
-    return lst_img, lst_mask, lst_probs
+            if len(pending) == 0:
+                break
 
+        return result
+
+    def match(self, names):
+        # as find, over the list of files. The names not found are searched again in a new list of the directory,
+        # if it changed since the list was taken
+        result = self.find(names, self.files)
 
-def predict_image(img, learn, bands, size, shift, bands_math={}):
-    pproc = create_custom_patches(img, bands, size, shift, bands_math)
+        pending = {key: name for key, name in names.items() if key not in result}
+        if len(pending) > 0 and self.changed(self.files_[self.key][1]):
+            result.update(self.find(pending, self.refresh()))
+
+        return result
 
-    _, masks, _ = predict_patches(pproc, learn)
-    out_proc = WNPatchProcessor(from_patches=masks)
-    out_proc.set_format(0, 366, 366, True, img.geo_transform, img.projection)
+    @classmethod
+    def clear_cache(cls):
+        cls.files_.clear()
 
-    return out_proc
 
 ####################################################################################
 class WNImage:
@@ -239,33 +1357,146 @@ class WNImage:
     resampling = gdal.GRA_NearestNeighbour
     # resampling = gdal.GRA_Average
 
+    # number of rows of each chunk when evaluating the band math
+    chunk_rows = 512
+
+    # number of threads used to decode the bands concurrently (see load_bands)
+    load_workers = 4
+
+    # value of the nodata pixels, besides the NaNs (None for only NaNs)
+    nodata = None
+
+    # size (pixels) of the blocks of the validity mask (see validity_blocks)
+    validity_block = 16
+
     def __init__(self, path=None, shape=None):
 
         self.path_, self.shape_ = path, shape
 
         self.dataset = gdal.Open(str(path)) if path is not None else None
-        self.loaded_bands_ = {}
+        self.loaded_bands_ = WNLoadedBands()
         self.calc_bands_ = {}
 
+        # lazy expressions of the calculated bands (None if the formula can't be expressed lazily)
+        # and the reductions (ex. min of a band) already calculated over the whole image
+        self.calc_exprs_, self.scalars_ = {}, {}
+
+        # block reduced validity masks, by bands and block size (see validity_blocks)
+        self.validity_ = {}
+
     # @staticmethod
     def normalized_difference(self, b1, b2, name=None):
         if name is None:
-            min_cte = np.min([self[b1], self[b2]])
-            if min_cte <= 0:
-                min_cte = -min_cte + 0.0001
-            else:
-                min_cte = 0
-
-            return ((self[b1]+min_cte) - (self[b2]+min_cte)) / ((self[b1]+min_cte) + (self[b2]+min_cte))
+            expr = WNExprBuilder(self).normalized_difference(b1, b2)
+            return self.eval_exprs({'nd': expr})['nd']
         else:
-            return self.band_math(name, lambda x: self.normalized_difference(b1, b2, None))
+            return self.band_math(name, lambda x: x.normalized_difference(b1, b2, None))
 
     @staticmethod
     def create_nan_mask(img):
-        nan_mask = np.zeros(img.shape).astype('bool')
-        for band in img.available_bands:
-            nan_mask |= np.isnan(img[band])
-        return nan_mask.astype('float32')
+        # NaN in any band, evaluated chunk by chunk
+        nan_mask = np.empty(img.shape, dtype=dtype_policy.storage)
+        for first_row, chunk in img.chunks():
+            nan_mask[first_row:first_row + chunk.shape[0]] = img.invalid_pixels(img.available_bands, first_row, chunk,
+                                                                                nodata=None)
+        return nan_mask
+
+    def chunk_raster(self, band, first_row, chunk):
+        # the rows of the chunk, from the band loaded for the whole image, if it is, or read for the chunk
+        arr = self.loaded_bands_.get(band)
+        if (arr is not None) and (arr.shape == self.shape):
+            return arr[first_row:first_row + chunk.shape[0]]
+        return chunk.get_raster(band)
+
+    def invalid_pixels(self, bands, first_row, chunk, nodata=None):
+        # True where any of the bands is NaN (or nodata), reduced over the stacked bands of the chunk at once
+        cube = np.stack([self.chunk_raster(band, first_row, chunk) for band in bands])
+
+        invalid = np.isnan(cube).any(axis=0) if cube.dtype.kind == 'f' else np.zeros(cube.shape[1:], dtype=bool)
+        if nodata is not None:
+            invalid |= (cube == nodata).any(axis=0)
+
+        return invalid
+
+    def source_bands(self, bands):
+        # bands read from the datasets to calculate the given bands (the calculated bands that can't be expressed
+        # lazily are used as they are)
+        result = []
+        for band in bands:
+            expr = self.band_expr(band) if band in self.calc_bands else None
+            for source in (sorted(expr.bands(), key=str) if expr is not None else [band]):
+                if source not in result:
+                    result.append(source)
+        return result
+
+    def validity_blocks(self, bands=None, block=None):
+        # Block reduced validity mask, (ceil(rows / block), ceil(cols / block)), True where the block has at least
+        # one valid pixel in all the bands (not NaN nor nodata). It is calculated once, chunk by chunk.
+        # bands defaults to all the available bands
+        bands = self.available_bands if bands is None else bands
+        block = self.validity_block if block is None else block
+        key = (tuple(bands), block)
+        if key in self.validity_:
+            return self.validity_[key]
+
+        rows, cols = self.shape
+        blocks_rows, blocks_cols = math.ceil(rows / block), math.ceil(cols / block)
+        result = np.zeros((blocks_rows, blocks_cols), dtype=bool)
+
+        # chunks with a height multiple of the block, so each block is in one chunk
+        block_h = self.block_shape[0]
+        step = block * block_h // math.gcd(block, block_h)
+        chunk_rows = max(1, math.ceil(self.chunk_rows / step)) * step
+
+        padded = None
+        for first_row, chunk in self.chunks(chunk_rows):
+            valid = ~self.invalid_pixels(bands, first_row, chunk, self.nodata)
+            n = math.ceil(valid.shape[0] / block)
+
+            if padded is None or padded.shape[0] != n * block:
+                padded = np.zeros((n * block, blocks_cols * block), dtype=bool)
+            padded[:valid.shape[0], :cols] = valid
+            padded[valid.shape[0]:] = False
+
+            first_block = first_row // block
+            result[first_block:first_block + n] = padded.reshape(n, block, blocks_cols, block).any(axis=(1, 3))
+
+        self.validity_[key] = result
+        return result
+
+    def valid_patches(self, size, shift, bands=None, block=None):
+        # (rows, cols) of the patches grid, True for the patches that are not fully invalid (conservative: a patch is
+        # only invalid if all the blocks it touches are fully invalid). bands defaults to all the available bands
+        block = self.validity_block if block is None else block
+        return self.blocks_patches(self.validity_blocks(bands, block), size, shift, self.patches_grid(size, shift),
+                                   block)
+
+    def valid_patches_rows(self, size, shift, first_row, last_row, bands=None, block=None):
+        # as valid_patches, for the rows of patches [first_row, last_row), reading only their region (aligned to the
+        # blocks, so the result is the same as the one from the whole image)
+        block = self.validity_block if block is None else block
+        last_row = min(last_row, self.patches_grid(size, shift)[0])
+
+        top = first_row * shift
+        region_top = top // block * block
+        region = self.window(0, region_top, self.shape[1], (last_row - first_row - 1) * shift + size + top - region_top)
+
+        return self.blocks_patches(region.validity_blocks(bands, block), size, shift,
+                                   (last_row - first_row, self.patches_grid(size, shift)[1]), block, top - region_top)
+
+    @staticmethod
+    def blocks_patches(blocks, size, shift, grid, block, top=0):
+        # reduces the blocks validity to the patches grid (rows, cols), through the summed area table of the valid
+        # blocks. top is the first row of the patches (pixels) from the blocks origin
+        table = np.zeros((blocks.shape[0] + 1, blocks.shape[1] + 1), dtype=np.int64)
+        table[1:, 1:] = blocks.cumsum(axis=0).cumsum(axis=1)
+
+        rows, cols = top + np.arange(grid[0]) * shift, np.arange(grid[1]) * shift
+        r0, c0 = rows // block, cols // block
+        r1, c1 = (rows + size - 1) // block + 1, (cols + size - 1) // block + 1
+
+        count = table[np.ix_(r1, c1)] - table[np.ix_(r0, c1)] - table[np.ix_(r1, c0)] + table[np.ix_(r0, c0)]
+        return count > 0
 
     @property
     def calc_bands(self):
@@ -327,18 +1558,16 @@ class WNImage:
             return None
 
         # then, check if band is already loaded and with the right shape
-        if (band in self.loaded_bands_.keys()) and (self.loaded_bands_[band].shape == self.shape):
-            return self.loaded_bands_[band]
+        arr = self.loaded_bands_.get(band)
+        if (arr is not None) and (arr.shape == self.shape):
+            return arr
 
         # if the band is a derived band, call the band_math with the formula
         if band in self.calc_bands:
             arr = self.band_math(band, self.calc_bands_[band])
         else:
-            # otherwise, try to open the dataset
-            ras = self.get_gdal_band(band)
-            arr = ras.ReadAsArray(buf_xsize=self.shape[1],
-                                  buf_ysize=self.shape[0],
-                                  resample_alg=self.resampling)*factor
+            # otherwise, read the whole raster as a single window
+            arr = self.read_window(band, 0, 0, self.shape[1], self.shape[0], factor=factor)
             # astype('float32')
 
             # if not successful, it will raise an error
@@ -349,21 +1578,295 @@ class WNImage:
 
         return arr
 
-    def set_band_math(self, name, fn):
-        self.calc_bands_.update({name: fn})
+    @staticmethod
+    def raster_size(ras):
+        # gdal bands and datasets name their sizes differently. Returns (rows, cols)
+        if isinstance(ras, gdal.Band):
+            return ras.YSize, ras.XSize
+        else:
+            return ras.RasterYSize, ras.RasterXSize
 
-    def band_math(self, name, fn):
-        # calc the resulting raster with given formula
-        calc_band = fn(self)
+    def read_window(self, band, xoff, yoff, width, height, factor=1):
+        # xoff, yoff, width and height are given in the target shape (self.shape) coordinates.
+        # They are mapped to the native grid of the band, that can have a different resolution
+        ras = self.get_gdal_band(band)
+        if ras is None:
+            return None
 
-        # update the result in the loaded bands dict
-        self.loaded_bands_.update({name: calc_band})
+        rows, cols = self.raster_size(ras)
+        scale_y, scale_x = rows / self.shape[0], cols / self.shape[1]
+
+        if self.resampling != gdal.GRA_NearestNeighbour:
+            arr = ras.ReadAsArray(int(round(xoff * scale_x)),
+                                  int(round(yoff * scale_y)),
+                                  max(1, int(round(width * scale_x))),
+                                  max(1, int(round(height * scale_y))),
+                                  buf_xsize=width,
+                                  buf_ysize=height,
+                                  resample_alg=self.resampling)
+
+            return dtype_policy.scale(arr, factor)
+
+        # Nearest neighbour: the target pixel i takes the native pixel floor((off + i + 0.5) * scale), the same
+        # mapping GDAL uses to resample the whole raster, so the windows match the whole scene pixel by pixel.
+        # The enclosing native window is read and the target pixels are picked from it
+        row_idx = self.nearest_index(yoff, height, scale_y, rows)
+        col_idx = self.nearest_index(xoff, width, scale_x, cols)
+
+        y0, x0 = int(row_idx[0]), int(col_idx[0])
+        arr = ras.ReadAsArray(x0, y0, int(col_idx[-1]) + 1 - x0, int(row_idx[-1]) + 1 - y0)
+
+        if arr.shape != (height, width):
+            arr = arr[np.ix_(row_idx - y0, col_idx - x0)]
+
+        return dtype_policy.scale(arr, factor)
+
+    @staticmethod
+    def nearest_index(offset, length, scale, size):
+        # native pixels of the target pixels [offset, offset + length) for the nearest neighbour resampling
+        idx = np.floor((offset + np.arange(length) + 0.5) * scale).astype(np.int64)
+        return np.clip(idx, 0, size - 1)
 
+    @property
+    def block_shape(self):
+        # native block size of the first band, expressed in the target shape coordinates (rows, cols)
+        ds = self.data_source
+        if ds is None:
+            return self.shape
+
+        cols, rows = ds.GetRasterBand(1).GetBlockSize()
+        native_rows, native_cols = self.raster_size(ds)
+
+        return (max(1, int(round(rows * self.shape[0] / native_rows))),
+                max(1, int(round(cols * self.shape[1] / native_cols))))
+
+    def window(self, xoff, yoff, width, height):
+        return WNImageWindow(self, xoff, yoff, width, height)
+
+    def iter_windows(self, height=None, width=None):
+        # height and width are rounded up to the native block size, so each block is decoded just once.
+        # By default, each window is one row of blocks with the full width of the image
+        block_h, block_w = self.block_shape
+        height = block_h if height is None else math.ceil(height / block_h) * block_h
+        width = self.shape[1] if width is None else math.ceil(width / block_w) * block_w
+
+        for yoff in range(0, self.shape[0], height):
+            for xoff in range(0, self.shape[1], width):
+                yield self.window(xoff, yoff, min(width, self.shape[1] - xoff), min(height, self.shape[0] - yoff))
+
+    def patches_grid(self, size, shift):
+        # number of rows and columns of patches
+        return math.floor(1 + (self.shape[0] - size) / shift), math.floor(1 + (self.shape[1] - size) / shift)
+
+    def default_window_rows(self, shift):
+        # enough rows of patches to cover one row of blocks
+        return max(1, self.block_shape[0] // shift)
+
+    def iter_patch_windows(self, size, shift, rows=None, first_row=0, last_row=None):
+        # Full width windows that follow the patches grid. Each window holds `rows` rows of patches, so
+        # the patches created window by window are the same (and in the same order) as the ones from the whole image.
+        # first_row and last_row (exclusive) restrict the windows to a range of rows of patches
+        num_patches_ver = self.patches_grid(size, shift)[0]
+        last_row = num_patches_ver if last_row is None else min(last_row, num_patches_ver)
+        rows = self.default_window_rows(shift) if rows is None else rows
+
+        for row in range(first_row, last_row, rows):
+            n = min(rows, last_row - row)
+            yield self.window(0, row * shift, self.shape[1], (n - 1) * shift + size)
+
+    def set_band_math(self, name, fn):
+        # a new formula invalidates the expressions that may have inlined the old one
+        if self.calc_bands_.get(name) is not fn:
+            self.calc_exprs_.clear()
+
+        self.calc_bands_.update({name: fn})
+
+    def band_math(self, name, fn):
         # update the formula
         self.set_band_math(name, fn)
 
+        # calc the resulting raster with given formula. If the formula can be expressed lazily,
+        # it is evaluated chunk by chunk, otherwise it is called with the image
+        expr = self.band_expr(name)
+        calc_band = self.eval_exprs({name: expr})[name] if expr is not None else dtype_policy.to_storage(fn(self))
+
+        # update the result in the loaded bands dict
+        self.loaded_bands_.update({name: calc_band})
+
         return calc_band
 
+    def band_expr(self, name):
+        # Builds the lazy expression of a calculated band, by calling its formula with a WNExprBuilder.
+        # Formulas that need the actual arrays (ex. np.where, boolean indexing) return None
+        if name not in self.calc_exprs_:
+            # mark as in progress to avoid recursion on formulas that refer to themselves
+            self.calc_exprs_[name] = None
+
+            try:
+                expr = self.calc_bands_[name](WNExprBuilder(self))
+            except Exception:
+                expr = None
+
+            self.calc_exprs_[name] = expr if isinstance(expr, WNExpr) else None
+
+        return self.calc_exprs_[name]
+
+    def is_loaded(self, band):
+        arr = self.loaded_bands_.get(band, count=False)
+        return (arr is not None) and (arr.shape == self.shape)
+
+    def prepare_reductions(self, bands):
+        # calculates the reductions of the lazy calculated bands (over the reduction image), before they are needed
+        reductions = {}
+        for band in bands:
+            expr = self.band_expr(band) if band in self.calc_bands else None
+            if expr is not None:
+                reductions.update(expr.reductions())
+
+        if len(reductions) > 0:
+            self.reduction_image.eval_reductions(reductions)
+
+    def fits_cache(self, bands):
+        # if the bands, loaded for the whole image, fit in the free budget of the band cache
+        cache = self.loaded_bands_.cache
+        if cache.max_bytes is None:
+            return True
+
+        nbytes = len(bands) * self.shape[0] * self.shape[1] * dtype_policy.storage.itemsize
+        return cache.nbytes + nbytes <= cache.max_bytes
+
+    @property
+    def concurrent_reads(self):
+        # all the bands of a WNImage share one gdal dataset, that can't be read by several threads at once
+        return False
+
+    def load_bands(self, bands, workers=None):
+        # Decodes the bands not loaded yet concurrently, in a thread pool (gdal releases the GIL while reading),
+        # and keeps them in the band cache. Calculated bands are skipped
+        workers = self.load_workers if workers is None else workers
+        bands = [bands] if type(bands) is not list else bands
+
+        raw = [band for band in dict.fromkeys(bands)
+               if band in self.available_bands and band not in self.calc_bands and not self.is_loaded(band)]
+
+        if len(raw) > 1 and workers > 1 and self.concurrent_reads:
+            with ThreadPoolExecutor(max_workers=min(workers, len(raw))) as pool:
+                list(pool.map(self.get_raster, raw))
+        else:
+            for band in raw:
+                self.get_raster(band)
+
+    def pinned(self, bands):
+        # context manager that keeps the bands from being evicted from the band cache while in use
+        bands = [bands] if type(bands) is not list else bands
+        return self.loaded_bands_.pinned(bands)
+
+    def eval_bands(self, bands):
+        # calculates, in a single fused pass, the lazy calculated bands that are not loaded yet
+        lazy = {band: self.band_expr(band) for band in bands
+                if band in self.calc_bands and not self.is_loaded(band)}
+        lazy = {band: expr for band, expr in lazy.items() if expr is not None}
+
+        if len(lazy) > 0:
+            self.loaded_bands_.update(self.eval_exprs(lazy))
+
+    def chunks(self, rows=None):
+        # full width chunks, with height multiple of the block height. Yields (first row, window)
+        block_h = self.block_shape[0]
+        rows = self.chunk_rows if rows is None else rows
+        rows = max(1, math.ceil(rows / block_h)) * block_h
+
+        for first_row in range(0, self.shape[0], rows):
+            yield first_row, self.window(0, first_row, self.shape[1], min(rows, self.shape[0] - first_row))
+
+    def eval_node(self, node, first_row, chunk, memo):
+        # evaluates the node over one chunk. memo holds the results of the common subexpressions
+        if node.key in memo:
+            return memo[node.key]
+
+        if node.op == 'band':
+            arr = self.loaded_bands_.get(node.value)
+            if (arr is not None) and (arr.shape == self.shape):
+                value = arr[first_row:first_row + chunk.shape[0]]
+            else:
+                value = chunk.get_raster(node.value)
+
+            # the math is done in the compute dtype, whatever the storage dtype
+            value = dtype_policy.to_compute(value)
+        elif node.op == 'const':
+            value = node.value
+        else:
+            value = node.fn(*[self.eval_node(child, first_row, chunk, memo) for child in node.children])
+
+        memo[node.key] = value
+        return value
+
+    @property
+    def reduction_image(self):
+        # image over which the reductions are calculated
+        return self
+
+    def eval_reductions(self, reductions, rows=None):
+        # Calculates the reductions ({key: WNExpr}) over the whole image, in as many passes as the nesting levels.
+        # The results are kept, so the windows of the image get the same values as the whole image
+        scalars = {key: self.scalars_[(key, self.shape)] for key in reductions if (key, self.shape) in self.scalars_}
+        pending = {key: node for key, node in reductions.items() if key not in scalars}
+
+        # The bands of the reductions are read again for the values, so they are loaded once for the whole image
+        # (and the values and windows take them from it) if they fit in the band cache
+        leaves = set().union(*[node.bands() for node in pending.values()])
+        leaves = [band for band in leaves if band not in self.calc_bands and not self.is_loaded(band)]
+        if len(leaves) > 0 and self.fits_cache(leaves):
+            self.load_bands(leaves)
+
+        while len(pending) > 0:
+            # reductions that depend only on reductions already calculated
+            ready = {key: node for key, node in pending.items()
+                     if all(k in scalars for k in node.children[0].reductions())}
+
+            partials = {}
+            for first_row, chunk in self.chunks(rows):
+                memo = dict(scalars)
+                for key, node in ready.items():
+                    value = node.fn(self.eval_node(node.children[0], first_row, chunk, memo))
+                    partials[key] = value if key not in partials else node.combine(partials[key], value)
+
+            scalars.update(partials)
+            pending = {key: node for key, node in pending.items() if key not in scalars}
+
+        self.scalars_.update({(key, self.shape): value for key, value in scalars.items()})
+        return scalars
+
+    def eval_exprs(self, exprs, rows=None):
+        # Evaluates several expressions ({name: WNExpr}) together, chunk by chunk. The bands and the common
+        # subexpressions are read/calculated once per chunk. Reductions (ex. min) are calculated before.
+        reductions = {}
+        for expr in exprs.values():
+            reductions.update(expr.reductions())
+
+        scalars = self.reduction_image.eval_reductions(reductions, rows) if len(reductions) > 0 else {}
+
+        # bands read for each chunk (the ones not already loaded for the whole image)
+        leaves = set()
+        for expr in exprs.values():
+            leaves |= expr.bands()
+        leaves = [band for band in leaves if not self.is_loaded(band)]
+
+        results = {}
+        for first_row, chunk in self.chunks(rows):
+            chunk.load_bands(leaves)
+
+            memo = dict(scalars)
+            for name, expr in exprs.items():
+                value = self.eval_node(expr, first_row, chunk, memo)
+
+                if name not in results:
+                    results[name] = np.empty(self.shape, dtype=dtype_policy.storage_dtype(np.result_type(value)))
+
+                results[name][first_row:first_row + chunk.shape[0]] = value
+
+        return results
+
     def get_gdal_band(self, i):
         if i in self.available_bands:
             return self.dataset.GetRasterBand(i+1)
@@ -376,15 +1879,20 @@ class WNImage:
         bands = self.available_bands if bands is None else bands
         bands = [bands] if type(bands) is not list else bands
 
-        result = {band: self.get_raster(band) for band in bands if self.get_raster(band) is not None}
+        self.eval_bands(bands)
+        result = {band: self.get_raster(band) for band in bands}
 
-        return result
+        return {band: arr for band, arr in result.items() if arr is not None}
 
     def as_list(self, bands=None):
         bands = self.available_bands if bands is None else bands
 
         bands = [bands] if type(bands) is not list else bands
-        return [self.get_raster(band) for band in bands if self.get_raster(band) is not None]
+
+        # the bands are decoded concurrently and the lazy calculated bands are evaluated together, in a single pass
+        self.load_bands(bands)
+        self.eval_bands(bands)
+        return [arr for arr in (self.get_raster(band) for band in bands) if arr is not None]
 
     def as_cube(self, bands=None, channels_first=False, squeeze=False):
         lst_bands = self.as_list(bands)
@@ -402,9 +1910,8 @@ class WNImage:
         return cube if not squeeze else cube.squeeze()
 
     def clear(self):
-        for band in self.loaded_bands_.keys():
-            self.loaded_bands_[band] = None
-        self.loaded_bands_ = {}
+        # removes the bands of this image from the band cache
+        self.loaded_bands_.clear()
 
     def show(self, bands, bright=1., ax=None):
         if ax is None:
@@ -412,9 +1919,22 @@ class WNImage:
         else:
             ax.imshow(self.as_cube(bands, squeeze=True)*bright)
 
-    def save_bands(self, bands, name, no_value=0, dtype=gdal.GDT_Float32):
+    @property
+    def scaled_geo_transform(self):
+        # geo transform considering the target shape, that can differ from the native resolution
+        return self.window(0, 0, self.shape[1], self.shape[0]).geo_transform
+
+    def save_bands(self, bands, name, no_value=0, dtype=gdal.GDT_Float32, **options):
+        # the bands are written chunk by chunk. The options are passed to WNRasterWriter
+        bands = [bands] if type(bands) is not list else bands
         fn = self.path.with_name(name).with_suffix('.tif')
-        array2raster(str(fn), self.as_cube(bands), self.geo_transform, self.projection, nodatavalue=no_value, dtype=dtype)
+
+        print('Saving image: ' + str(fn))
+
+        with WNRasterWriter(str(fn), self.shape[0], self.shape[1], len(bands), self.scaled_geo_transform,
+                            self.projection, dtype=dtype, nodatavalue=no_value, **options) as writer:
+            for first_row, chunk in self.chunks():
+                writer.write(chunk.as_cube(bands, channels_first=True), 0, first_row)
 
     def __del__(self):
         # print(f'Cleaning memory from WNImage')
@@ -457,19 +1977,47 @@ class WNSatImage(WNImage):
                  }
 
 
-    def __init__(self, path, img_dic=None, verbose=True, shape=None):
+    # nodata of each product type, after the factor: THEIA -10000, L1C and L2A 0
+    nodataS2_L1C = 0.
+    nodataS2_THEIA = -1.
+    nodataS2_L2A = 0.
+
+    # WNDiskBandCache used by default by all the WNSatImages (None to disable)
+    disk_cache = None
+
+    def __init__(self, path, img_dic=None, verbose=True, shape=None, disk_cache=None, persist_index=False,
+                 nodata=None):
+        # persist_index saves the list of files of the product next to it (see WNProductIndex)
+        # nodata defaults to the one of the product type of img_dic (see product_nodata)
         super().__init__(None, shape)
 
         if img_dic is None:
             img_dic = self.dicS2_THEIA
 
         self.path, self.img_dic, self.verbose = path, img_dic, verbose
+        self.persist_index = persist_index
+        self.nodata = self.product_nodata(img_dic) if nodata is None else nodata
+
+        # the decoded bands can be kept on disk, to skip the JPEG2000 decoding in the next runs
+        if disk_cache is not None:
+            self.disk_cache = disk_cache if isinstance(disk_cache, WNDiskBandCache) else WNDiskBandCache(disk_cache)
 
         self.datasets = self.open_img() if path is not None else {}
 
         # initialize with known indices
-        self.set_band_math('ndwi', lambda x: self.normalized_difference('B3', 'B8'))
-        self.set_band_math('mndwi', lambda x: self.normalized_difference('B3', 'B11'))
+        self.set_band_math('ndwi', lambda x: x.normalized_difference('B3', 'B8'))
+        self.set_band_math('mndwi', lambda x: x.normalized_difference('B3', 'B11'))
+
+    @classmethod
+    def product_nodata(cls, img_dic):
+        # the nodata of the product type of the bands dictionary. Other dictionaries are THEIA products if their
+        # files are GeoTIFFs, and L1C/L2A products (JPEG2000) otherwise
+        for product in ['L1C', 'THEIA', 'L2A']:
+            if img_dic == getattr(cls, f'dicS2_{product}'):
+                return getattr(cls, f'nodataS2_{product}')
+
+        jp2 = any(str(name).lower().endswith('.jp2') for name in img_dic.values())
+        return cls.nodataS2_L2A if jp2 else cls.nodataS2_THEIA
 
     @property
     def data_source(self):
@@ -500,58 +2048,888 @@ class WNSatImage(WNImage):
     def shape(self, value):
         self.shape_ = value
 
-    @property
-    def available_bands(self):
-        return list(self.datasets.keys()) + self.calc_bands
+    @property
+    def available_bands(self):
+        return list(self.datasets.keys()) + self.calc_bands
+
+    @property
+    def concurrent_reads(self):
+        # each band has its own dataset
+        return True
+
+    def reset_shape(self):
+        self.shape_ = None
+
+    def open_gdal_ds(self, name, recursive=True):
+        file = search_file([self.path], name, recursive)
+
+        if file is None:
+            print(f'File {name} not found in {self.path} and subdirectories')
+            return None
+        else:
+            ds = gdal.Open(str(file))
+            if ds is None:
+                print(f'Could not open file {file}')
+
+            return ds
+
+    def open_img(self):
+        # the product tree is walked just once, and all the bands are matched in the same pass
+        files = WNProductIndex(self.path, persist=self.persist_index).match(self.img_dic)
+
+        result = {}
+        for band_key, name in self.img_dic.items():
+            file = files.get(band_key)
+
+            if file is None:
+                print(f'File {name} not found in {self.path} and subdirectories')
+                ds = None
+            else:
+                ds = gdal.Open(str(file))
+                if ds is None:
+                    print(f'Could not open file {file}')
+
+            result.update({band_key: ds})
+        return result
+
+    def get_gdal_band(self, key):
+        if key in self.available_bands:
+            return self.datasets[key]
+        else:
+            print(f'Band {key} not available')
+            return None
+
+    def get_raster(self, band, factor=None):
+        factor = 1/10000 if factor is None else factor
+        return super().get_raster(band, factor=factor)
+        # return arr/10000 if arr is not None else None
+
+    def read_window(self, band, xoff, yoff, width, height, factor=None):
+        factor = 1/10000 if factor is None else factor
+
+        if self.disk_cache is not None and band in self.datasets:
+            decoded = self.decoded_band(band)
+            if decoded is not None:
+                return dtype_policy.scale(decoded[yoff:yoff + height, xoff:xoff + width], factor)
+
+        return super().read_window(band, xoff, yoff, width, height, factor=factor)
+
+    def decoded_band(self, band):
+        # decoded band (before the factor) in the target shape, memory mapped from the disk cache.
+        # If it is not in the cache, it is decoded chunk by chunk directly into the cache file
+        def reader(first_row, rows):
+            return WNImage.read_window(self, band, 0, first_row, self.shape[1], rows, factor=1)
+
+        rows = max(1, math.ceil(self.chunk_rows / self.block_shape[0])) * self.block_shape[0]
+        return self.disk_cache.band(self.datasets[band], self.shape, self.resampling, reader, rows)
+
+    def __repr__(self):
+        s = f'WNSatImage with {self.available_bands} available bands \n'
+        s += f'Source: {self.path} \n'
+        s += f'Bands {list(self.loaded_bands_.keys())} loaded in memory'
+        return s
+
+
+####################################################################################
+class WNImageWindow(WNImage):
+    """
+    A rectangular window over a WNImage (or WNSatImage). It behaves like an image with shape (height, width), reading
+    only its region from the parent datasets. The band math formulas are shared with the parent, so the derived bands
+    are calculated just for the window.
+    """
+
+    def __init__(self, parent, xoff, yoff, width, height):
+        super().__init__(None, (height, width))
+
+        self.parent = parent
+        self.xoff, self.yoff = xoff, yoff
+
+        # share the formulas with the parent image
+        self.calc_bands_ = parent.calc_bands_
+        self.calc_exprs_ = parent.calc_exprs_
+        self.scalars_ = parent.scalars_
+
+    @property
+    def available_bands(self):
+        return self.parent.available_bands
+
+    @property
+    def data_source(self):
+        return self.parent.data_source
+
+    @property
+    def geo_transform(self):
+        # move the origin to the window corner, considering the parent target resolution
+        gt = self.parent.geo_transform
+        rows, cols = self.raster_size(self.data_source)
+        res_x = gt[1] * cols / self.parent.shape[1]
+        res_y = gt[5] * rows / self.parent.shape[0]
+        return gt[0] + self.xoff * res_x, res_x, gt[2], gt[3] + self.yoff * res_y, gt[4], res_y
+
+    @property
+    def path(self):
+        return self.parent.path
+
+    @property
+    def shape(self):
+        return self.shape_
+
+    @shape.setter
+    def shape(self, value):
+        self.shape_ = value
+
+    @property
+    def block_shape(self):
+        return self.parent.block_shape
+
+    @property
+    def reduction_image(self):
+        # reductions (ex. the min in the normalized difference) consider the whole parent image
+        return self.parent.reduction_image
+
+    @property
+    def nodata(self):
+        return self.parent.nodata
+
+    def valid_patches(self, size, shift, bands=None, block=None):
+        # windows aligned to the patches grid take their part of the parent mask, if it was calculated for the scene.
+        # Otherwise, the mask is calculated for the window, from its bands
+        block = self.validity_block if block is None else block
+        bands = self.available_bands if bands is None else bands
+        if self.xoff % shift != 0 or self.yoff % shift != 0 or (tuple(bands), block) not in self.parent.validity_:
+            return super().valid_patches(size, shift, bands, block)
+
+        n_rows, n_cols = self.patches_grid(size, shift)
+        first_row, first_col = self.yoff // shift, self.xoff // shift
+        return self.parent.valid_patches(size, shift, bands, block)[first_row:first_row + n_rows,
+                                                                    first_col:first_col + n_cols]
+
+    @property
+    def concurrent_reads(self):
+        return self.parent.concurrent_reads
+
+    def get_gdal_band(self, band):
+        return self.parent.get_gdal_band(band)
+
+    def get_raster(self, band, factor=None):
+        if band not in self.available_bands:
+            print(f'Band {band} not available')
+            return None
+
+        arr = self.loaded_bands_.get(band)
+        if arr is not None:
+            return arr
+
+        if band in self.calc_bands:
+            return self.band_math(band, self.calc_bands_[band])
+
+        # the region of a band the parent loaded for the whole image (ex. for the reductions) is not read again
+        if factor is None and band not in self.parent.calc_bands and self.parent.is_loaded(band):
+            return self.parent.loaded_bands_.get(band)[self.yoff:self.yoff + self.shape[0],
+                                                       self.xoff:self.xoff + self.shape[1]]
+
+        # the parent knows the right factor for its bands
+        if factor is None:
+            arr = self.parent.read_window(band, self.xoff, self.yoff, self.shape[1], self.shape[0])
+        else:
+            arr = self.parent.read_window(band, self.xoff, self.yoff, self.shape[1], self.shape[0], factor=factor)
+
+        if arr is None:
+            print(f'Band {band} could not be opened')
+        else:
+            self.loaded_bands_.update({band: arr})
+
+        return arr
+
+    def read_window(self, band, xoff, yoff, width, height, factor=None):
+        # windows of windows are relative to this window
+        if factor is None:
+            return self.parent.read_window(band, self.xoff + xoff, self.yoff + yoff, width, height)
+        return self.parent.read_window(band, self.xoff + xoff, self.yoff + yoff, width, height, factor=factor)
+
+    def window(self, xoff, yoff, width, height):
+        return WNImageWindow(self.parent, self.xoff + xoff, self.yoff + yoff, width, height)
+
+    def __repr__(self):
+        s = f'WNImageWindow (x={self.xoff}, y={self.yoff}, shape={self.shape}) over: \n'
+        s += str(self.parent)
+        return s
+
+
+####################################################################################
+class WNShardWriter:
+    """
+    Writes patches into a few big binary shard files ({prefix}_000.shard, {prefix}_001.shard, ...) with an index
+    ({prefix}.index.npz) that records, for each patch, its index, shard, offset, shape and dtype. Each patch starts
+    at an aligned offset, so it can be memory mapped. If the index already exists, the new patches are appended, and
+    a patch saved again (same scene and index) replaces the old one in the index. The index is written on close.
+    """
+
+    align = 64
+
+    def __init__(self, path, prefix, scene='', shard_size=2**30):
+        self.path, self.prefix, self.scene, self.shard_size = Path(path), prefix, scene, shard_size
+
+        records = WNShardReader.read_index(self.index_path) if self.index_path.exists() else []
+        self.records_ = WNShardReader.unique(records)
+        self.shard_ = max([r['shard'] for r in records]) if len(records) > 0 else 0
+        self.file_ = None
+
+        # position of each (scene, idx) in records_
+        self.keys_ = {(r['scene'], r['idx']): i for i, r in enumerate(self.records_)}
+
+    @property
+    def index_path(self):
+        return self.path / f'{self.prefix}.index.npz'
+
+    def shard_path(self, shard):
+        return self.path / f'{self.prefix}_{shard:03d}.shard'
+
+    def write(self, idx, patch):
+        patch = np.ascontiguousarray(patch)
+
+        if self.file_ is None:
+            self.file_ = open(self.shard_path(self.shard_), 'ab')
+
+        # start a new shard when the current one is full
+        offset = self.file_.tell()
+        if offset > 0 and offset + patch.nbytes > self.shard_size:
+            self.file_.close()
+            self.shard_ += 1
+            self.file_ = open(self.shard_path(self.shard_), 'ab')
+            offset = 0
+
+        patch.tofile(self.file_)
+
+        # pad to keep the next patch aligned
+        padding = -patch.nbytes % self.align
+        self.file_.write(b'\0' * padding)
+
+        record = {'scene': self.scene, 'idx': idx, 'shard': self.shard_, 'offset': offset, 'shape': patch.shape,
+                  'dtype': patch.dtype.str}
+
+        # the bytes of a replaced patch stay in the shard, but the index points to the new ones
+        key = (self.scene, idx)
+        if key in self.keys_:
+            self.records_[self.keys_[key]] = record
+        else:
+            self.keys_[key] = len(self.records_)
+            self.records_.append(record)
+
+    def close(self):
+        if self.file_ is not None:
+            self.file_.close()
+            self.file_ = None
+
+        n = len(self.records_)
+        shapes = np.zeros((n, 4), dtype=np.int64)
+        for i, r in enumerate(self.records_):
+            shapes[i, :len(r['shape'])] = r['shape']
+
+        np.savez(self.index_path,
+                 scene=np.array([r['scene'] for r in self.records_], dtype=str),
+                 idx=np.array([r['idx'] for r in self.records_], dtype=np.int64),
+                 shard=np.array([r['shard'] for r in self.records_], dtype=np.int32),
+                 offset=np.array([r['offset'] for r in self.records_], dtype=np.int64),
+                 ndim=np.array([len(r['shape']) for r in self.records_], dtype=np.int8),
+                 shape=shapes,
+                 dtype=np.array([r['dtype'] for r in self.records_], dtype=str))
+
+    def __del__(self):
+        if self.file_ is not None:
+            self.file_.close()
+
+
+####################################################################################
+class WNShardReader:
+    """
+    Random access to the patches written by WNShardWriter. Reads all the indices in the directory that match
+    base_name (or the given prefixes, with no directory listing) and orders the patches by scene and index.
+    scenes selects the patches of the scenes by their exact names. The shards are memory mapped on demand.
+    """
+
+    def __init__(self, path, base_name='', prefixes=None, scenes=None):
+        self.path = Path(path)
+
+        if prefixes is None:
+            prefixes = [index_path.name[:-len('.index.npz')] for index_path in sorted(self.path.glob('*.index.npz'))]
+            prefixes = [prefix for prefix in prefixes if base_name in prefix]
+
+        scenes = None if scenes is None else set([scenes] if isinstance(scenes, str) else scenes)
+
+        records = []
+        for prefix in prefixes:
+            records += [dict(r, prefix=prefix) for r in self.read_index(self.path / f'{prefix}.index.npz')
+                        if scenes is None or r['scene'] in scenes]
+
+        records.sort(key=lambda r: (r['scene'], r['idx'], r['prefix']))
+
+        self.records_ = self.unique(records)
+        self.maps_ = {}
+
+    @staticmethod
+    def unique(records):
+        # one record per (scene, idx), the last one (indices written before the writer replaced the patches saved
+        # again can repeat them)
+        last = {(r['scene'], r['idx']): i for i, r in enumerate(records)}
+        return [r for i, r in enumerate(records) if last[(r['scene'], r['idx'])] == i]
+
+    @staticmethod
+    def has_shards(path):
+        return any(True for _ in Path(path).glob('*.index.npz'))
+
+    @staticmethod
+    def read_index(index_path):
+        with np.load(index_path, allow_pickle=False) as index:
+            return [{'scene': str(index['scene'][i]),
+                     'idx': int(index['idx'][i]),
+                     'shard': int(index['shard'][i]),
+                     'offset': int(index['offset'][i]),
+                     'shape': tuple(int(d) for d in index['shape'][i, :index['ndim'][i]]),
+                     'dtype': str(index['dtype'][i])}
+                    for i in range(len(index['idx']))]
+
+    def select(self, keys):
+        # keeps only the records in keys, a set of (prefix, idx)
+        self.records_ = [r for r in self.records_ if (r['prefix'], r['idx']) in keys]
+
+    def get_map(self, prefix, shard):
+        key = (prefix, shard)
+        if key not in self.maps_:
+            self.maps_[key] = np.memmap(self.path / f'{prefix}_{shard:03d}.shard', dtype=np.uint8, mode='r')
+        return self.maps_[key]
+
+    def key(self, item):
+        r = self.records_[item]
+        return f'{self.path / r["prefix"]}:{r["scene"]}:{r["idx"]}'
+
+    def get(self, item, copy=True):
+        r = self.records_[item]
+        dtype = np.dtype(r['dtype'])
+        nbytes = int(np.prod(r['shape'])) * dtype.itemsize
+
+        buffer = self.get_map(r['prefix'], r['shard'])[r['offset']:r['offset'] + nbytes]
+        patch = buffer.view(dtype).reshape(r['shape'])
+
+        return np.array(patch) if copy else patch
+
+    def __len__(self):
+        return len(self.records_)
+
+    def __getitem__(self, item):
+        return self.get(item)
+
+
+####################################################################################
+class WNPatchStats:
+    """
+    Per patch statistics, computed once (vectorized, batch by batch) when the patches are saved and stored alongside
+    them in {prefix}.stats.npz files. For each patch it records the patch name, scene and index, the fraction of
+    valid (not NaN nor nodata in any band) pixels, the fraction of water pixels (value == 1, meaningful for the
+    labels) and the min/max of each band (without the nodata). It is used to filter or weight the patches of a
+    WNDataset.
+    """
+
+    suffix = '.stats.npz'
+    columns = ['valid', 'water', 'min', 'max']
+
+    def __init__(self, stats=None, names=None, scenes=None, idxs=None):
+        self.stats = {} if stats is None else stats
+        self.names = [] if names is None else list(names)
+        self.scenes = [] if scenes is None else list(scenes)
+        self.idxs = [] if idxs is None else list(idxs)
+
+    @staticmethod
+    def compute(batch, channels_first=True, water_value=1, nodata=None):
+        # batch is (B, C, H, W), (B, H, W, C) or (B, H, W) for single band patches.
+        # The nodata pixels (ex. WNSatImage.nodata) are invalid, as the NaNs
+        batch = np.asarray(batch)
+        if batch.ndim == 3:
+            batch = batch[:, np.newaxis]
+        elif not channels_first:
+            batch = np.moveaxis(batch, -1, 1)
+
+        flat = batch.reshape(batch.shape[0], batch.shape[1], -1)
+        if nodata is not None:
+            flat = np.where(flat == nodata, np.nan, flat.astype(np.result_type(flat.dtype, np.float32)))
+
+        # fmin/fmax ignore the NaNs (and return NaN for all NaN bands without warnings)
+        return {'valid': (~np.isnan(flat).any(axis=1)).mean(axis=1).astype('float32'),
+                'water': (flat[:, 0] == water_value).mean(axis=1).astype('float32'),
+                'min': np.fmin.reduce(flat, axis=2).astype('float32'),
+                'max': np.fmax.reduce(flat, axis=2).astype('float32')}
+
+    @staticmethod
+    def concat(stats):
+        stats = [s for s in stats if len(s) > 0]
+        if len(stats) == 0:
+            return {}
+        return {column: np.concatenate([s[column] for s in stats]) for column in WNPatchStats.columns}
+
+    @classmethod
+    def of(cls, patches, bs=256, nodata=None):
+        # computes the statistics of a WNPatchProcessor (with the nodata of its image) or of an array of patches
+        # (channels first)
+        if isinstance(patches, WNPatchProcessor):
+            return patches.patch_stats(bs=bs)
+
+        return cls.concat([cls.compute(np.asarray(patches[i:i + bs]), nodata=nodata)
+                           for i in range(0, len(patches), bs)])
+
+    def __len__(self):
+        return len(self.names)
+
+    def save(self, path, prefix):
+        # appends to the existing stats of the prefix, replacing the patches saved again
+        fn = Path(path) / f'{prefix}{self.suffix}'
+        current = WNPatchStats.read_file(fn) if fn.exists() else WNPatchStats()
+
+        names = set(self.names)
+        keep = np.array([name not in names for name in current.names], dtype=bool)
+        if not keep.all():
+            current = WNPatchStats({column: values[keep] for column, values in current.stats.items()},
+                                   names=np.array(current.names)[keep], scenes=np.array(current.scenes)[keep],
+                                   idxs=np.array(current.idxs)[keep].tolist())
+
+        stats = self.concat([current.stats, self.stats])
+        np.savez(fn, name=np.array(current.names + self.names, dtype=str),
+                 scene=np.array(current.scenes + self.scenes, dtype=str),
+                 idx=np.array(current.idxs + self.idxs, dtype=np.int64), **stats)
+
+    @classmethod
+    def read_file(cls, fn):
+        with np.load(fn, allow_pickle=False) as f:
+            return cls({column: f[column] for column in cls.columns}, names=f['name'].tolist(),
+                       scenes=f['scene'].tolist(), idxs=f['idx'].tolist())
+
+    @classmethod
+    def read(cls, path, base_name=''):
+        # reads and merges all the stats files in the directory that match base_name
+        parts = [cls.read_file(fn) for fn in sorted(Path(path).glob(f'*{cls.suffix}'))
+                 if base_name in fn.name[:-len(cls.suffix)]]
+
+        return cls.merge(parts)
+
+    @classmethod
+    def merge(cls, parts):
+        return cls(cls.concat([part.stats for part in parts]), names=sum([part.names for part in parts], []),
+                   scenes=sum([part.scenes for part in parts], []), idxs=sum([part.idxs for part in parts], []))
+
+    def take(self, keys):
+        # returns the statistics in the order of the keys (patch names or (scene, idx) tuples), or None if any
+        # of the patches has no statistics. Repeated keys keep the last ones saved
+        rows = {}
+        for row, (name, scene, idx) in enumerate(zip(self.names, self.scenes, self.idxs)):
+            rows[name] = rows[(scene, idx)] = row
+
+        if not all(key in rows for key in keys):
+            return None
+
+        rows = np.array([rows[key] for key in keys], dtype=np.int64)
+        return {column: self.stats[column][rows] for column in self.columns}
+
+
+####################################################################################
+class WNQuantizer:
+    """
+    Quantization of the patches to uint16 or uint8 for storage. Each band is stored as round((value - offset) / scale)
+    and the NaNs as the sentinel (the max of the dtype). The scale and offset of each band are given by ranges
+    [(min, max), ...], by a fixed physical range (see fixed) or calibrated from the patches statistics (integer data,
+    ex. labels, keep scale 1). A single range applies to all the bands.
+    The quantization of a patches directory is saved in it (quantization.json) and shared by all its patches, so the
+    values out of its range are not clipped silently: they raise an error (or are reported, see overflow).
+    """
+
+    file_name = 'quantization.json'
+
+    # physical range of the reflectances (and the indices, in [-1, 1]) after the factor
+    physical_range = (-1., 2.)
+
+    # values out of the range: 'raise', 'warn' (printed and clipped) or 'clip'
+    overflow = 'raise'
+
+    def __init__(self, dtype='uint16', ranges=None, scale=None, offset=None):
+        self.dtype = np.dtype(dtype)
+        self.sentinel = np.iinfo(self.dtype).max
+
+        self.scale = None if scale is None else np.asarray(scale, dtype='float32')
+        self.offset = None if offset is None else np.asarray(offset, dtype='float32')
+
+        if ranges is not None:
+            self.set_ranges(ranges)
+
+    @classmethod
+    def fixed(cls, dtype='uint16', integral=False):
+        # quantization that does not depend on the data, for datasets saved window by window or scene by scene:
+        # the physical range of the reflectances or, for integral data (ex. labels), the integers from 0 (scale 1)
+        quantizer = cls(dtype)
+        if integral:
+            quantizer.set_ranges([(0, int(quantizer.sentinel) - 1)], integral=True)
+        else:
+            quantizer.set_ranges([cls.physical_range])
+        return quantizer
+
+    @property
+    def calibrated(self):
+        return self.scale is not None
+
+    def matches(self, other):
+        # if other (a WNQuantizer or a dtype) can be used as this quantization: the same dtype and, if it has them,
+        # the same scales and offsets
+        other = other if isinstance(other, WNQuantizer) else WNQuantizer(other)
+        if other.dtype != self.dtype:
+            return False
+
+        return not other.calibrated or (np.allclose(other.scale, self.scale) and np.allclose(other.offset, self.offset))
+
+    def set_ranges(self, ranges, integral=False):
+        # the sentinel is not used for values
+        ranges = np.asarray(ranges, dtype='float64').reshape(-1, 2)
+        levels = int(self.sentinel) - 1
+
+        scale = (ranges[:, 1] - ranges[:, 0]) / levels
+        if integral and np.all(ranges[:, 1] - ranges[:, 0] <= levels):
+            scale = np.ones_like(scale)
+
+        self.scale = np.where(scale > 0, scale, 1).astype('float32')
+        self.offset = ranges[:, 0].astype('float32')
+
+    def calibrate(self, proc, bs=256):
+        # ranges from the patches min/max. If all the values are integers, they are stored exactly
+        # the statistics leave the nodata pixels out, but they are saved too, so the ranges cover the nodata value
+        stats = proc.patch_stats(bs=bs)
+        ranges = np.stack([np.nanmin(stats['min'], axis=0), np.nanmax(stats['max'], axis=0)], axis=1)
+        nodata = proc.format.get('nodata')
+        if nodata is not None:
+            ranges = np.stack([np.fmin(ranges[:, 0], nodata), np.fmax(ranges[:, 1], nodata)], axis=1)
+
+        integral = all(np.all(np.isnan(batch) | (batch == np.round(batch))) for batch in proc.iter_batches(bs))
+        self.set_ranges(np.nan_to_num(ranges), integral=integral)
+
+    def band_shape(self, patch, channels_first):
+        # shape to broadcast the bands parameters over a patch (C, H, W), (H, W, C) or (H, W)
+        if patch.ndim == 2:
+            return ()
+        return (-1, 1, 1) if channels_first else (-1,)
+
+    def quantize(self, patch, channels_first=True):
+        shape = self.band_shape(patch, channels_first)
+        scale, offset = self.scale.reshape(shape) if shape else self.scale[0], \
+            self.offset.reshape(shape) if shape else self.offset[0]
+
+        q = np.rint((patch - offset) / scale)
+        self.check_range(q)
+        q = np.clip(q, 0, self.sentinel - 1, out=q)
+        q[np.isnan(patch)] = self.sentinel
+
+        return q.astype(self.dtype)
+
+    def check_range(self, q):
+        # q are the quantized levels, before clipping (NaN for the NaNs)
+        if self.overflow == 'clip' or np.isnan(q).all():
+            return
+
+        low, high = np.nanmin(q), np.nanmax(q)
+        if low >= 0 and high <= self.sentinel - 1:
+            return
+
+        msg = (f'Values out of the quantization range (levels {low:.0f} to {high:.0f}, valid 0 to '
+               f'{self.sentinel - 1}). Give the ranges of the bands or use WNQuantizer.fixed')
+        if self.overflow == 'raise':
+            raise ValueError(msg)
+        print(msg)
+
+    def dequantize(self, patch, channels_first=True):
+        # returns the storage dtype (dtype_policy), with NaNs in the sentinel pixels
+        shape = self.band_shape(patch, channels_first)
+        scale, offset = self.scale.reshape(shape) if shape else self.scale[0], \
+            self.offset.reshape(shape) if shape else self.offset[0]
+
+        result = patch.astype(dtype_policy.storage)
+        result *= scale
+        result += offset
+        result[patch == self.sentinel] = np.nan
+
+        return result
+
+    def save(self, path):
+        fn = Path(path) / self.file_name
+        tmp_fn = fn.with_suffix('.tmp')
+        with open(tmp_fn, 'w') as f:
+            json.dump({'dtype': self.dtype.name, 'scale': self.scale.tolist(), 'offset': self.offset.tolist()}, f)
+        os.replace(tmp_fn, fn)
+
+    @classmethod
+    def read(cls, path):
+        fn = Path(path) / cls.file_name
+        if not fn.exists():
+            return None
+
+        with open(fn) as f:
+            spec = json.load(f)
+        return cls(spec['dtype'], scale=spec['scale'], offset=spec['offset'])
+
+    def __repr__(self):
+        return f'WNQuantizer {self.dtype.name} scale={self.scale} offset={self.offset}'
+
+
+####################################################################################
+class WNPatchManifest:
+    """
+    Index of a patches directory (manifest.sqlite), written by save_patches. It records, for each patch, its scene,
+    index, file (the file name, or the shards prefix), format (ext), bands, shape, dtype, position in the patches
+    grid (row, col) and the format parameters (size, shift, channels_first and the patches grid of the scene). The patches are opened
+    from it with no directory listing, selecting the scenes by their exact names, and the manifest rows are the
+    patches of the directory (also for the shards). SQLite locks the file, so the parallel workers can add their
+    patches to the same manifest. When the manifest is created in a directory with patches saved before it, they
+    are added to it first (see legacy_records), so they are still loaded.
+    """
+
+    file_name = 'manifest.sqlite'
+    columns = ['scene', 'idx', 'file', 'format', 'bands', 'shape', 'dtype', 'row', 'col', 'size', 'shift',
+               'channels_first', 'patches_per_row', 'patches_per_column']
+
+    # seconds waiting for the lock of other writers
+    timeout = 60
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    @property
+    def fn(self):
+        return self.path / self.file_name
+
+    @classmethod
+    def exists(cls, path):
+        return (Path(path) / cls.file_name).exists()
+
+    def connect(self):
+        con = sqlite3.connect(str(self.fn), timeout=self.timeout)
+        con.execute('CREATE TABLE IF NOT EXISTS patches (scene TEXT NOT NULL, idx INTEGER NOT NULL, '
+                    'file TEXT NOT NULL, format TEXT, bands TEXT, shape TEXT, dtype TEXT, row INTEGER, col INTEGER, '
+                    'size INTEGER, shift INTEGER, channels_first INTEGER, patches_per_row INTEGER, '
+                    'patches_per_column INTEGER, '
+                    'PRIMARY KEY (scene, bands, idx))')
+        con.execute('CREATE INDEX IF NOT EXISTS patches_scene ON patches (scene, idx)')
+        return con
+
+    def add(self, records):
+        # records are dicts with the columns. A patch saved again (same scene, bands and index, even in another shards
+        # prefix) replaces the old record
+        if not self.fn.exists() and len(records) > 0:
+            records = self.legacy_records(records[0]['bands']) + list(records)
+
+        rows = [tuple(r.get(column) for column in self.columns) for r in records]
+
+        con = self.connect()
+        try:
+            with con:
+                con.executemany(f'INSERT OR REPLACE INTO patches ({", ".join(self.columns)}) '
+                                f'VALUES ({", ".join("?" * len(self.columns))})', rows)
+        finally:
+            con.close()
+
+    def legacy_records(self, bands):
+        # Records of the patches in the directory with no manifest: the shards indices and the patch files
+        # ({scene}_{bands}_{idx}.ext). The scene is split from the file names with the bands string given (the one of
+        # the patches being saved), as the scenes can have '_'. Their position in the patches grid is unknown
+        records = []
+        for index_path in sorted(self.path.glob('*.index.npz')):
+            prefix = index_path.name[:-len('.index.npz')]
+            for r in WNShardReader.unique(WNShardReader.read_index(index_path)):
+                records.append({'scene': r['scene'], 'idx': r['idx'], 'file': prefix, 'format': 'shard',
+                                'bands': prefix[len(r['scene']) + 1:], 'shape': ','.join(map(str, r['shape'])),
+                                'dtype': r['dtype']})
+
+        for fn in sorted(self.path.glob('*_*')):
+            head, _, idx = fn.stem.rpartition('_')
+            if fn.suffix not in ('.npy', '.png', '.torch') or not idx.isdigit():
+                continue
+
+            scene, file_bands = (head[:-len(bands) - 1], bands) if head.endswith(f'_{bands}') else (head, '')
+            record = {'scene': scene, 'idx': int(idx), 'file': fn.name, 'format': fn.suffix[1:], 'bands': file_bands}
+
+            if fn.suffix == '.npy':
+                patch = np.load(fn, mmap_mode='r')
+                record.update({'shape': ','.join(map(str, patch.shape)), 'dtype': patch.dtype.str})
+            records.append(record)
+
+        return records
+
+    def records(self, scenes=None):
+        # records of the scenes (exact names, all the scenes if None), ordered by scene and index
+        query = f'SELECT {", ".join(self.columns)} FROM patches'
+        params = []
+        if scenes is not None:
+            scenes = [scenes] if isinstance(scenes, str) else list(scenes)
+            query += f' WHERE scene IN ({", ".join("?" * len(scenes))})'
+            params = scenes
+        query += ' ORDER BY scene, idx, file'
+
+        con = self.connect()
+        try:
+            rows = con.execute(query, params).fetchall()
+        finally:
+            con.close()
+
+        records = [dict(zip(self.columns, row)) for row in rows]
+        for r in records:
+            r['shape'] = tuple(int(d) for d in r['shape'].split(',') if d) if r['shape'] is not None else None
+            r['channels_first'] = bool(r['channels_first']) if r['channels_first'] is not None else None
+        return records
+
+    def scenes(self):
+        con = self.connect()
+        try:
+            return [row[0] for row in con.execute('SELECT DISTINCT scene FROM patches ORDER BY scene')]
+        finally:
+            con.close()
+
+    def __len__(self):
+        con = self.connect()
+        try:
+            return con.execute('SELECT COUNT(*) FROM patches').fetchone()[0]
+        finally:
+            con.close()
+
+    def __repr__(self):
+        return f'WNPatchManifest at {self.fn}'
+
+
+####################################################################################
+class WNSaveSession:
+    """
+    Groups consecutive save_patches calls (ex. the windows of a scene). The shard writers stay open, and the shards
+    indices, the patches statistics and the manifest records are written once, on close, and not on every window.
+    """
+
+    def __init__(self):
+        # shard writers and statistics by (path, prefix), manifest records by path
+        self.writers_, self.stats_, self.records_ = {}, {}, {}
+
+    def writer(self, path, prefix, scene):
+        key = (Path(path), prefix)
+        if key not in self.writers_:
+            self.writers_[key] = WNShardWriter(path, prefix, scene=scene)
+        return self.writers_[key]
+
+    def add_stats(self, path, prefix, stats):
+        self.stats_.setdefault((Path(path), prefix), []).append(stats)
+
+    def add_records(self, path, records):
+        self.records_.setdefault(Path(path), []).extend(records)
+
+    def close(self):
+        for writer in self.writers_.values():
+            writer.close()
+
+        for (path, prefix), parts in self.stats_.items():
+            WNPatchStats.merge(parts).save(path, prefix)
+
+        # the manifest is written after the patches, so it never points to missing files
+        for path, records in self.records_.items():
+            WNPatchManifest(path).add(records)
+
+        self.writers_, self.stats_, self.records_ = {}, {}, {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+####################################################################################
+class WNPatchCache:
+    """
+    LRU cache of patches loaded from disk, limited by a budget in bytes. It can be shared by several
+    WNPatchProcessors (ex. images and labels of a WNDataset). The cached patches are read only.
+    """
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.items_ = OrderedDict()
+        self.nbytes, self.hits, self.misses = 0, 0, 0
+
+    def get(self, key, loader):
+        if key in self.items_:
+            self.items_.move_to_end(key)
+            self.hits += 1
+            return self.items_[key]
+
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        # patches bigger than the whole budget are not cached
+        if value.nbytes > self.max_bytes:
+            return
 
-    def reset_shape(self):
-        self.shape_ = None
+        if key in self.items_:
+            self.nbytes -= self.items_.pop(key).nbytes
 
-    def open_gdal_ds(self, name, recursive=True):
-        file = search_file([self.path], name, recursive)
+        value.flags.writeable = False
+        self.items_[key] = value
+        self.nbytes += value.nbytes
 
-        if file is None:
-            print(f'File {name} not found in {self.path} and subdirectories')
-            return None
-        else:
-            ds = gdal.Open(str(file))
-            if ds is None:
-                print(f'Could not open file {file}')
+        # evict the least recently used
+        while self.nbytes > self.max_bytes:
+            _, old = self.items_.popitem(last=False)
+            self.nbytes -= old.nbytes
 
-            return ds
+    def clear(self):
+        self.items_ = OrderedDict()
+        self.nbytes = 0
 
-    def open_img(self):
-        bands = self.img_dic.keys()
-        result = {}
-        for band_key in bands:
-            result.update({band_key: self.open_gdal_ds(self.img_dic[band_key], recursive=True)})
-        return result
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
 
-    def get_gdal_band(self, key):
-        if key in self.available_bands:
-            return self.datasets[key]
-        else:
-            print(f'Band {key} not available')
-            return None
+    @property
+    def stats(self):
+        return {'items': len(self), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
 
-    def get_raster(self, band, factor=None):
-        factor = 1/10000 if factor is None else factor
-        return super().get_raster(band, factor=factor)
-        # return arr/10000 if arr is not None else None
+    def __len__(self):
+        return len(self.items_)
 
     def __repr__(self):
-        s = f'WNSatImage with {self.available_bands} available bands \n'
-        s += f'Source: {self.path} \n'
-        s += f'Bands {list(self.loaded_bands_.keys())} loaded in memory'
-        return s
+        return (f'WNPatchCache with {len(self)} patches, {self.nbytes/1024/1024:.1f}/{self.max_bytes/1024/1024:.1f} Mb. '
+                f'Hits: {self.hits} Misses: {self.misses}')
 
 
 ####################################################################################
 class WNPatchProcessor:
-    def __init__(self, img=None, patches_path=None, from_patches=None):
+    def __init__(self, img=None, patches_path=None, from_patches=None, mmap_mode=None, cache=None):
 
         self.patches_, self.path_patches_, self.format_ = [], [], {}
 
+        # mmap_mode is used to open .npy (and shards) from disk, and the cache (WNPatchCache) keeps the last ones read
+        self.mmap_mode, self.cache = mmap_mode, cache
+
+        # strided view (rows, cols, patch...) over the cube, used instead of patches_ when created with as_view
+        self.view_ = None
+
+        # reader for patches saved in shards (ext='shard'), used instead of path_patches_
+        self.shards_ = None
+
+        # per patch statistics (WNPatchStats), read from disk or computed on demand
+        self.stats_ = None
+
+        # quantization (WNQuantizer) of the patches loaded from disk, if they were saved quantized
+        self.quant_ = None
+
+        # flat mask of the patches that are not fully invalid (created with skip_invalid), None for all valid
+        self.valid_ = None
+
+        # for patches loaded from disk with some patches not saved (fully invalid), the stored patch of each
+        # position of the patches grid (-1 for the missing ones), and the shape and dtype of the patches
+        self.grid_items_, self.missing_ = None, None
+
         self.img = None
 
         if img is not None:
@@ -662,18 +3040,41 @@ class WNPatchProcessor:
         }
         self.format_ = format_
 
-    def create_patches(self, bands, size, shift, channels_first=False):
+    def create_patches(self, bands, size, shift, channels_first=False, as_view=False, valid=None):
+        # valid marks the patches that are not fully invalid (valid_). They are not saved nor predicted, and they are
+        # filled with the fill (nodata) value in the assembly. It can be True (calculated from the bands read to
+        # create the patches, with no other pass over the image, see WNImage.valid_patches) or a (rows, cols) mask of
+        # the patches grid.
+        # None keeps all the patches
 
         self.set_format(bands, size, shift, channels_first)
+        self.format_['nodata'] = self.img.nodata
+        self.stats_ = None
 
         bands = bands if type(bands) == list else [bands]
 
-        cube = self.img.as_cube(bands, channels_first=False)
+        if valid is True:
+            # calculated from the source bands loaded for the patches, so they are not read again. The blocks of
+            # gcd(size, shift) pixels tile the patches exactly, and the windows of the patches grid are aligned to them
+            sources = self.img.source_bands(bands)
+            self.img.load_bands(sources)
+            valid = self.img.valid_patches(size, shift, sources, block=math.gcd(size, shift))
+
+        if as_view:
+            self.create_patches_view(bands, size, shift, channels_first)
+            self.valid_ = None if valid is None else np.asarray(valid, dtype=bool).reshape(-1)
+            return
+
+        self.valid_ = None if valid is None else np.asarray(valid, dtype=bool).reshape(-1)
+
+        with self.img.pinned(bands):
+            cube = self.img.as_cube(bands, channels_first=False)
 
         dims = (0, 1, 2) if not channels_first else (2, 0, 1)
 
         num_patches_hor = math.floor(1 + (cube.shape[1] - size) / shift)
         num_patches_ver = math.floor(1 + (cube.shape[0] - size) / shift)
+        self.format_.update({'patches_per_row': num_patches_hor, 'patches_per_column': num_patches_ver})
 
         squares = [np.transpose(cube[i * shift:i * shift + size, j * shift:j * shift + size, :], dims)
                    for i in range(num_patches_ver)
@@ -683,6 +3084,57 @@ class WNPatchProcessor:
 
         # return self.patches_
 
+    def create_patches_view(self, bands, size, shift, channels_first=False):
+        # Creates the patches as a single strided view over the cube, with no copies and no per patch objects.
+        # The view has shape (rows, cols, C, size, size) or (rows, cols, size, size, C)
+        self.clear_patches()
+
+        with self.img.pinned(bands):
+            cube = self.img.as_cube(bands, channels_first=channels_first)
+
+        rows_axis, cols_axis = (1, 2) if channels_first else (0, 1)
+
+        num_patches_hor = math.floor(1 + (cube.shape[cols_axis] - size) / shift)
+        num_patches_ver = math.floor(1 + (cube.shape[rows_axis] - size) / shift)
+
+        patch_shape = list(cube.shape)
+        patch_shape[rows_axis], patch_shape[cols_axis] = size, size
+
+        shape = (num_patches_ver, num_patches_hor) + tuple(patch_shape)
+        strides = (cube.strides[rows_axis] * shift, cube.strides[cols_axis] * shift) + cube.strides
+
+        self.view_ = np.lib.stride_tricks.as_strided(cube, shape=shape, strides=strides, writeable=False)
+        self.format_.update({'patches_per_row': num_patches_hor, 'patches_per_column': num_patches_ver})
+
+    @property
+    def patches_view(self):
+        # the patches as a (N, C, H, W) or (N, H, W, C) array. It is a view only if the grid has one column,
+        # otherwise numpy needs to copy it
+        if self.view_ is None:
+            return self.get_batch(0, len(self))
+        return self.view_.reshape((-1,) + self.view_.shape[2:])
+
+    def get_batch(self, start, stop):
+        # returns the patches [start:stop] as a contiguous array (B, C, H, W) or (B, H, W, C), always with the
+        # channels axis, even for single band patches
+        return self.take(np.arange(start, min(stop, len(self))))
+
+    def take(self, idxs):
+        # as get_batch, for any patches indices
+        if self.view_ is not None:
+            cols = self.view_.shape[1]
+            return np.ascontiguousarray(self.view_[idxs // cols, idxs % cols])
+
+        batch = np.stack([self[i] for i in idxs])
+        if batch.ndim == 3:
+            batch = batch[:, np.newaxis] if self.channels_first else batch[..., np.newaxis]
+
+        return batch
+
+    def iter_batches(self, bs):
+        for start in range(0, len(self), bs):
+            yield self.get_batch(start, start + bs)
+
     def get_visual_patch(self, idx, bright=1., chnls=[3, 2, 1]):
         patch = self[idx]
         if patch is not None:
@@ -731,25 +3183,91 @@ class WNPatchProcessor:
         for p in range(qty):
             ax[p].imshow(self.get_visual_patch(p+first, bright, chnls=chnls))
 
-    def save_patches(self, path, base_name, ext='npy', fill_nan=None):
-        if len(self) == 0:
+    def save_patches(self, path, base_name, ext='npy', fill_nan=None, start=0, part=None, stats=True, quantize=None,
+                     session=None):
+        # start is the index of the first patch, used when the patches are created window by window.
+        # part is added to the shards names, so different parts of a scene can be written concurrently.
+        # session (WNSaveSession) defers the shards indices, statistics and manifest of the windows of a scene to
+        # its close. Without it, they are written at the end of this call.
+        # if stats is True, the patches statistics (WNPatchStats) are saved alongside the patches.
+        # quantize ('uint16', 'uint8' or a WNQuantizer) stores the patches quantized (npy and shard). The quantization
+        # already saved in the directory is always reused, so the windows and scenes of a dataset share it (a
+        # different dtype or range raises an error), and the values out of its range raise an error. It is only
+        # calibrated from the patches on a single save (not in a session or from start > 0); the windowed and multi
+        # scene saves need a WNQuantizer with the ranges of the bands, or WNQuantizer.fixed
+        # the fully invalid patches (see create_patches) are not saved, but the others keep their indices
+        valid = np.ones(len(self), dtype=bool) if self.valid_ is None else self.valid_
+
+        if not valid.any():
             print(f'No patches to save')
             return
 
         path.mkdir(parents=True, exist_ok=True)
 
-        for i, patch in enumerate(self.patches_):
+        quantizer = None
+        if quantize is not None:
+            quantizer = WNQuantizer.read(path)
+            if quantizer is not None and not quantizer.matches(quantize):
+                raise ValueError(f'The patches in {path} are quantized as {quantizer}, not as {quantize}. Save them '
+                                 f'with the same quantization, or in another directory')
+
+            if quantizer is None:
+                quantizer = quantize if isinstance(quantize, WNQuantizer) else WNQuantizer(quantize)
+                if not quantizer.calibrated:
+                    if session is not None or start > 0 or part is not None:
+                        raise ValueError('The quantization of patches saved window by window needs the ranges of '
+                                         'the bands (WNQuantizer with ranges, or WNQuantizer.fixed)')
+                    quantizer.calibrate(self)
+                quantizer.save(path)
+
+        own_session = session is None
+        session = WNSaveSession() if own_session else session
+
+        # all the patches go to a few big shard files, appending to the existing ones (windowed creation)
+        prefix = f'{base_name}_{self.bands_string}' + (f'_{part}' if part is not None else '')
+        writer = session.writer(path, prefix, base_name) if ext == 'shard' else None
+
+        # records of the saved patches, added to the manifest of the directory (see WNPatchManifest)
+        records = []
+        ppr = self.format.get('patches_per_row')
+        grid = {key: None if self.format.get(key) is None else int(self.format.get(key))
+                for key in ['size', 'shift', 'channels_first', 'patches_per_row', 'patches_per_column']}
+
+        if stats:
+            # computed before filling the NaNs, so the NaNs and the nodata of the image (format nodata) are invalid
+            idxs = [start + i for i in np.flatnonzero(valid).tolist()]
+            patch_stats = {column: values[valid] for column, values in self.patch_stats().items()}
+            session.add_stats(path, prefix, WNPatchStats(patch_stats,
+                                                         names=[f'{base_name}_{self.bands_string}_{i}' for i in idxs],
+                                                         scenes=[base_name] * len(idxs), idxs=idxs))
+
+        for i, patch in enumerate(self, start):
+            if not valid[i - start]:
+                continue
 
             if fill_nan is not None:
                 patch = np.nan_to_num(patch, nan=fill_nan)
 
+            if quantizer is not None:
+                patch = quantizer.quantize(patch, bool(self.format.get('channels_first')))
+
             fn = (path / f'{base_name}_{self.bands_string}_{i}').with_suffix('.'+ext)
             # patch = np.where(patch > 1, 1, np.where(patch < 0, 0, patch))
 
-            if ext == 'npy':
+            patch = np.asarray(patch)
+            records.append({'scene': base_name, 'idx': int(i), 'file': prefix if ext == 'shard' else fn.name,
+                            'format': ext, 'bands': self.bands_string, 'shape': ','.join(map(str, patch.shape)),
+                            'dtype': patch.dtype.str, 'row': int(i // ppr) if ppr else None,
+                            'col': int(i % ppr) if ppr else None, **grid})
+
+            if ext == 'shard':
+                writer.write(i, patch)
+
+            elif ext == 'npy':
                 np.save(str(fn), patch, allow_pickle=False)
 
             elif ext == 'jpg':
+                records[-1]['file'] = fn.with_suffix('.png').name
                 plt.imsave(fn.with_suffix('.png'), patch)
 
             elif ext == 'png':
@@ -759,11 +3277,76 @@ class WNPatchProcessor:
             elif ext == 'torch':
                 torch.save(patch, fn)
 
-    def load_patches(self, path, bands=[], size=0, shift=0, base_name='', channels_first=True, in_memory=False):
+        session.add_records(path, records)
+
+        if own_session:
+            session.close()
+
+    def load_patches(self, path, bands=[], size=0, shift=0, base_name='', channels_first=True, in_memory=False,
+                     mmap_mode=None, cache=None, scenes=None):
+        # If the directory has a manifest (WNPatchManifest), the patches are opened from it, with no directory
+        # listing, and base_name (or scenes, a list) selects the scenes by their exact names. The format (size,
+        # shift and patches per row) not given is taken from the manifest.
+        # Directories saved before the manifest are listed, and base_name selects the files by their names prefix
+        path = Path(path)
         self.set_format(bands, size, shift, channels_first)
 
+        self.mmap_mode = mmap_mode if mmap_mode is not None else self.mmap_mode
+        self.cache = cache if cache is not None else self.cache
+        self.stats_ = None
+        self.valid_ = None
+        self.grid_items_, self.missing_ = None, None
+
+        # quantized patches are dequantized when accessed (__getitem__)
+        self.quant_ = WNQuantizer.read(path)
+
+        if WNPatchManifest.exists(path):
+            scenes = scenes if scenes is not None else (base_name if base_name != '' else None)
+            records = WNPatchManifest(path).records(scenes)
+
+            # the patches saved before the manifest have no format
+            saved = next((r for r in records if r['size'] is not None), None)
+            if saved is not None and size == 0:
+                self.format_.update({key: saved[key] for key in ['size', 'shift']})
+            if saved is not None and self.format_.get('patches_per_row') is None:
+                self.format_.update({'patches_per_row': saved['patches_per_row']})
+
+            # the patches not saved (fully invalid, see create_patches) get back their positions in the grid
+            self.set_grid(records)
+
+            # if the patches are in shards, they are used instead of the individual files
+            shard_records = [r for r in records if r['format'] == 'shard']
+            if len(shard_records) > 0:
+                self.shards_ = WNShardReader(path, prefixes=sorted(set(r['file'] for r in shard_records)),
+                                             scenes=scenes)
+                self.shards_.select(set((r['file'], r['idx']) for r in shard_records))
+                self.path_patches_ = []
+            else:
+                self.shards_ = None
+                self.path_patches_ = [str(path / r['file']) for r in records]
+
+            if in_memory:
+                # stored as read (quantized patches are dequantized when accessed)
+                stored = [self.stored_item(i) for i in range(len(self))]
+                self.patches_ = [self.read_patch(item) if item >= 0 else self.missing_patch() for item in stored]
+
+            return None
+
+        # if the directory has shards, they are used instead of the individual files
+        if WNShardReader.has_shards(path):
+            self.shards_ = WNShardReader(path, base_name)
+            self.path_patches_ = []
+
+            if in_memory:
+                self.patches_ = [self.shards_[i] for i in range(len(self.shards_))]
+
+            return None
+
+        # the names are {base_name}_{bands}_{idx}, so base_name is matched as a prefix (T31_1 does not match T31_10)
+        prefix = f'{base_name}_' if base_name != '' else ''
         imgs_names = [(int(str(file).split('_')[-1].split('.')[0]), str(file)) for file in path.iterdir()
-                      if (not file.is_dir()) and (base_name in file.stem)]
+                      if (not file.is_dir()) and file.stem.startswith(prefix) and
+                      (not file.name.endswith(WNPatchStats.suffix)) and (file.name != WNQuantizer.file_name)]
         imgs_names.sort()
 
         # create the list with the files in disk
@@ -774,7 +3357,97 @@ class WNPatchProcessor:
 
         return None
 
-    def assembly_patches(self, channels_first=None):
+    def set_grid(self, records):
+        # Places the records (manifest, ordered by scene and idx) in the patches grids of their scenes. If any patch
+        # is missing, grid_items_ maps the positions to the stored patches and valid_ marks the stored ones
+        groups = itertools.groupby(enumerate(records), key=lambda item: item[1]['scene'])
+
+        grid_items = []
+        for _, group in groups:
+            group = list(group)
+            ppr = group[0][1]['patches_per_row']
+            if ppr is None:
+                # patches saved before the manifest, with no grid
+                grid_items.append(np.array([i for i, _ in group], dtype=np.int64))
+                continue
+
+            rows = max([group[0][1]['patches_per_column'] or 0] + [r['idx'] // ppr + 1 for _, r in group])
+            items = np.full(rows * ppr, -1, dtype=np.int64)
+            items[[r['idx'] for _, r in group]] = [i for i, _ in group]
+            grid_items.append(items)
+
+        if len(grid_items) == 0:
+            return
+
+        grid_items = np.concatenate(grid_items)
+        if len(grid_items) == len(records):
+            return
+
+        self.grid_items_ = grid_items
+        self.valid_ = grid_items >= 0
+        self.missing_ = (records[0]['shape'], np.dtype(records[0]['dtype']))
+
+    def missing_patch(self):
+        # patch of a position not saved: NaN (nodata) for float or quantized patches, otherwise 0
+        shape, dtype = self.missing_
+        if self.quant_ is not None and dtype == self.quant_.dtype:
+            return np.full(shape, np.nan, dtype=dtype_policy.storage)
+        return np.full(shape, np.nan if dtype.kind == 'f' else 0, dtype=dtype)
+
+    def stored_item(self, item):
+        # index of the stored patch (in path_patches_ or shards_) of an item, -1 if it was not saved
+        return item if self.grid_items_ is None else int(self.grid_items_[item])
+
+    def item_key(self, idx):
+        # key of the patch in the WNPatchStats: (scene, idx) for shards, or the file name
+        idx = self.stored_item(idx)
+        if self.shards_ is not None:
+            r = self.shards_.records_[idx]
+            return r['scene'], r['idx']
+        return Path(self.path_patches_[idx]).stem
+
+    def patch_stats(self, bs=256):
+        # statistics of the patches, in the order of the patches. For patches loaded from disk, they are read from
+        # the stats files saved with the patches, otherwise (or if they are missing) they are computed
+        if self.stats_ is not None:
+            return self.stats_
+
+        path = None
+        if self.shards_ is not None:
+            path = self.shards_.path
+        elif len(self.path_patches_) > 0:
+            path = Path(self.path_patches_[0]).parent
+
+        if path is not None:
+            # the patches not saved have no statistics: valid 0 and NaN min/max
+            items = np.arange(len(self)) if self.valid_ is None else np.flatnonzero(self.valid_)
+            stats = WNPatchStats.read(path).take([self.item_key(i) for i in items])
+
+            if stats is not None and self.valid_ is not None:
+                stats = {column: self.scatter_stats(values, items, len(self)) for column, values in stats.items()}
+            self.stats_ = stats
+
+        if self.stats_ is None:
+            # the batches always have the channels axis, first or last as in get_batch
+            channels_first = bool(self.format.get('channels_first'))
+            self.stats_ = WNPatchStats.concat([WNPatchStats.compute(batch, channels_first=channels_first,
+                                                                    nodata=self.format.get('nodata'))
+                                               for batch in self.iter_batches(bs)])
+
+        return self.stats_
+
+    @staticmethod
+    def scatter_stats(values, items, n):
+        result = np.full((n,) + values.shape[1:], np.nan if values.ndim > 1 else 0, dtype=values.dtype)
+        result[items] = values
+        return result
+
+    def assembly_patches(self, channels_first=None, dtype=None, feather=False, fill=0, on_rows=None):
+        # The overlapping regions are averaged (or blended with feathered weights), so the result does not depend on
+        # the patches order. If on_rows is given, the scene is not allocated and each finished block of rows
+        # is passed as on_rows(first_row, rows) with rows in (C, n_rows, width) shape, for incremental writing.
+        # dtype defaults to the storage dtype (dtype_policy)
+        dtype = dtype_policy.storage if dtype is None else dtype
         if channels_first is not None:
             self.channels_first = channels_first
 
@@ -782,57 +3455,81 @@ class WNPatchProcessor:
             print(f'No patches to assembly')
             return
 
-        if self.format['patches_per_row'] is None:
-            patches_by_row = int(math.sqrt(len(self)))
-        else:
-            patches_by_row = self.format['patches_per_row']
+        patches_by_row, patches_by_column, size, shift = self.assembly_grid()
 
-        patches_by_column = int(len(self)/patches_by_row)
+        assembler = WNPatchAssembler(patches_by_row, size, shift, channels=self.num_channels, dtype=dtype,
+                                     feather=feather, fill=fill)
 
-        size_y = self.patch_height * patches_by_column
-        size_x = self.patch_width * patches_by_row
+        scene = None
+        if on_rows is None:
+            # create the scene array (always channels first while assembling)
+            scene = np.empty((self.num_channels, (patches_by_column - 1) * shift + size, assembler.width), dtype=dtype)
+            print(f'Creating image shape {scene.shape}')
 
-        # create the scene array
-        if self.channels_first:
-            scene = np.ones((self.num_channels, size_y, size_x))
-        else:
-            scene = np.ones((size_y, size_x, self.num_channels))
+        def write(chunks):
+            for first_row, rows in chunks:
+                if on_rows is not None:
+                    on_rows(first_row, rows)
+                else:
+                    scene[:, first_row:first_row + rows.shape[1]] = rows
 
-        print(f'Creating image shape {scene.shape}')
+        for row in range(patches_by_column):
+            # the fully invalid patches (see create_patches) are not read, and are filled in the scene
+            valid = None if self.valid_ is None else self.valid_[row * patches_by_row:(row + 1) * patches_by_row]
+            if valid is not None and not valid.any():
+                write(assembler.add_row(None))
+                continue
 
-        patch_size = self.patch_width
-        row = 0
-        col = 0
-        idx = 0
+            batch = self.get_batch(row * patches_by_row, (row + 1) * patches_by_row)
+            if not self.channels_first:
+                batch = np.moveaxis(batch, -1, 1)
 
-        for patch in self:
-            if patch.ndim == 2:
-                if self.channels_first:
-                    patch = patch[np.newaxis, :, :]
-                else:
-                    patch = patch[:, :, np.newaxis]
+            write(assembler.add_row(batch, valid))
 
-            if idx == patches_by_row:
-                row += self.format['shift']
-                col = 0
-                idx = 0
+        write(assembler.finish())
 
-            if self.channels_first:
-                scene[:, row:row + patch_size, col:col + patch_size] = patch
-            else:
-                scene[row:row + patch_size, col:col + patch_size, :] = patch
+        if scene is None:
+            return None
 
-            col += self.format['shift']
-            idx += 1
+        if not self.channels_first:
+            scene = np.moveaxis(scene, 0, -1)
 
         return scene.squeeze()
 
-    def save_scene(self, path, dtype=gdal.GDT_Float32):
-        scene = self.assembly_patches()
+    def assembly_grid(self):
+        # patches by row, patches by column, size and shift of the patches
+        if self.format['patches_per_row'] is None:
+            patches_by_row = int(math.sqrt(len(self)))
+        else:
+            patches_by_row = self.format['patches_per_row']
+
+        patches_by_column = int(len(self)/patches_by_row)
+
+        size = self.patch_width
+        shift = self.format['shift'] if self.format.get('shift') else size
+
+        return patches_by_row, patches_by_column, size, shift
+
+    @property
+    def assembly_shape(self):
+        patches_by_row, patches_by_column, size, shift = self.assembly_grid()
+        return (patches_by_column - 1) * shift + size, (patches_by_row - 1) * shift + size
+
+    def save_scene(self, path, dtype=gdal.GDT_Float32, **options):
+        # The scene is assembled and written row by row, so it is never held in memory.
+        # The options are passed to WNRasterWriter. Returns the path
+        if len(self) == 0:
+            print(f'No patches to save')
+            return
+
+        rows, cols = self.assembly_shape
+        print('Saving image: ' + str(path))
 
-        array2raster(str(path), scene, self.geo_transform, self.projection, nodatavalue=0, dtype=dtype)
+        with WNRasterWriter(str(path), rows, cols, self.num_channels, self.geo_transform, self.projection,
+                            dtype=dtype, nodatavalue=0, **options) as writer:
+            self.assembly_patches(on_rows=lambda first_row, chunk: writer.write(chunk, 0, first_row))
 
-        return scene
+        return path
 
     def get_patch_path(self, item):
         if item < len(self.path_patches_):
@@ -845,10 +3542,17 @@ class WNPatchProcessor:
         if self.img is not None:
             self.img.clear()
 
+        self.clear_patches()
+
+    def clear_patches(self):
         for patch in self.patches_:
             patch = None
 
         self.patches_ = []
+        self.view_ = None
+        self.stats_ = None
+        self.valid_ = None
+        self.grid_items_, self.missing_ = None, None
 
     def patch_as_pil(self, idx):
         patch = self[idx]
@@ -861,58 +3565,445 @@ class WNPatchProcessor:
 
         return pi
 
+    @property
+    def in_memory(self):
+        if self.view_ is not None:
+            return self.view_.shape[0] * self.view_.shape[1]
+        return len(self.patches_)
+
     def __len__(self):
-        length = len(self.patches_) if len(self.patches_) > 0 else len(self.path_patches_)
-        return length
+        if self.in_memory > 0:
+            return self.in_memory
+        if self.grid_items_ is not None:
+            return len(self.grid_items_)
+        return len(self.shards_) if self.shards_ is not None else len(self.path_patches_)
 
     def __getitem__(self, item):
         # First check if the item is in the range
         if item < len(self):
             # Check if the patches are in memory
-            if item < len(self.patches_):
-                return self.patches_[item]
-            # otherwise, load from disk
+            if self.view_ is not None:
+                cols = self.view_.shape[1]
+                return np.squeeze(self.view_[item // cols, item % cols])
+            elif item < len(self.patches_):
+                return self.dequantize(self.patches_[item])
+
+            # otherwise, load from disk (through the cache, if there is one, that keeps the quantized patches)
+            stored = self.stored_item(item)
+            if stored < 0:
+                return self.missing_patch()
+            elif self.cache is not None:
+                return self.dequantize(self.cache.get(self.patch_key(stored), lambda: self.read_patch(stored)))
             else:
-                item_path = Path(self.path_patches_[item])
-                if item_path.suffix == '.npy':
-                    return np.load(self.path_patches_[item])
-                elif item_path.suffix == '.png':
-                    return plt.imread(self.path_patches_[item])
+                return self.dequantize(self.read_patch(stored))
         else:
             print(f'Patch {item} not found')
             return None
 
+    def dequantize(self, patch):
+        if self.quant_ is None or patch.dtype != self.quant_.dtype:
+            return patch
+        return self.quant_.dequantize(patch, bool(self.format.get('channels_first')))
+
+    def patch_key(self, item):
+        return self.shards_.key(item) if self.shards_ is not None else self.path_patches_[item]
+
+    def read_patch(self, item):
+        if self.shards_ is not None:
+            return self.shards_.get(item, copy=self.mmap_mode is None)
+
+        item_path = Path(self.path_patches_[item])
+        if item_path.suffix == '.npy':
+            return np.load(self.path_patches_[item], mmap_mode=self.mmap_mode)
+        elif item_path.suffix == '.png':
+            return plt.imread(self.path_patches_[item])
+
     def __repr__(self):
-        s = f'Patch Processors with {len(self)} patches and {len(self.patches_)} in memory patches \n'
+        s = f'Patch Processors with {len(self)} patches and {self.in_memory} in memory patches \n'
         s += f'Source image:\n{str(self.img) if self.img is not None else "None"}'
         return  s
 
     def __iter__(self):
+        if self.view_ is not None or self.quant_ is not None:
+            return (self[i] for i in range(len(self)))
         return iter(self.patches_)
 
     def __del__(self):
         self.clear()
 
 
+####################################################################################
+class WNPatchAssembler:
+    """
+    Assembles a grid of (possibly overlapping) patches, one row of patches at a time. Overlaps are accumulated in a
+    sum-and-weight buffer that holds just one patch height, and the rows that no further patch can touch are
+    returned as soon as they are finished, as (first_row, array (C, n_rows, width)) chunks.
+    """
+
+    def __init__(self, patches_per_row, size, shift, channels=1, dtype='float32', feather=False, fill=0):
+        self.patches_per_row, self.size, self.shift = patches_per_row, size, shift
+        self.channels, self.dtype, self.fill = channels, np.dtype(dtype), fill
+
+        self.width = (patches_per_row - 1) * shift + size
+
+        # the sums are accumulated at least in the compute dtype, and the finished rows are returned in dtype
+        acc_dtype = np.promote_types(self.dtype, dtype_policy.accumulator)
+        self.kernel = self.feather_kernel(size, acc_dtype) if feather else np.ones((size, size), dtype=acc_dtype)
+
+        self.sum_ = np.zeros((channels, size, self.width), dtype=acc_dtype)
+        self.weight_ = np.zeros((size, self.width), dtype=acc_dtype)
+
+        # scene row of the first buffer row and number of rows of patches already added
+        self.top_, self.row_ = 0, 0
+
+    @staticmethod
+    def feather_kernel(size, dtype='float32'):
+        # weights decrease linearly towards the borders of the patch
+        ramp = np.minimum(np.arange(1, size + 1), np.arange(size, 0, -1)).astype(dtype)
+        ramp /= ramp.max()
+        return np.outer(ramp, ramp)
+
+    def normalize(self, rows):
+        out = np.full((self.channels, rows, self.width), self.fill, dtype=self.dtype)
+        np.divide(self.sum_[:, :rows], self.weight_[:rows], out=out, where=self.weight_[:rows] > 0)
+        return out
+
+    def advance(self, first_row):
+        # releases the rows before first_row, that are already finished
+        chunks = []
+        distance = first_row - self.top_
+        if distance <= 0:
+            return chunks
+
+        rows = min(distance, self.size)
+        chunks.append((self.top_, self.normalize(rows)))
+
+        # gaps not covered by any patch (shift > size)
+        if distance > self.size:
+            chunks.append((self.top_ + self.size,
+                           np.full((self.channels, distance - self.size, self.width), self.fill, dtype=self.dtype)))
+
+        # move the pending rows to the top of the buffer
+        self.sum_[:, :self.size - rows] = self.sum_[:, rows:]
+        self.sum_[:, self.size - rows:] = 0
+        self.weight_[:self.size - rows] = self.weight_[rows:]
+        self.weight_[self.size - rows:] = 0
+
+        self.top_ = first_row
+        return chunks
+
+    def add_row(self, patches, valid=None):
+        # patches is a (patches_per_row, C, size, size) array with the next row of patches. The patches not in the
+        # valid mask (patches_per_row,) are not accumulated, and the pixels no valid patch covers get the fill value.
+        # patches can be None if no patch in the row is valid
+        chunks = self.advance(self.row_ * self.shift)
+
+        if patches is None or (valid is not None and not valid.any()):
+            self.row_ += 1
+            return chunks
+
+        # patches that are at least `step` columns apart do not overlap, so each group is accumulated
+        # at once through a strided view of the buffer
+        step = math.ceil(self.size / self.shift)
+        s_c, s_h, s_w = self.sum_.strides
+        w_h, w_w = self.weight_.strides
+
+        for first in range(min(step, self.patches_per_row)):
+            group = patches[first::step]
+            n = group.shape[0]
+            offset = first * self.shift
+
+            sum_view = np.lib.stride_tricks.as_strided(self.sum_[:, :, offset:],
+                                                       shape=(n, self.channels, self.size, self.size),
+                                                       strides=(s_w * step * self.shift, s_c, s_h, s_w))
+            weight_view = np.lib.stride_tricks.as_strided(self.weight_[:, offset:],
+                                                          shape=(n, self.size, self.size),
+                                                          strides=(w_w * step * self.shift, w_h, w_w))
+
+            if valid is None:
+                sum_view += group * self.kernel
+                weight_view += self.kernel
+            else:
+                group_valid = valid[first::step].astype(self.kernel.dtype)
+                sum_view += group * (self.kernel * group_valid[:, None, None, None])
+                weight_view += self.kernel * group_valid[:, None, None]
+
+        self.row_ += 1
+        return chunks
+
+    def finish(self, height=None):
+        # releases the remaining rows. If height is bigger than the patches coverage, the rest is filled
+        last_row = (self.row_ - 1) * self.shift + self.size if self.row_ > 0 else 0
+        height = last_row if height is None else height
+
+        chunks = []
+        rows = max(0, min(last_row, height) - self.top_)
+        if rows > 0:
+            chunks.append((self.top_, self.normalize(rows)))
+
+        if height > self.top_ + rows:
+            chunks.append((self.top_ + rows,
+                           np.full((self.channels, height - self.top_ - rows, self.width), self.fill, dtype=self.dtype)))
+
+        self.sum_[:] = 0
+        self.weight_[:] = 0
+        self.top_, self.row_ = height, 0
+        return chunks
+
+
+####################################################################################
+class WNPredictor:
+    """
+    Batched inference engine. Stacks the patches in batches of bs, runs the model on its own device (CPU or GPU)
+    with no autograd, and returns the masks and the probabilities as contiguous numpy arrays.
+    """
+
+    def __init__(self, model, bs=32, device=None, transform=None, activation=None):
+        self.model, self.bs, self.transform = model, bs, transform
+
+        self.device = torch.device(device) if device is not None else self.model_device(model)
+        self.model.to(self.device)
+
+        self.activation = (lambda out: torch.softmax(out, dim=1)) if activation is None else activation
+
+    @staticmethod
+    def model_device(model):
+        param = next(model.parameters(), None)
+        return param.device if param is not None else torch.device('cpu')
+
+    @staticmethod
+    def no_grad():
+        # inference_mode is cheaper than no_grad, but it is only available in newer torch versions
+        return torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+
+    def predict_batch(self, batch):
+        # batch is a (B, C, H, W) array or tensor
+        if isinstance(batch, np.ndarray):
+            batch = torch.from_numpy(np.ascontiguousarray(batch, dtype=np.float32))
+
+        x = batch.to(self.device, dtype=torch.float32, non_blocking=True)
+
+        self.model.eval()
+        with self.no_grad():
+            if self.transform is not None:
+                x = self.transform(x)
+
+            probs = self.activation(self.model(x))
+            masks = probs.argmax(dim=1).to(torch.uint8)
+
+        return masks.cpu().numpy(), probs.float().cpu().numpy()
+
+    def iter_predict(self, batches):
+        for batch in batches:
+            yield self.predict_batch(batch)
+
+    def predict(self, batches, n=None):
+        # if n (total number of items) is known, the results are written in preallocated arrays
+        if n is None:
+            results = list(self.iter_predict(batches))
+            if len(results) == 0:
+                return None, None
+            return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+        masks, probs, pos = None, None, 0
+        for batch_masks, batch_probs in self.iter_predict(batches):
+            if masks is None:
+                masks = np.empty((n,) + batch_masks.shape[1:], dtype=batch_masks.dtype)
+                probs = np.empty((n,) + batch_probs.shape[1:], dtype=batch_probs.dtype)
+
+            masks[pos:pos + len(batch_masks)] = batch_masks
+            probs[pos:pos + len(batch_probs)] = batch_probs
+            pos += len(batch_masks)
+
+        return masks, probs
+
+    def iter_proc_batches(self, proc, idxs=None):
+        # idxs restricts the batches to some patches
+        batches = proc.iter_batches(self.bs) if idxs is None else \
+            (proc.take(idxs[i:i + self.bs]) for i in range(0, len(idxs), self.bs))
+
+        for batch in batches:
+            yield batch if proc.channels_first else np.moveaxis(batch, -1, 1)
+
+    def predict_proc(self, proc):
+        if proc.valid_ is None:
+            return self.predict(self.iter_proc_batches(proc), len(proc))
+
+        # only the valid patches are predicted. The others get mask and probabilities 0
+        idxs = np.flatnonzero(proc.valid_)
+        masks, probs = self.predict(self.iter_proc_batches(proc, idxs), len(idxs))
+        return self.scatter(masks, idxs, len(proc)), self.scatter(probs, idxs, len(proc))
+
+    @staticmethod
+    def scatter(values, idxs, n):
+        # values of the items idxs in an array of n items, with zeros for the others
+        if values is None:
+            return None
+        result = np.zeros((n,) + values.shape[1:], dtype=values.dtype)
+        result[idxs] = values
+        return result
+
+
+####################################################################################
+class WNTelemetry:
+    """
+    Structured telemetry of the training, the patches creation and the inference. Each event is a dict with the
+    event name, the wall time and its fields (durations in seconds, memory in Mb). The events are kept in memory,
+    appended as JSON lines to path (if given) and passed to each callback(event).
+    """
+
+    def __init__(self, path=None, callbacks=None, keep=True):
+        self.path = Path(path) if path is not None else None
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.keep = keep
+
+        self.events = []
+        self.file_ = None
+        self.lock_ = threading.Lock()
+
+    def emit(self, event, **fields):
+        record = {'event': event, 'time': time.time()}
+        record.update(fields)
+
+        with self.lock_:
+            if self.keep:
+                self.events.append(record)
+
+            if self.path is not None:
+                if self.file_ is None:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    self.file_ = open(self.path, 'a')
+                self.file_.write(json.dumps(record, default=float) + '\n')
+                self.file_.flush()
+
+        for callback in self.callbacks:
+            callback(record)
+
+        return record
+
+    @contextmanager
+    def span(self, event, **fields):
+        # times the block and emits the event with its duration (seconds). The block can add fields to the yielded dict
+        start = time.perf_counter()
+        yield fields
+        fields['seconds'] = time.perf_counter() - start
+        self.emit(event, **fields)
+
+    def select(self, event):
+        return [record for record in self.events if record['event'] == event]
+
+    def summary(self, event):
+        # count, totals and means of the numeric fields of the kept events
+        records = self.select(event)
+        fields = [k for k, v in (records[0].items() if records else []) if isinstance(v, (int, float)) and k != 'time']
+
+        total = {field: sum(r.get(field, 0) for r in records) for field in fields}
+        return {'count': len(records), 'total': total,
+                'mean': {field: value / len(records) for field, value in total.items()}}
+
+    @staticmethod
+    def sync(device):
+        # waits for the device, so the measured times include the asynchronous (cuda) work
+        if device is not None and torch.device(device).type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    @staticmethod
+    def peak_memory(device=None):
+        # peak memory in Mb: allocated by torch for cuda devices, otherwise the peak resident memory of the process
+        if device is not None and torch.device(device).type == 'cuda':
+            return torch.cuda.max_memory_allocated(device) / 2**20
+
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def close(self):
+        with self.lock_:
+            if self.file_ is not None:
+                self.file_.close()
+                self.file_ = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f'WNTelemetry with {len(self.events)} events' + (f' at {self.path}' if self.path is not None else '')
+
+
+####################################################################################
+class WNResumableSampler(torch.utils.data.Sampler):
+    """
+    Sampler whose order can be checkpointed. Each epoch draws its order from the base sampler (random, weighted or
+    sequential) and keeps it until the epoch ends, so an interrupted epoch is resumed with the same order from a
+    sample offset, without loading the samples already trained.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.order_, self.start_ = None, 0
+
+    def __iter__(self):
+        if self.order_ is None:
+            self.order_ = torch.as_tensor(list(self.base), dtype=torch.int64)
+
+        start, self.start_ = self.start_, 0
+        for idx in self.order_[start:].tolist():
+            yield idx
+
+        # the next epoch draws a new order
+        self.order_ = None
+
+    def __len__(self):
+        # always the whole epoch, so the steps keep their numbers when resuming
+        return len(self.base)
+
+    def state_dict(self):
+        return {'order': self.order_}
+
+    def load_state_dict(self, state, start=0):
+        # start is the offset (in samples) of the first sample of the resumed epoch
+        self.order_ = state.get('order')
+        self.start_ = start if self.order_ is not None else 0
+
+
 ####################################################################################
 class WNDataset(torch.utils.data.Dataset):
-    def __init__(self, imgs=None, lbls=None, cuda=True, path=None):
+    def __init__(self, imgs=None, lbls=None, cuda=True, path=None, mmap_mode=None, cache_bytes=None, min_valid=None,
+                 min_water=None):
+        # if cache_bytes is given, images and labels share a WNPatchCache with that budget.
+        # min_valid and min_water filter the patches by their statistics (see WNDataset.filter)
         super().__init__()
 
         self.imgs, self.lbls = None, None
         self.path_ = path
+        self.cache = WNPatchCache(cache_bytes) if cache_bytes is not None else None
+
+        # indices of the selected patches (None for all of them) and the patches statistics
+        self.items_, self.stats_ = None, None
 
         if path is None:
             self.set_attr('imgs', imgs)
             self.set_attr('lbls', lbls)
         else:
-            self.imgs = WNPatchProcessor(patches_path=path/'Images')
-            self.lbls = WNPatchProcessor(patches_path=path/'Labels')
+            self.imgs = WNPatchProcessor(patches_path=path/'Images', mmap_mode=mmap_mode, cache=self.cache)
+            self.lbls = WNPatchProcessor(patches_path=path/'Labels', mmap_mode=mmap_mode, cache=self.cache)
+
+        if self.cache is not None:
+            self.set_cache(self.cache)
+
+        # the patches not saved (fully invalid, see create_patches) are not items of the dataset
+        if self.imgs is not None and self.imgs.valid_ is not None:
+            self.select(np.flatnonzero(self.imgs.valid_))
 
         self.cuda = cuda
 
         self.train_dl, self.valid_dl = None, None
 
+        if min_valid is not None or min_water is not None:
+            self.select(self.filter(min_valid=min_valid, min_water=min_water))
+
     @property
     def path(self):
         return self.path_
@@ -921,7 +4012,57 @@ class WNDataset(torch.utils.data.Dataset):
     def has_labels(self):
         return self.lbls is not None
 
+    @property
+    def stats(self):
+        # statistics of all the patches: valid fraction and band min/max from the images, water fraction
+        # from the labels
+        if self.stats_ is None:
+            stats = WNPatchStats.of(self.imgs)
+            stats['water'] = WNPatchStats.of(self.lbls)['water'] if self.has_labels else np.zeros_like(stats['valid'])
+            self.stats_ = stats
+
+        return self.stats_
+
+    def filter(self, min_valid=None, min_water=None, max_water=None):
+        # returns the indices of the patches that satisfy the conditions (fractions from 0 to 1)
+        keep = np.ones(len(self.imgs), dtype=bool) if self.imgs.valid_ is None else self.imgs.valid_.copy()
+
+        if min_valid is not None:
+            keep &= self.stats['valid'] >= min_valid
+        if min_water is not None:
+            keep &= self.stats['water'] >= min_water
+        if max_water is not None:
+            keep &= self.stats['water'] <= max_water
+
+        return np.flatnonzero(keep)
+
+    def select(self, idxs):
+        # restricts the dataset to the given patches indices (None selects all of them)
+        self.items_ = None if idxs is None else np.asarray(idxs, dtype=np.int64)
+
+    def item_idx(self, item):
+        return item if self.items_ is None else int(self.items_[item])
+
+    def sample_weights(self, water_weight=1., min_valid=0.):
+        # sampling weights of the selected patches, proportional to the valid fraction and increased by the
+        # water fraction. Patches with less than min_valid valid pixels are never sampled
+        items = slice(None) if self.items_ is None else self.items_
+        valid, water = self.stats['valid'][items], self.stats['water'][items]
+
+        weights = valid * (1 + water_weight * water)
+        weights[valid < min_valid] = 0
+
+        return weights.astype('float64')
+
+    def sampler(self, weights=None, num_samples=None, replacement=True):
+        weights = self.sample_weights() if weights is None else weights
+        num_samples = len(weights) if num_samples is None else num_samples
+
+        return torch.utils.data.WeightedRandomSampler(torch.as_tensor(weights, dtype=torch.float64), num_samples,
+                                                      replacement=replacement)
+
     def show_item(self, idx, bright=1., ax=None, size=4):
+        idx = self.item_idx(idx)
         columns = 2 if self.has_labels else 1
         if ax is None:
             fig, ax = plt.subplots(1, columns, figsize=(size*columns, size))
@@ -952,34 +4093,166 @@ class WNDataset(torch.utils.data.Dataset):
         else:
             setattr(self, name, None)
 
+    def set_cache(self, cache):
+        # the same cache is used by the images and the labels, in training and in inference
+        self.cache = cache
+        for proc in [self.imgs, self.lbls]:
+            if isinstance(proc, WNPatchProcessor):
+                proc.cache = cache
+
     # def set_data(self, imgs, lbls=None):
     #     self.data.set_data(imgs, lbls)
 
-    def create_data_loaders(self, bs, shuffle=True, valid_size=0):
-        train_ds, valid_ds = torch.utils.data.random_split(self, (len(self)-valid_size, valid_size))
-        self.train_dl = torch.utils.data.DataLoader(train_ds, batch_size=bs, shuffle=shuffle)
-        self.valid_dl = torch.utils.data.DataLoader(valid_ds, batch_size=bs, shuffle=shuffle)
+    @property
+    def device(self):
+        # device where the batches are sent by the learner
+        return torch.device('cuda' if self.cuda and torch.cuda.is_available() else 'cpu')
+
+    def create_data_loaders(self, bs, shuffle=True, valid_size=0, num_workers=0, pin_memory=None, prefetch_factor=2,
+                            persistent_workers=False, weights=None, seed=None):
+        # The items are collated and normalized once per batch (WNDataset.collate), on the CPU, so the loading
+        # can run in worker processes. pin_memory defaults to True when the batches go to a GPU.
+        # If weights are given (one per item, or True for sample_weights()), the training patches are drawn with
+        # a WeightedRandomSampler instead of shuffled. The training order is drawn by a WNResumableSampler, so it is
+        # saved in the checkpoints of WNLearner. seed makes the train/valid split reproducible (needed to resume in
+        # another process)
+        pin_memory = self.device.type == 'cuda' if pin_memory is None else pin_memory
+
+        kwargs = {'batch_size': bs, 'shuffle': shuffle, 'collate_fn': self.collate, 'num_workers': num_workers,
+                  'pin_memory': pin_memory}
+
+        # these options are only accepted with worker processes
+        if num_workers > 0:
+            kwargs.update({'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers})
+
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        train_ds, valid_ds = torch.utils.data.random_split(self, (len(self)-valid_size, valid_size),
+                                                           **({} if generator is None else {'generator': generator}))
+
+        if weights is not None:
+            weights = self.sample_weights() if weights is True else np.asarray(weights)
+            base = self.sampler(weights[train_ds.indices])
+        elif shuffle:
+            base = torch.utils.data.RandomSampler(train_ds)
+        else:
+            base = torch.utils.data.SequentialSampler(train_ds)
+
+        train_kwargs = dict(kwargs, shuffle=False, sampler=WNResumableSampler(base))
+
+        self.train_dl = torch.utils.data.DataLoader(train_ds, **train_kwargs)
+        self.valid_dl = torch.utils.data.DataLoader(valid_ds, **dict(kwargs, shuffle=False))
+
+    @staticmethod
+    def collate(batch):
+        # stacks the items and normalizes the whole batch at once. Returns CPU tensors
+        x = torch.from_numpy(np.stack([item[0] for item in batch])).float()
+        x.add_(1).div_(2)
+
+        if isinstance(batch[0][1], np.ndarray):
+            y = torch.from_numpy(np.stack([item[1] for item in batch])).long()
+        else:
+            y = torch.zeros(len(batch), dtype=torch.int64)
+
+        return x, y
 
     def __len__(self):
-        return len(self.imgs)
+        return len(self.imgs) if self.items_ is None else len(self.items_)
 
     def __getitem__(self, item):
-        x = (self.imgs[item] + 1) / 2
-        y = (self.lbls[item] == 1).astype(int) if self.has_labels else 0
+        # returns compact numpy arrays, as stored. The normalization and the conversion to tensors are done
+        # per batch, by collate
+        item = self.item_idx(item)
+        x = self.imgs[item]
+        y = (self.lbls[item] == 1).astype(np.uint8) if self.has_labels else 0
         # y = (self.lbls[item] + 1) / 2 if self.has_labels else 0
 
-        if self.cuda:
-            return torch.tensor(x, dtype=torch.float32).cuda(), torch.tensor(y, dtype=torch.int64).cuda()
-        else:
-            return torch.tensor(x, dtype=torch.float32), torch.tensor(y, dtype=torch.int64)
+        return x, y
 
     def __repr__(self):
         s = f'WNDataset with {len(self)} items. Labels={self.has_labels}'
         return s
 
 
+####################################################################################
+class WNCheckpointWriter:
+    """
+    Writes checkpoints in a background thread, so the training does not wait for the disk. The state is copied to the
+    CPU (snapshot) before being queued, and each file is written to a temporary name and renamed, so a checkpoint is
+    either complete or absent. With keep, only the last `keep` checkpoints with the given prefix are retained.
+    At most `pending` checkpoints wait to be written; beyond that, save blocks until the writer catches up.
+    """
+
+    def __init__(self, keep=None, prefix='auto_', pending=1):
+        self.keep, self.prefix = keep, prefix
+
+        self.queue_ = queue.Queue(maxsize=pending)
+        self.error_ = None
+        self.thread_ = threading.Thread(target=self.worker, daemon=True)
+        self.thread_.start()
+
+    @staticmethod
+    def snapshot(obj):
+        # copies the tensors of a (nested) state dict to the CPU
+        if isinstance(obj, torch.Tensor):
+            return obj.detach().to('cpu', copy=True)
+        elif isinstance(obj, dict):
+            return type(obj)((key, WNCheckpointWriter.snapshot(value)) for key, value in obj.items())
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(WNCheckpointWriter.snapshot(value) for value in obj)
+        return obj
+
+    def worker(self):
+        while True:
+            item = self.queue_.get()
+            try:
+                if item is None:
+                    return
+
+                path, state = item
+                tmp_path = path.with_suffix('.tmp')
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+
+                if self.keep is not None and path.name.startswith(self.prefix):
+                    self.apply_retention(path.parent)
+
+            except Exception as e:
+                self.error_ = e
+            finally:
+                self.queue_.task_done()
+
+    def apply_retention(self, path):
+        # the automatic checkpoints names are ordered by epoch and step
+        checkpoints = sorted(path.glob(f'{self.prefix}*.pth'))
+        for checkpoint in checkpoints[:max(len(checkpoints) - self.keep, 0)]:
+            checkpoint.unlink()
+
+    def check(self):
+        if self.error_ is not None:
+            error, self.error_ = self.error_, None
+            raise error
+
+    def save(self, path, state):
+        self.check()
+        self.queue_.put((Path(path), self.snapshot(state)))
+
+    def wait(self):
+        # blocks until all the queued checkpoints are written
+        self.queue_.join()
+        self.check()
+
+    def close(self):
+        if self.thread_.is_alive():
+            self.queue_.put(None)
+            self.thread_.join()
+        self.check()
+
+
 ####################################################################################
 class WNLearner:
+    # prefix of the automatic checkpoints (see train)
+    checkpoint_prefix = 'auto_'
+
     def __init__(self, dataset, model):
         self.dataset, self.model = dataset, model
         self.loss_fn = torch.nn.CrossEntropyLoss()
@@ -987,17 +4260,68 @@ class WNLearner:
         self.losses, self.accuracies = ([], []), ([], [])
         self.checkpoints = []
 
-    def train(self, lr=0.0001, epochs=1, new_model=None, show_each=10):
-
-        self.model = self.model if new_model is None else new_model
-        self.model.cuda()
-        opt = torch.optim.Adam(self.model.parameters(), lr=lr)
+        # device of the last training (see train)
+        self.device = None
+
+        # the optimizer is kept between trainings. The optimizer state loaded from a checkpoint before the optimizer
+        # exists is applied when it is created
+        self.opt, self.opt_state_ = None, None
+
+        # gradient scaler of the last training (fp16), and the states loaded from a checkpoint, applied when training
+        self.scaler_, self.scaler_state_, self.sampler_state_ = None, None, None
+
+        # completed epochs and training steps done in the current epoch
+        self.epoch, self.step = 0, 0
+
+        self.checkpoint_writer_ = None
+
+    def train(self, lr=0.0001, epochs=1, new_model=None, show_each=10, device=None, amp=False, amp_dtype=None,
+              accumulate=1, compile=False, telemetry=None, resume=None, checkpoint_every=None, keep_checkpoints=3):
+        # device defaults to the dataset device (cuda if available). With amp=True the forward pass runs under
+        # autocast, in amp_dtype (default bfloat16 on CPU and float16 on cuda, with gradient scaling).
+        # accumulate is the number of batches whose gradients are accumulated before each optimizer step.
+        # compile=True runs the model through torch.compile (if available).
+        # The metrics are accumulated detached, on the device, and only synchronized every show_each steps.
+        # telemetry (WNTelemetry) receives a 'train_step' event per step, with the time waiting for the data, the
+        # compute (forward/backward) and optimizer times, samples/s and peak memory, and an 'epoch' event per phase.
+        # The steps are timed with device synchronizations, so they are only measured when telemetry is given.
+        # The optimizer (and its state) is kept between calls. With checkpoint_every (optimizer steps), the model,
+        # optimizer, gradient scaler, training order, epoch and step are checkpointed in the background every
+        # checkpoint_every optimizer steps and at the end of each epoch, keeping the last keep_checkpoints of them.
+        # resume (checkpoint name, index, path or True for the last automatic checkpoint) restores a checkpoint before
+        # training. The interrupted epoch goes on with its order, from the first sample not trained (with a
+        # WNResumableSampler, see WNDataset.create_data_loaders). epochs is always the number of epochs trained by
+        # this call, from the current (or restored) epoch: the interrupted epoch, when resuming, counts as one of
+        # them. To finish a run of N epochs interrupted at epoch e, resume with epochs=N - e.
+
+        if new_model is not None:
+            self.model, self.opt = new_model, None
+
+        if resume is not None:
+            self.load_checkpoint(self.last_checkpoint() if resume is True else resume)
+
+        first_epoch, last_epoch = self.epoch, self.epoch + epochs
+
+        self.device = torch.device(device) if device is not None else self.dataset.device
+        self.model.to(self.device)
+        opt = self.optimizer(lr)
+
+        if amp_dtype is None:
+            amp_dtype = torch.bfloat16 if self.device.type == 'cpu' else torch.float16
+        scaling = amp and amp_dtype == torch.float16 and self.device.type == 'cuda'
+        scaler = torch.amp.GradScaler('cuda', enabled=scaling) if hasattr(torch.amp, 'GradScaler') else \
+            torch.cuda.amp.GradScaler(enabled=scaling)
+        if scaling and self.scaler_state_:
+            scaler.load_state_dict(self.scaler_state_)
+        self.scaler_, self.scaler_state_ = scaler, None
+
+        model = torch.compile(self.model) if compile and hasattr(torch, 'compile') else self.model
 
         # Start the training loop
         start = time.time()
 
-        for epoch in range(epochs):
-            print('Epoch {}/{}'.format(epoch, epochs - 1))
+        for epoch in range(first_epoch, last_epoch):
+            print('Epoch {}/{}'.format(epoch, last_epoch - 1))
             print('-' * 10)
 
             for phase_value, phase in enumerate(['train', 'valid']):
@@ -1008,58 +4332,149 @@ class WNLearner:
                     self.model.train(False)  # Set model to evaluate mode
                     data_loader = self.dataset.valid_dl
 
+                if data_loader is None or len(data_loader.dataset) == 0:
+                    continue
+
                 # init variables
-                running_loss = 0.0
-                running_acc = 0.0
-                step = 0
+                running_loss = torch.zeros((), device=self.device)
+                running_acc = torch.zeros((), device=self.device)
+                samples = 0
+
+                opt.zero_grad(set_to_none=True)
+                phase_start = t_data = time.perf_counter()
+
+                # when resuming, the steps already done in this epoch are skipped. The resumable sampler starts after
+                # their samples, in the saved order; other samplers skip the batches
+                first_step = self.step if phase == 'train' else 0
+                sampler = getattr(data_loader, 'sampler', None)
+                if phase == 'train' and isinstance(sampler, WNResumableSampler):
+                    # the order of a checkpoint, or the one of the epoch interrupted in this process
+                    if first_step > 0:
+                        state = self.sampler_state_ if self.sampler_state_ is not None else sampler.state_dict()
+                        sampler.load_state_dict(state, first_step * data_loader.batch_size)
+                    self.sampler_state_ = None
+                    batches = enumerate(data_loader, first_step) if sampler.start_ > 0 else \
+                        itertools.islice(enumerate(data_loader), first_step, None)
+                else:
+                    batches = itertools.islice(enumerate(data_loader), first_step, None)
+
+                # optimizer steps of the epoch
+                updates = first_step // accumulate
 
                 # iterate over data
-                for step, (x, y) in enumerate(data_loader):
+                for step, (x, y) in batches:
+                    t_start = time.perf_counter()
+
+                    # one host to device copy per batch
+                    x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
 
                     if phase == 'train':
-                        # zero the gradients
-                        opt.zero_grad()
-                        outputs = self.model(x)
-                        loss = self.loss_fn(outputs, y)
+                        with torch.autocast(device_type=self.device.type, dtype=amp_dtype, enabled=amp):
+                            outputs = model(x)
+                            loss = self.loss_fn(outputs, y)
 
                         # the backward pass frees the graph memory, so there is no
                         # need for torch.no_grad in this training pass
-                        loss.backward()
-                        opt.step()
+                        scaler.scale(loss / accumulate).backward()
+
+                        if telemetry is not None:
+                            telemetry.sync(self.device)
+                        t_compute = time.perf_counter()
+
+                        if (step + 1) % accumulate == 0 or step + 1 == len(data_loader):
+                            scaler.step(opt)
+                            scaler.update()
+                            opt.zero_grad(set_to_none=True)
+
+                            self.step, updates = step + 1, updates + 1
+                            if checkpoint_every and updates % checkpoint_every == 0:
+                                self.save_checkpoint(self.checkpoint_name(epoch, self.step), keep=keep_checkpoints)
                         # scheduler.step()
                     else:
-                        with torch.no_grad():
-                            outputs = self.model(x)
-                            loss = self.loss_fn(outputs, y.long())
+                        with WNPredictor.no_grad(), \
+                                torch.autocast(device_type=self.device.type, dtype=amp_dtype, enabled=amp):
+                            outputs = model(x)
+                            loss = self.loss_fn(outputs, y)
+
+                        if telemetry is not None:
+                            telemetry.sync(self.device)
+                        t_compute = time.perf_counter()
 
                     # stats - whatever is the phase
-                    acc = self.accuracy(outputs, y)
+                    with torch.no_grad():
+                        acc = self.accuracy(outputs, y)
 
-                    running_acc  += acc*data_loader.batch_size
-                    running_loss += loss*data_loader.batch_size
+                        running_acc += acc * x.shape[0]
+                        running_loss += loss.detach() * x.shape[0]
+                        samples += x.shape[0]
 
-                    if step % show_each == 0:
-                        print('Current step: {}  Loss: {}  Acc: {}  AllocMem (Mb): {}'.format(step, loss, acc, torch.cuda.memory_allocated()/1024/1024))
+                    if show_each and step % show_each == 0:
+                        print('Current step: {}  Loss: {:.4f}  Acc: {:.4f}  AllocMem (Mb): {}'.format(
+                            step, loss.item(), acc.item(), self.memory_allocated(self.device)))
                         # print(torch.cuda.memory_summary())
 
-                epoch_loss = running_loss / len(data_loader.dataset)
-                epoch_acc = running_acc / len(data_loader.dataset)
+                    if telemetry is not None:
+                        telemetry.sync(self.device)
+                        t_end = time.perf_counter()
+                        telemetry.emit('train_step', phase=phase, epoch=epoch, step=step, samples=x.shape[0],
+                                       data_wait=t_start - t_data, compute=t_compute - t_start,
+                                       optimizer=t_end - t_compute, samples_per_s=x.shape[0] / (t_end - t_data),
+                                       peak_memory=telemetry.peak_memory(self.device))
+
+                    t_data = time.perf_counter()
+
+                epoch_loss = (running_loss / samples).item()
+                epoch_acc = (running_acc / samples).item()
+
+                if telemetry is not None:
+                    elapsed = time.perf_counter() - phase_start
+                    telemetry.emit('epoch', phase=phase, epoch=epoch, loss=epoch_loss, acc=epoch_acc, samples=samples,
+                                   seconds=elapsed, samples_per_s=samples / elapsed,
+                                   peak_memory=telemetry.peak_memory(self.device))
 
                 # print('Epoch {}/{}'.format(epoch, epochs - 1))
                 print('-' * 10)
-                print('{} Loss: {:.4f} Acc: {}  Time{:.0f}m {:.0f}s'
+                print('{} Loss: {:.4f} Acc: {:.4f}  Time{:.0f}m {:.0f}s'
                       .format(phase, epoch_loss, epoch_acc, (time.time() - start) // 60, (time.time() - start) % 60))
                 print('-' * 10)
 
                 self.losses[phase_value].append(epoch_loss)
                 self.accuracies[phase_value].append(epoch_acc)
 
+            self.epoch, self.step = epoch + 1, 0
+            if checkpoint_every:
+                self.save_checkpoint(self.checkpoint_name(self.epoch, 0), keep=keep_checkpoints)
+
+        if self.checkpoint_writer_ is not None:
+            self.checkpoint_writer_.wait()
+
         time_elapsed = time.time() - start
         print('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
 
+    def optimizer(self, lr):
+        # creates the optimizer (once per model) and applies the pending state loaded from a checkpoint
+        if self.opt is None:
+            self.opt = torch.optim.Adam(self.model.parameters(), lr=lr)
+
+        if self.opt_state_ is not None:
+            self.opt.load_state_dict(self.opt_state_)
+            self.opt_state_ = None
+
+        for group in self.opt.param_groups:
+            group['lr'] = lr
+
+        return self.opt
+
     @staticmethod
     def accuracy(pred_b, y_b):
-        return (pred_b.argmax(dim=1) == y_b.cuda()).float().mean()
+        return (pred_b.argmax(dim=1) == y_b).float().mean()
+
+    @staticmethod
+    def memory_allocated(device):
+        # allocated memory in Mb (only tracked for cuda devices)
+        if device.type == 'cuda':
+            return round(torch.cuda.memory_allocated(device) / 1024 / 1024)
+        return None
 
     @property
     def models_path(self):
@@ -1069,10 +4484,11 @@ class WNLearner:
         return model_path
 
     def predict_item(self, idx, dataset=None):
-        x, _ = self.dataset[idx] if dataset is None else dataset[idx]
+        dataset = self.dataset if dataset is None else dataset
+        x, _ = WNDataset.collate([dataset[idx]])
 
         with torch.no_grad():
-            probs = self.model(x.unsqueeze(0)).squeeze().cpu()
+            probs = self.model(x.to(WNPredictor.model_device(self.model))).squeeze().cpu()
         return torch.argmax(probs, axis=0).int(), probs
 
     def show_prediction(self, idx, bright=1.):
@@ -1103,24 +4519,87 @@ class WNLearner:
         ax[1].plot(self.accuracies[1], label='Valid Acc')
         ax[1].legend()
 
-    def save_checkpoint(self, name):
+    @classmethod
+    def checkpoint_name(cls, epoch, step):
+        return f'{cls.checkpoint_prefix}e{epoch:04d}_s{step:07d}'
+
+    def last_checkpoint(self):
+        # last automatic checkpoint in the models path
+        checkpoints = sorted(self.models_path.glob(f'{self.checkpoint_prefix}*.pth'))
+        if len(checkpoints) == 0:
+            raise FileNotFoundError(f'No checkpoints to resume in {self.models_path}')
+        return checkpoints[-1]
+
+    def save_checkpoint(self, name, blocking=False, keep=None):
+        # The model, optimizer, gradient scaler, training order, epoch, step and metrics are snapshotted to the CPU and
+        # written in a background thread.
+        # With blocking=True it waits for the write. keep is the number of automatic checkpoints retained
         checkpoint_name = (self.models_path/name).with_suffix('.pth')
         self.checkpoints.append(checkpoint_name)
-        torch.save(self.model.state_dict(), checkpoint_name)
+
+        if self.checkpoint_writer_ is None:
+            self.checkpoint_writer_ = WNCheckpointWriter(prefix=self.checkpoint_prefix)
+        self.checkpoint_writer_.keep = keep
+
+        scaler = self.scaler_.state_dict() if self.scaler_ is not None and self.scaler_.is_enabled() else None
+        sampler = getattr(getattr(self.dataset, 'train_dl', None), 'sampler', None)
+        sampler = sampler.state_dict() if isinstance(sampler, WNResumableSampler) else None
+
+        state = {'model': self.model.state_dict(),
+                 'optimizer': self.opt.state_dict() if self.opt is not None else self.opt_state_,
+                 'scaler': scaler if scaler is not None else self.scaler_state_,
+                 'sampler': sampler if sampler is not None else self.sampler_state_,
+                 'epoch': self.epoch, 'step': self.step, 'losses': self.losses, 'accuracies': self.accuracies}
+        self.checkpoint_writer_.save(checkpoint_name, state)
+
+        if blocking:
+            self.checkpoint_writer_.wait()
+
+        return checkpoint_name
 
     def load_checkpoint(self, checkpoint):
-        path = self.checkpoints[checkpoint] if type(checkpoint) == int else \
-            (self.models_path/checkpoint).with_suffix('.pth')
+        # checkpoint is an index in self.checkpoints, a name in the models path or a path.
+        # Checkpoints with only the model weights (older format) are also accepted
+        if type(checkpoint) == int:
+            path = self.checkpoints[checkpoint]
+        elif isinstance(checkpoint, Path):
+            path = checkpoint
+        else:
+            path = (self.models_path/checkpoint).with_suffix('.pth')
+
+        # the checkpoint may still be in the writer queue
+        if self.checkpoint_writer_ is not None:
+            self.checkpoint_writer_.wait()
+
         self.checkpoints.append(path)
         print(f'Loading weights at {path}')
-        self.model.load_state_dict(torch.load(path))
+        state = torch.load(path, map_location='cpu')
+
+        if 'model' not in state:
+            self.model.load_state_dict(state)
+            return
+
+        self.model.load_state_dict(state['model'])
+        self.epoch, self.step = state['epoch'], state['step']
+        self.losses, self.accuracies = state['losses'], state['accuracies']
+
+        # the gradient scaler and training order are restored when training
+        self.scaler_state_, self.sampler_state_ = state.get('scaler'), state.get('sampler')
+
+        # the optimizer state is loaded when the optimizer is created (see optimizer)
+        self.opt_state_ = state['optimizer']
+        if self.opt is not None and self.opt_state_ is not None:
+            self.opt.load_state_dict(self.opt_state_)
+            self.opt_state_ = None
+
+    def predict_data(self, dataset, bs=32):
+        # returns the predicted masks as a (N, H, W) array
+        data_loader = torch.utils.data.DataLoader(dataset, batch_size=bs, shuffle=False, collate_fn=WNDataset.collate)
+        predictor = WNPredictor(self.model, bs=bs)
 
-    def predict_data(self, dataset):
-        preds = []
-        for idx in range(len(dataset)):
-            preds.append(self.predict_item(idx, dataset)[0])
+        masks, _ = predictor.predict((x for x, _ in data_loader), len(dataset))
 
-        return preds
+        return masks
 
     def __repr__(self):
         s = f'Learner with {len(self.checkpoints)} checkpoint.\n'
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules are at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+def grid_patches(cube, size, shift):
+    rows = (cube.shape[1] - size) // shift + 1
+    cols = (cube.shape[2] - size) // shift + 1
+    patches = np.stack([cube[:, r * shift:r * shift + size, c * shift:c * shift + size]
+                        for r in range(rows) for c in range(cols)])
+    return patches, rows, cols
+
+
+def naive_assembly(patches, cols, size, shift, valid=None, fill=0):
+    rows = len(patches) // cols
+    sums = np.zeros((patches.shape[1], (rows - 1) * shift + size, (cols - 1) * shift + size))
+    weights = np.zeros(sums.shape[1:])
+    for i, patch in enumerate(patches):
+        if valid is not None and not valid[i]:
+            continue
+        r, c = divmod(i, cols)
+        sums[:, r * shift:r * shift + size, c * shift:c * shift + size] += patch
+        weights[r * shift:r * shift + size, c * shift:c * shift + size] += 1
+
+    return np.where(weights > 0, sums / np.maximum(weights, 1), fill)
+
+
+@pytest.mark.parametrize('size, shift', [(8, 4), (8, 3), (6, 6), (4, 6)])
+def test_assembly_is_the_average_of_the_overlaps(size, shift):
+    # the patches are noisy, so the overlaps do not average to the original cube
+    rng = np.random.default_rng(0)
+    patches, rows, cols = grid_patches(rng.random((2, 30, 26)), size, shift)
+    patches = (patches + rng.normal(0, 0.1, patches.shape)).astype('float32')
+
+    proc = WN.WNPatchProcessor.create_from_patches(patches, size, shift, patches_per_row=cols, channels_first=True)
+    scene = proc.assembly_patches(dtype='float64')
+
+    assert np.allclose(scene, naive_assembly(patches, cols, size, shift), atol=1e-6)
+
+
+def test_assembly_skips_the_invalid_patches():
+    rng = np.random.default_rng(1)
+    patches, rows, cols = grid_patches(rng.random((1, 28, 28)).astype('float32'), 8, 4)
+    valid = rng.random(len(patches)) > 0.4
+
+    proc = WN.WNPatchProcessor.create_from_patches(patches, 8, 4, patches_per_row=cols, channels_first=True)
+    proc.valid_ = valid
+    scene = proc.assembly_patches(dtype='float64', fill=-1)
+
+    assert np.allclose(scene, naive_assembly(patches, cols, 8, 4, valid, fill=-1)[0], atol=1e-6)
+
+
+def test_rows_are_streamed_in_order():
+    patches, rows, cols = grid_patches(np.random.default_rng(2).random((3, 40, 20)).astype('float32'), 8, 4)
+    proc = WN.WNPatchProcessor.create_from_patches(patches, 8, 4, patches_per_row=cols, channels_first=True)
+
+    chunks = []
+    assert proc.assembly_patches(on_rows=lambda first, rows: chunks.append((first, rows.copy()))) is None
+
+    # each chunk is released once no other patch can touch it, so the buffer never holds the whole scene
+    firsts = [first for first, _ in chunks]
+    assert firsts == sorted(firsts) and firsts[0] == 0
+    assert max(rows.shape[1] for _, rows in chunks) <= 8
+    assert np.array_equal(np.concatenate([rows for _, rows in chunks], axis=1), proc.assembly_patches())
+
+
+def test_feathered_assembly_keeps_constant_scenes():
+    patches, rows, cols = grid_patches(np.full((1, 20, 20), 3., dtype='float32'), 8, 4)
+    proc = WN.WNPatchProcessor.create_from_patches(patches, 8, 4, patches_per_row=cols, channels_first=True)
+
+    assert np.allclose(proc.assembly_patches(feather=True), 3.)
+
+
+def test_assembler_fills_the_gaps():
+    assembler = WN.WNPatchAssembler(2, 4, 6, fill=-1)
+    patches = np.ones((2, 1, 4, 4), dtype='float32')
+
+    chunks = assembler.add_row(patches) + assembler.add_row(patches) + assembler.finish(height=12)
+    scene = np.concatenate([rows for _, rows in chunks], axis=1)[0]
+
+    assert scene.shape == (12, 10)
+    assert (scene[4:6] == -1).all() and (scene[:, 4:6] == -1).all() and (scene[10:] == -1).all()
+    assert (scene[:4, :4] == 1).all() and (scene[6:10, 6:] == 1).all()
@@ -0,0 +1,44 @@
+import json
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('gdal')
+pytest.importorskip('osr')
+WN = pytest.importorskip('WNInputOutput')
+WNBenchmark = pytest.importorskip('WNBenchmark')
+
+
+def test_synthetic_product_is_a_theia_product(tmp_path):
+    product, label = WNBenchmark.create_theia_product(tmp_path, size=64, nodata_fraction=0.25)
+    WN.WNProductIndex.clear_cache()
+    img = WN.WNSatImage(product, verbose=False)
+
+    assert img.nodata == -1.
+    assert set(WNBenchmark.theia_10m_bands + WNBenchmark.theia_20m_bands) <= set(img.available_bands)
+    for band in ['B2', 'B11']:
+        array = img.get_raster(band)
+        assert array.shape == (64, 64)
+        assert (array[:, 48:] == -1).all() and (array[:, :48] > -1).all()
+
+    mask = WN.WNImage(label).get_raster(0)
+    assert mask.shape == (64, 64) and set(np.unique(mask)) == {0, 1}
+
+    # the water is darker in the SWIR
+    b11 = img.get_raster('B11')[:, :48]
+    assert b11[mask[:, :48] == 1].mean() < b11[mask[:, :48] == 0].mean()
+
+
+def test_benchmark_runs_all_the_stages(tmp_path):
+    bench = WNBenchmark.WNBenchmark(tmp_path, size=64, patch_size=16, shift=8, bands=['B2', 'B11'], repeat=1, bs=8)
+    report = bench.run()
+
+    assert [r['stage'] for r in report['results']] == WNBenchmark.WNBenchmark.stages
+    assert all(r['best'] > 0 and r['peak_memory'] >= 0 for r in report['results'])
+    assert {r['stage']: r['items'] for r in report['results']}['create_patches'] == 7 * 7
+    assert report['meta']['size'] == 64
+
+    fn = bench.save(tmp_path / 'results.json')
+    assert json.loads(fn.read_text())['results'] == json.loads(json.dumps(report['results']))
+    assert WNBenchmark.compare_results(fn, report) == {r['stage']: 1. for r in report['results']}
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+def open_img(path, cache):
+    img = WN.WNImage(path)
+    img.loaded_bands_ = WN.WNLoadedBands(cache)
+    return img
+
+
+@pytest.fixture
+def img(tmp_path):
+    array = np.random.default_rng(0).random((12, 10)).astype('float32')
+    WN.array2raster(str(tmp_path / 'img.tif'), array, (0., 10., 0., 120., 0., -10.), '')
+    return open_img(tmp_path / 'img.tif', WN.WNBandCache()), array
+
+
+@pytest.fixture
+def bands_path(tmp_path):
+    # 3 bands of 480 bytes
+    array = np.random.default_rng(0).random((3, 12, 10)).astype('float32')
+    WN.array2raster(str(tmp_path / 'bands.tif'), array, (0., 10., 0., 120., 0., -10.), '')
+    return tmp_path / 'bands.tif', array
+
+
+def test_is_loaded_is_not_counted(img):
+    img, array = img
+    cache = img.loaded_bands_.cache
+
+    assert not img.is_loaded(0)
+    img.load_bands([0])
+    hits, misses = cache.hits, cache.misses
+    for _ in range(3):
+        assert img.is_loaded(0)
+    assert (cache.hits, cache.misses) == (hits, misses)
+
+    assert np.allclose(img.get_raster(0), array)
+    assert (cache.hits, cache.misses) == (hits + 1, misses)
+
+
+def test_disk_cache_removes_the_partial_file(tmp_path):
+    cache = WN.WNDiskBandCache(tmp_path / 'cache')
+    array = np.arange(40, dtype='float32').reshape(10, 4)
+
+    def failing(first_row, n_rows):
+        return array[first_row:first_row + n_rows] if first_row == 0 else None
+
+    def raising(first_row, n_rows):
+        if first_row > 0:
+            raise OSError('read error')
+        return array[first_row:first_row + n_rows]
+
+    assert cache.create('a', array.shape, failing, 4) is None
+    with pytest.raises(OSError):
+        cache.create('b', array.shape, raising, 4)
+    assert list((tmp_path / 'cache').iterdir()) == []
+
+    assert np.array_equal(cache.create('c', array.shape, lambda first, n: array[first:first + n], 4), array)
+    assert [fn.name for fn in (tmp_path / 'cache').iterdir()] == ['c.npy']
+
+
+def test_band_cache_keeps_the_budget_across_images(bands_path):
+    path, array = bands_path
+    cache = WN.WNBandCache(max_bytes=2 * 480)
+    first, second = open_img(path, cache), open_img(path, cache)
+
+    first.load_bands([0, 1])
+    second.load_bands([2])
+
+    # the least recently used band is evicted, and read again when needed
+    assert cache.nbytes == 2 * 480 and cache.evictions == 1
+    assert not first.is_loaded(0) and first.is_loaded(1) and second.is_loaded(2)
+    assert np.array_equal(first.get_raster(0), array[0])
+    assert cache.stats['occupancy'] == 1.
+
+    first.clear()
+    assert first.loaded_bands_.keys() == [] and second.is_loaded(2)
+
+
+def test_pinned_bands_are_not_evicted(bands_path):
+    path, array = bands_path
+    cache = WN.WNBandCache(max_bytes=480)
+    img = open_img(path, cache)
+
+    with img.pinned([0]):
+        img.load_bands([0, 1])
+        assert img.is_loaded(0) and not img.is_loaded(1)
+
+    # once unpinned, the budget is enforced again
+    img.load_bands([2])
+    assert not img.is_loaded(0) and img.is_loaded(2) and cache.nbytes == 480
+
+
+def test_evicted_bands_spill_to_disk(bands_path, tmp_path):
+    path, array = bands_path
+    cache = WN.WNBandCache()
+    cache.configure(max_bytes=480, spill_path=tmp_path / 'spill')
+    img = open_img(path, cache)
+
+    img.load_bands([0, 1, 2])
+    assert cache.spills == 2 and len(list((tmp_path / 'spill').iterdir())) == 2
+
+    # the spilled bands are read back memory mapped, with no new read of the image
+    spilled = img.loaded_bands_[0]
+    assert isinstance(spilled, np.memmap) and np.array_equal(spilled, array[0])
+
+    img.clear()
+    assert list((tmp_path / 'spill').iterdir()) == [] and cache.stats['spilled'] == 0
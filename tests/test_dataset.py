@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+def make_dataset(n=12, **kwargs):
+    rng = np.random.default_rng(0)
+    imgs = WN.WNPatchProcessor(from_patches=rng.uniform(-1, 1, (n, 2, 4, 4)).astype('float32'))
+    lbls = WN.WNPatchProcessor(from_patches=np.where(rng.random((n, 4, 4)) > 0.5, 1, -1).astype('int8'))
+    for proc, bands in [(imgs, ['a', 'b']), (lbls, ['label'])]:
+        proc.set_format(bands, 4, 4, True, ppr=4)
+    return WN.WNDataset(imgs, lbls, cuda=False, **kwargs), imgs, lbls
+
+
+def test_items_are_compact_arrays_normalized_per_batch():
+    dataset, imgs, lbls = make_dataset()
+    x, y = dataset[3]
+    assert isinstance(x, np.ndarray) and x.dtype == np.float32
+    assert isinstance(y, np.ndarray) and y.dtype == np.uint8
+
+    xb, yb = WN.WNDataset.collate([dataset[i] for i in range(4)])
+    assert xb.dtype == torch.float32 and yb.dtype == torch.int64
+    assert torch.allclose(xb, (torch.from_numpy(np.stack([imgs[i] for i in range(4)])) + 1) / 2)
+    assert torch.equal(yb, torch.from_numpy(np.stack([lbls[i] for i in range(4)]) == 1).long())
+
+
+def test_loaders_with_worker_processes():
+    dataset, imgs, _ = make_dataset()
+    dataset.create_data_loaders(4, shuffle=False, valid_size=4, num_workers=1, seed=0)
+
+    assert dataset.device == torch.device('cpu') and not dataset.train_dl.pin_memory
+    batches = list(dataset.train_dl)
+    assert [len(x) for x, _ in batches] == [4, 4]
+
+    idxs = dataset.train_dl.dataset.indices
+    expected = (np.stack([imgs[i] for i in idxs]) + 1) / 2
+    assert np.allclose(torch.cat([x for x, _ in batches]).numpy(), expected)
+
+
+def test_seeded_split_is_reproducible():
+    splits = []
+    for _ in range(2):
+        dataset, _, _ = make_dataset()
+        dataset.create_data_loaders(4, valid_size=4, seed=7)
+        splits.append((list(dataset.train_dl.dataset.indices), list(dataset.valid_dl.dataset.indices)))
+
+    assert splits[0] == splits[1]
+    assert sorted(splits[0][0] + splits[0][1]) == list(range(12))
+
+
+def test_stats_of_a_batch():
+    batch = np.random.default_rng(0).random((3, 2, 4, 4)).astype('float32')
+    batch[0, 1, :2] = np.nan
+    batch[1] = np.nan
+    batch[2, 0, 0] = 1
+
+    stats = WN.WNPatchStats.compute(np.moveaxis(batch, 1, -1), channels_first=False)
+
+    assert np.allclose(stats['valid'], [0.5, 0, 1])
+    assert np.allclose(stats['water'], [0, 0, 0.25])
+    assert np.allclose(stats['min'][[0, 2]], np.nanmin(batch[[0, 2]], axis=(2, 3)))
+    assert np.allclose(stats['max'][[0, 2]], np.nanmax(batch[[0, 2]], axis=(2, 3)))
+    assert np.isnan(stats['min'][1]).all()
+
+
+def save_dataset(path):
+    # patches with 1 to 16 valid pixels (of 16) and 0 to 15 water pixels
+    n = 16
+    imgs = np.random.default_rng(0).uniform(-1, 1, (n, 2, 4, 4)).astype('float32')
+    lbls = np.full((n, 4, 4), -1, dtype='float32')
+    for i in range(n):
+        imgs[i].reshape(2, -1)[:, i + 1:] = np.nan
+        lbls[i].reshape(-1)[:i] = 1
+
+    for name, patches in [('Images', imgs), ('Labels', lbls)]:
+        proc = WN.WNPatchProcessor.create_from_patches(patches, 4, 4, patches_per_row=4,
+                                                       channels_first=True if patches.ndim == 4 else None)
+        proc.save_patches(path / name, 'S')
+    return path
+
+
+def test_saved_stats_match_the_computed_ones(tmp_path):
+    save_dataset(tmp_path)
+    stats = WN.WNDataset(path=tmp_path, cuda=False).stats
+
+    assert np.allclose(stats['valid'], np.arange(1, 17) / 16)
+    assert np.allclose(stats['water'], np.arange(16) / 16)
+
+    computed = WN.WNPatchStats.of(WN.WNDataset(path=tmp_path, cuda=False).imgs.patches_view)
+    for column in ['valid', 'min', 'max']:
+        assert np.allclose(stats[column], computed[column])
+
+
+def test_dataset_filters_and_weights_by_the_stats(tmp_path):
+    save_dataset(tmp_path)
+
+    dataset = WN.WNDataset(path=tmp_path, cuda=False, min_valid=0.5, min_water=0.25)
+    assert np.array_equal(dataset.items_, np.arange(7, 16))
+    assert len(dataset) == 9
+    x, _ = dataset[0]
+    assert np.isnan(x.reshape(2, -1)[:, 8:]).all() and not np.isnan(x.reshape(2, -1)[:, :8]).any()
+
+    full = WN.WNDataset(path=tmp_path, cuda=False)
+    assert np.array_equal(full.filter(max_water=0.1), [0, 1])
+    weights = full.sample_weights(water_weight=2., min_valid=0.25)
+    valid, water = np.arange(1, 17) / 16, np.arange(16) / 16
+    assert np.allclose(weights, np.where(valid >= 0.25, valid * (1 + 2 * water), 0))
+
+    # the zero weight patches are never drawn (the sampler draws positions of the train split)
+    full.create_data_loaders(4, weights=weights, seed=0)
+    drawn = [full.train_dl.dataset.indices[i] for i in full.train_dl.sampler]
+    assert len(drawn) == 16 and all(weights[i] > 0 for i in drawn)
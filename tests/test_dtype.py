@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+@pytest.fixture
+def float16(monkeypatch):
+    # the storage dtype is restored after the test
+    monkeypatch.setattr(WN.dtype_policy, 'storage', np.dtype('float16'))
+
+
+@pytest.fixture
+def product(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = {band: rng.integers(0, 10000, (20, 20)).astype('int16') for band in ['B2', 'B11']}
+    for band, array in arrays.items():
+        WN.array2raster(str(tmp_path / f'P_SRE_{band}.tif'), array, (0., 10., 0., 200., 0., -10.), '',
+                        nodatavalue=-10000, dtype=gdal.GDT_Int16)
+    WN.WNProductIndex.clear_cache()
+
+    img = WN.WNSatImage(tmp_path, img_dic={band: f'SRE_{band}.tif' for band in arrays}, verbose=False)
+    img.clear()
+    return img, {band: array / 10000 for band, array in arrays.items()}
+
+
+def test_bands_are_scaled_in_the_compute_dtype(product):
+    img, expected = product
+    band = img.get_raster('B2')
+
+    assert band.dtype == np.float32
+    assert np.allclose(band, expected['B2'], atol=1e-6)
+
+
+def test_storage_dtype_of_bands_math_and_patches(product, float16):
+    img, expected = product
+    assert img.get_raster('B2').dtype == np.float16
+
+    ndwi = img.band_math('nd', lambda x: x.normalized_difference('B2', 'B11'))
+    assert ndwi.dtype == np.float16
+    assert np.allclose(ndwi, (expected['B2'] - expected['B11']) / (expected['B2'] + expected['B11']), atol=1e-2)
+
+    proc = WN.create_custom_patches(img, ['B2', 'B11'], 10, 5)
+    assert proc[0].dtype == np.float16
+    scene = proc.assembly_patches()
+    assert scene.dtype == np.float16 and np.allclose(scene[0], expected['B2'], atol=1e-3)
+
+
+def test_assembly_accumulates_in_the_compute_dtype(float16):
+    # many overlapping float16 patches: the sums would lose precision in float16
+    patches = np.random.default_rng(0).uniform(1, 2, (49, 1, 32, 32)).astype('float16')
+    proc = WN.WNPatchProcessor.create_from_patches(patches, 32, 4, patches_per_row=7, channels_first=True)
+
+    sums, weights = np.zeros((56, 56)), np.zeros((56, 56))
+    for i, patch in enumerate(patches.astype('float64')):
+        r, c = divmod(i, 7)
+        sums[r * 4:r * 4 + 32, c * 4:c * 4 + 32] += patch[0]
+        weights[r * 4:r * 4 + 32, c * 4:c * 4 + 32] += 1
+
+    scene = proc.assembly_patches()
+    assert scene.dtype == np.float16
+    assert np.abs(scene.astype('float64') - sums / weights).max() <= 2 ** -10
+    assert proc.assembly_patches(dtype='float32').dtype == np.float32
+
+
+def test_integer_bands_keep_their_dtype(tmp_path, float16):
+    label = np.random.default_rng(0).integers(0, 2, (12, 10)).astype('uint8')
+    WN.array2raster(str(tmp_path / 'label.tif'), label, (0., 10., 0., 120., 0., -10.), '', dtype=gdal.GDT_Byte)
+
+    band = WN.WNImage(tmp_path / 'label.tif').get_raster(0)
+    assert band.dtype == np.uint8 and np.array_equal(band, label)
+
+
+def test_policy_conversions():
+    policy = WN.WNDtypePolicy(storage='float16')
+
+    assert policy.scale(np.array([10000], dtype='int16'), 1 / 10000).dtype == np.float16
+    assert policy.scale(np.array([1], dtype='uint8')).dtype == np.uint8
+    assert policy.storage_dtype('int16') == np.int16 and policy.storage_dtype('float64') == np.float16
+    assert policy.accumulator == np.float32 and policy.to_compute(np.zeros(2, 'float16')).dtype == np.float32
+
+    policy.configure(compute='float64', storage='float32')
+    assert policy.accumulator == np.float64
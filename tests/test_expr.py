@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+@pytest.fixture
+def img(tmp_path):
+    array = np.random.default_rng(0).random((12, 10)).astype('float32')
+    WN.array2raster(str(tmp_path / 'img.tif'), array, (0., 10., 0., 120., 0., -10.), '')
+    return WN.WNImage(tmp_path / 'img.tif'), array
+
+
+def test_apply_of_different_functions_is_not_merged(img):
+    img, array = img
+    band = img.band_math('diff', lambda x: x[0].apply(lambda v: v + 1) - x[0].apply(lambda v: v * 2))
+
+    assert img.band_expr('diff') is not None
+    assert np.allclose(band, 1 - array, atol=1e-6)
+
+
+def test_array_constant_falls_back_to_eager(img):
+    img, array = img
+    offsets = np.arange(array.shape[1], dtype='float32')
+    band = img.band_math('shifted', lambda x: x[0] + offsets)
+
+    assert img.band_expr('shifted') is None
+    assert np.allclose(band, array + offsets)
+
+
+def test_scalar_constants_keep_their_type():
+    band = WN.WNExpr('band', value=0)
+
+    assert (band + 1).key != (band + 1.).key
+    assert (band + np.array(2.)).key == (band + np.float64(2.)).key
+
+
+def count_reads(monkeypatch):
+    pixels = []
+    read_window = WN.WNImage.read_window
+
+    def counted(self, band, xoff, yoff, width, height, *args, **kwargs):
+        pixels.append(width * height)
+        return read_window(self, band, xoff, yoff, width, height, *args, **kwargs)
+
+    monkeypatch.setattr(WN.WNImage, 'read_window', counted)
+    return pixels
+
+
+@pytest.fixture
+def bands_img(tmp_path):
+    array = np.random.default_rng(0).random((2, 40, 10)).astype('float32')
+    WN.array2raster(str(tmp_path / 'bands.tif'), array, (0., 10., 0., 400., 0., -10.), '')
+    img = WN.WNImage(tmp_path / 'bands.tif')
+    img.chunk_rows = 8
+    return img, array
+
+
+def test_reduction_bands_are_read_once(bands_img, monkeypatch):
+    img, array = bands_img
+    pixels = count_reads(monkeypatch)
+
+    nd = img.band_math('nd', lambda x: x.normalized_difference(0, 1))
+
+    assert sum(pixels) == array.size
+    b1, b2 = array + WN.nd_offset(array.min())
+    assert np.allclose(nd, (b1 - b2) / (b1 + b2), atol=1e-6)
+
+
+def test_windows_take_the_bands_loaded_for_the_reductions(bands_img, monkeypatch):
+    img, array = bands_img
+    img.set_band_math('nd', lambda x: x.normalized_difference(0, 1))
+    whole = img.get_raster('nd').copy()
+    pixels = count_reads(monkeypatch)
+
+    window = img.window(0, 16, 10, 8)
+    assert np.allclose(window.get_raster('nd'), whole[16:24])
+    assert sum(pixels) == 0
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('fastai.vision')
+WF = pytest.importorskip('WNFastaiClasses')
+
+
+def test_items_are_widened_once_by_default():
+    item = np.arange(12, dtype='float16').reshape(3, 2, 2)
+    tensor = WF.array_as_tensor(item)
+
+    assert tensor.dtype == torch.float32 and torch.equal(tensor, torch.arange(12.).reshape(3, 2, 2))
+
+
+def test_compact_items_share_the_memory():
+    item = np.arange(12, dtype='uint8').reshape(3, 2, 2)
+    tensor = WF.array_as_tensor(item, compact=True)
+
+    assert tensor.dtype == torch.uint8 and np.shares_memory(tensor.numpy(), item)
+    assert WF.array_as_tensor(item.astype('uint16'), compact=True).dtype == torch.int32
+
+    x, y = WF.widen_batch((tensor[np.newaxis], tensor[np.newaxis, 0]))
+    assert x.dtype == torch.float32 and y.dtype == torch.int64
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_items_and_labels_are_memory_mapped(tmp_path, compact, monkeypatch):
+    img = np.random.default_rng(0).random((4, 8, 8)).astype('float16')
+    lbl = (np.random.default_rng(1).random((8, 8)) > 0.5).astype('uint8')
+    np.save(tmp_path / 'img.npy', img)
+    np.save(tmp_path / 'lbl.npy', lbl)
+
+    loads = []
+    load = np.load
+    monkeypatch.setattr(np, 'load', lambda *args, **kwargs: loads.append(kwargs.get('mmap_mode')) or
+                        load(*args, **kwargs))
+    monkeypatch.setattr(WF.MSSegmentationItemList, 'compact', compact)
+    monkeypatch.setattr(WF.MSSegmentationLabelList, 'compact', compact)
+
+    item = WF.MSSegmentationItemList([tmp_path / 'img.npy']).open(tmp_path / 'img.npy')
+    label = WF.MSSegmentationLabelList([tmp_path / 'lbl.npy']).open(tmp_path / 'lbl.npy')
+
+    assert loads == ['c', 'c']
+    assert item.px.dtype == (torch.float16 if compact else torch.float32)
+    assert label.px.dtype == (torch.uint8 if compact else torch.float32)
+    assert np.array_equal(item.px.float().numpy(), img.astype('float32'))
+    assert label.px.shape == (1, 8, 8) and np.array_equal(label.px[0].numpy(), lbl)
+
+
+def test_labels_are_mapped_by_name(tmp_path):
+    imgs, lbls = tmp_path / 'images', tmp_path / 'labels'
+    imgs.mkdir(), lbls.mkdir()
+    for i in range(3):
+        (imgs / f'S_n_mndwin_ndwin_B11B2_{i}.npy').touch()
+        (lbls / f'S_water_mask_{i}.npy').touch()
+    (imgs / 'S_n_mndwin_ndwin_B11B2_3.npy').touch()
+
+    WF.lbl_fns.clear()
+    WF.create_lbl_map(imgs)
+
+    assert len(WF.lbl_fns) == 3
+    assert WF.get_lbl_fn(imgs / 'S_n_mndwin_ndwin_B11B2_1.npy') == lbls / 'S_water_mask_1.npy'
+
+    # the images with no mapped label fall back to the name replacement
+    assert WF.get_lbl_fn(imgs / 'S_n_mndwin_ndwin_B11B2_3.npy') == lbls / 'S_water_mask_3.torch'
+    assert WF.get_lbl_fn(Path('x') / 'images' / 'a_n_mndwin_ndwin_B11B2.npy') == \
+        Path('x') / 'labels' / 'a_water_mask.torch'
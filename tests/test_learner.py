@@ -0,0 +1,163 @@
+import types
+
+import pytest
+
+torch = pytest.importorskip('torch')
+WN = pytest.importorskip('WNInputOutput')
+
+
+def make_learner(tmp_path):
+    x = torch.randn(8, 2, 4, 4)
+    y = torch.randint(0, 2, (8, 4, 4))
+    data = torch.utils.data.TensorDataset(x, y)
+    dl = torch.utils.data.DataLoader(data, batch_size=4)
+
+    dataset = types.SimpleNamespace(train_dl=dl, valid_dl=dl, device=torch.device('cpu'), path=tmp_path)
+    learner = WN.WNLearner(dataset, torch.nn.Conv2d(2, 2, 1))
+    return learner
+
+
+def test_epochs_are_additional_with_and_without_resume(tmp_path):
+    learner = make_learner(tmp_path)
+    learner.train(epochs=2, show_each=None, checkpoint_every=1)
+    learner.train(epochs=1, show_each=None)
+    assert learner.epoch == 3
+
+    resumed = make_learner(tmp_path)
+    resumed.train(epochs=1, show_each=None, resume=True)
+    assert resumed.epoch == 3
+
+
+class Recorder(torch.nn.Module):
+    # records the samples trained (the first pixel of each sample is its index) and can fail at a given batch
+    def __init__(self, fail_at=None):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(1, 2, 1)
+        self.seen, self.batches, self.fail_at = [], 0, fail_at
+
+    def forward(self, x):
+        if self.training:
+            if self.batches == self.fail_at:
+                raise RuntimeError('interrupted')
+            self.batches += 1
+            self.seen += x[:, 0, 0, 0].long().tolist()
+        return self.conv(x)
+
+
+def make_recorder_learner(tmp_path, n=8, bs=2, fail_at=None):
+    x = torch.arange(n, dtype=torch.float32).reshape(n, 1, 1, 1).expand(n, 1, 4, 4).contiguous()
+    y = torch.randint(0, 2, (n, 4, 4))
+    data = torch.utils.data.TensorDataset(x, y)
+    sampler = WN.WNResumableSampler(torch.utils.data.RandomSampler(data))
+    dl = torch.utils.data.DataLoader(data, batch_size=bs, sampler=sampler)
+
+    dataset = types.SimpleNamespace(train_dl=dl, valid_dl=None, device=torch.device('cpu'), path=tmp_path)
+    return WN.WNLearner(dataset, Recorder(fail_at))
+
+
+def test_resume_goes_on_with_the_order_of_the_interrupted_epoch(tmp_path):
+    learner = make_recorder_learner(tmp_path, fail_at=2)
+    with pytest.raises(RuntimeError, match='interrupted'):
+        learner.train(epochs=1, show_each=None, checkpoint_every=1)
+    learner.checkpoint_writer_.wait()
+
+    resumed = make_recorder_learner(tmp_path)
+    resumed.train(epochs=1, show_each=None, resume=True)
+
+    assert len(resumed.model.seen) == 4
+    assert sorted(learner.model.seen + resumed.model.seen) == list(range(8))
+
+
+def test_checkpoints_count_optimizer_steps(tmp_path):
+    learner = make_recorder_learner(tmp_path, n=24)
+    learner.train(epochs=1, show_each=None, accumulate=2, checkpoint_every=3, keep_checkpoints=None)
+    learner.checkpoint_writer_.wait()
+
+    names = sorted(path.stem for path in tmp_path.glob('models/auto_*.pth'))
+    assert names == ['auto_e0000_s0000006', 'auto_e0000_s0000012', 'auto_e0001_s0000000']
+
+    state = torch.load(tmp_path / 'models' / 'auto_e0000_s0000006.pth')
+    assert {'scaler', 'sampler'} <= set(state)
+    assert sorted(state['sampler']['order'].tolist()) == list(range(24))
+
+
+def make_data_learner(tmp_path, bs, n=8, valid=True):
+    torch.manual_seed(0)
+    x, y = torch.randn(n, 2, 4, 4), torch.randint(0, 2, (n, 4, 4))
+    data = torch.utils.data.TensorDataset(x, y)
+    dl = torch.utils.data.DataLoader(data, batch_size=bs)
+    valid_dl = dl if valid else torch.utils.data.DataLoader(torch.utils.data.TensorDataset(x[:0], y[:0]))
+
+    dataset = types.SimpleNamespace(train_dl=dl, valid_dl=valid_dl, device=torch.device('cpu'), path=tmp_path)
+    return WN.WNLearner(dataset, torch.nn.Conv2d(2, 2, 1)), x, y
+
+
+def test_metrics_are_the_averages_over_the_samples(tmp_path):
+    learner, x, y = make_data_learner(tmp_path, bs=3)
+    with torch.no_grad():
+        outputs = learner.model(x)
+        expected_loss = torch.nn.functional.cross_entropy(outputs, y).item()
+        expected_acc = (outputs.argmax(dim=1) == y).float().mean().item()
+
+    # with lr=0 the model does not change during the epoch
+    learner.train(lr=0., epochs=1, show_each=None, device='cpu')
+
+    assert learner.device == torch.device('cpu')
+    for losses, accuracies in zip(learner.losses, learner.accuracies):
+        assert type(losses[0]) is float and type(accuracies[0]) is float
+        assert losses[0] == pytest.approx(expected_loss, rel=1e-5)
+        assert accuracies[0] == pytest.approx(expected_acc)
+
+
+def test_accumulated_batches_match_a_bigger_batch(tmp_path):
+    whole, _, _ = make_data_learner(tmp_path, bs=4)
+    accumulated, _, _ = make_data_learner(tmp_path, bs=2)
+
+    whole.train(lr=0.01, epochs=1, show_each=None)
+    accumulated.train(lr=0.01, epochs=1, show_each=None, accumulate=2)
+
+    for a, b in zip(whole.model.parameters(), accumulated.model.parameters()):
+        assert torch.allclose(a, b, atol=1e-6)
+    assert whole.step == accumulated.step == 0 and whole.epoch == accumulated.epoch == 1
+
+
+def test_empty_valid_and_mixed_precision_on_cpu(tmp_path):
+    learner, _, _ = make_data_learner(tmp_path, bs=4, valid=False)
+    learner.train(epochs=2, show_each=1, amp=True)
+
+    assert len(learner.losses[0]) == 2 and learner.losses[1] == []
+    assert all(p.dtype == torch.float32 for p in learner.model.parameters())
+
+
+def test_checkpoint_writer_saves_snapshots_and_keeps_the_last(tmp_path):
+    writer = WN.WNCheckpointWriter(keep=2)
+    weights = torch.zeros(3)
+
+    for step in range(4):
+        weights += 1
+        writer.save(tmp_path / f'auto_e0000_s{step:07d}.pth', {'model': {'w': weights}, 'step': step})
+    writer.save(tmp_path / 'manual.pth', {'model': {'w': weights}})
+    writer.wait()
+
+    # the state is copied when saved, so the later updates are not in the earlier checkpoints
+    names = sorted(path.name for path in tmp_path.iterdir())
+    assert names == ['auto_e0000_s0000002.pth', 'auto_e0000_s0000003.pth', 'manual.pth']
+    assert torch.equal(torch.load(tmp_path / 'auto_e0000_s0000002.pth')['model']['w'], torch.full((3,), 3.))
+
+    writer.close()
+    assert not writer.thread_.is_alive()
+
+
+def test_checkpoint_writer_errors_are_raised(tmp_path):
+    writer = WN.WNCheckpointWriter()
+    writer.save(tmp_path / 'missing' / 'auto.pth', {'step': 0})
+
+    # torch raises a RuntimeError or an OSError, depending on its version
+    with pytest.raises((OSError, RuntimeError)):
+        writer.wait()
+
+    # the writer goes on after the error
+    writer.save(tmp_path / 'auto.pth', {'step': 1})
+    writer.wait()
+    assert torch.load(tmp_path / 'auto.pth') == {'step': 1}
+    writer.close()
@@ -0,0 +1,320 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+def make_proc(n=12, seed=0, ppr=4, scale=1):
+    patches = (np.random.default_rng(seed).random((n, 2, 8, 8)) * scale).astype('float32')
+    proc = WN.WNPatchProcessor(from_patches=patches)
+    proc.set_format(['a', 'b'], 8, 4, True, ppr=ppr)
+    return proc
+
+
+def load(path, **kwargs):
+    proc = WN.WNPatchProcessor()
+    proc.load_patches(path, **kwargs)
+    return proc
+
+
+@pytest.mark.parametrize('ext', ['npy', 'shard'])
+def test_resave_keeps_patches_count(tmp_path, ext):
+    make_proc(seed=0).save_patches(tmp_path, 'S', ext)
+    second = make_proc(seed=1)
+    second.save_patches(tmp_path, 'S', ext)
+
+    proc = load(tmp_path)
+    assert len(proc) == 12
+    assert np.array_equal(proc[5], second[5])
+    assert len(WN.WNPatchStats.read(tmp_path)) == 12
+
+    if ext == 'shard':
+        assert len(WN.WNShardReader(tmp_path)) == 12
+
+
+@pytest.mark.parametrize('ext', ['npy', 'shard'])
+def test_session_writes_windows_once(tmp_path, ext):
+    with WN.WNSaveSession() as session:
+        for start in range(0, 12, 4):
+            make_proc(4, seed=start).save_patches(tmp_path, 'S', ext, start=start, session=session)
+
+    assert len(load(tmp_path)) == 12
+    assert len(WN.WNPatchStats.read(tmp_path)) == 12
+
+
+def test_shards_follow_manifest(tmp_path):
+    make_proc(seed=0).save_patches(tmp_path, 'S', 'shard')
+    part = make_proc(4, seed=1)
+    part.save_patches(tmp_path, 'S', 'shard', start=4, part='00001')
+
+    proc = load(tmp_path)
+    assert len(proc) == 12
+    assert len(WN.WNPatchManifest(tmp_path)) == 12
+    assert np.array_equal(proc[5], part[1])
+
+
+def test_exact_scene_selection(tmp_path):
+    make_proc(seed=0).save_patches(tmp_path, 'T31_1', 'npy')
+    make_proc(4, seed=1).save_patches(tmp_path, 'T31_10', 'npy')
+
+    assert len(load(tmp_path, base_name='T31_1')) == 12
+    assert len(load(tmp_path, scenes=['T31_10'])) == 4
+    assert len(load(tmp_path)) == 16
+
+
+@pytest.mark.parametrize('ext', ['npy', 'shard'])
+def test_skipped_patches_round_trip(tmp_path, ext):
+    # 5 x 4 grid of 8x8 patches with shift 4, the first two rows of patches fully invalid
+    cube = np.random.default_rng(0).random((2, 24, 20)).astype('float32')
+    patches = np.stack([cube[:, r * 4:r * 4 + 8, c * 4:c * 4 + 8] for r in range(5) for c in range(4)])
+    proc = WN.WNPatchProcessor.create_from_patches(patches, 8, 4, patches_per_row=4, channels_first=True)
+    proc.valid_ = np.arange(20) >= 8
+
+    expected = proc.assembly_patches(fill=np.nan)
+    proc.save_patches(tmp_path, 'S', ext)
+
+    loaded = load(tmp_path)
+    assert len(loaded) == 20
+    assert np.array_equal(loaded.valid_, proc.valid_)
+    assert np.isnan(loaded[0]).all()
+    assert np.array_equal(loaded[8], patches[8])
+
+    scene = loaded.assembly_patches(fill=np.nan)
+    assert scene.shape == expected.shape == (2, 24, 20)
+    assert np.array_equal(scene, expected, equal_nan=True)
+
+
+def test_quantization_out_of_range_raises(tmp_path):
+    make_proc(seed=0).save_patches(tmp_path, 'S', 'npy', quantize='uint16')
+
+    with pytest.raises(ValueError, match='quantization range'):
+        make_proc(seed=1, scale=4).save_patches(tmp_path, 'T', 'npy', quantize='uint16')
+
+
+def test_windowed_quantization_needs_ranges(tmp_path):
+    with pytest.raises(ValueError, match='window by window'):
+        make_proc(4).save_patches(tmp_path, 'S', 'npy', start=4, quantize='uint16')
+
+    with WN.WNSaveSession() as session:
+        for start in range(0, 12, 4):
+            make_proc(4, seed=start).save_patches(tmp_path, 'S', 'npy', start=start, session=session,
+                                                  quantize=WN.WNQuantizer.fixed('uint16'))
+
+    proc = load(tmp_path)
+    assert np.allclose(proc[5], make_proc(4, seed=4)[1], atol=1e-4)
+
+
+def test_parallel_failures_raise(tmp_path):
+    imgs = {'A': {'img': str(tmp_path / 'missing_A')}, 'B': {'img': str(tmp_path / 'missing_B')}}
+
+    with pytest.raises(RuntimeError, match='2 of 2 patches tasks failed'):
+        WN.auto_train_patches_creation(imgs, tmp_path / 'out', ['B2'], 10, 10, workers=2, max_memory=2**32)
+
+
+def test_stats_count_nodata_as_invalid(tmp_path):
+    array = np.random.default_rng(0).random((16, 16)).astype('float32')
+    array[:8] = -1.
+    array[8:12, :4] = -1.
+    WN.array2raster(str(tmp_path / 'img.tif'), array, (0., 10., 0., 160., 0., -10.), '')
+
+    img = WN.WNImage(tmp_path / 'img.tif')
+    img.nodata = -1.
+    proc = WN.WNPatchProcessor(img)
+    proc.create_patches([0], 8, 8, True)
+    proc.save_patches(tmp_path / 'patches', 'S')
+
+    expected = [0, 0, 0.75, 1]
+    assert np.allclose(proc.patch_stats()['valid'], expected)
+    assert np.allclose(WN.WNPatchStats.read(tmp_path / 'patches').stats['valid'], expected)
+
+    proc.save_patches(tmp_path / 'quantized', 'S', quantize='uint16')
+    assert np.allclose(load(tmp_path / 'quantized')[0], -1., atol=1e-4)
+    assert np.all(load(tmp_path / 'patches').patch_stats()['min'][2:] >= 0)
+
+
+@pytest.mark.parametrize('ext', ['npy', 'shard'])
+def test_manifest_keeps_legacy_patches(tmp_path, ext):
+    make_proc(seed=0).save_patches(tmp_path, 'T31_1', ext)
+    make_proc(4, seed=1).save_patches(tmp_path, 'T31_2', ext)
+
+    # directory saved before the manifest
+    (tmp_path / WN.WNPatchManifest.file_name).unlink()
+
+    new = make_proc(seed=2)
+    new.save_patches(tmp_path, 'T32_1', ext)
+
+    assert len(load(tmp_path)) == 28
+    assert len(load(tmp_path, base_name='T31_1')) == 12
+    assert np.array_equal(load(tmp_path, base_name='T32_1')[3], new[3])
+
+
+def test_quantization_must_match_the_saved_one(tmp_path):
+    make_proc(seed=0).save_patches(tmp_path, 'S', 'npy', quantize=WN.WNQuantizer.fixed('uint16'))
+
+    make_proc(seed=1).save_patches(tmp_path, 'T', 'npy', quantize='uint16')
+    make_proc(seed=1).save_patches(tmp_path, 'T', 'npy', quantize=WN.WNQuantizer.fixed('uint16'))
+    with pytest.raises(ValueError, match='quantized as'):
+        make_proc(seed=1).save_patches(tmp_path, 'T', 'npy', quantize='uint8')
+    with pytest.raises(ValueError, match='quantized as'):
+        make_proc(seed=1).save_patches(tmp_path, 'T', 'npy', quantize=WN.WNQuantizer('uint16', ranges=[(0, 1)]))
+
+
+@pytest.fixture
+def cube_img(tmp_path):
+    cube = np.random.default_rng(0).random((3, 20, 16)).astype('float32')
+    WN.array2raster(str(tmp_path / 'cube.tif'), cube, (0., 10., 0., 200., 0., -10.), '')
+    return WN.WNImage(tmp_path / 'cube.tif'), cube
+
+
+@pytest.mark.parametrize('channels_first', [True, False])
+def test_view_patches_match_the_copies(cube_img, channels_first):
+    img, cube = cube_img
+    copies, view = WN.WNPatchProcessor(img), WN.WNPatchProcessor(img)
+    copies.create_patches([0, 1, 2], 8, 4, channels_first)
+    view.create_patches([0, 1, 2], 8, 4, channels_first, as_view=True)
+
+    assert len(view) == len(copies) == 4 * 3
+    assert view.format['patches_per_row'] == copies.format['patches_per_row'] == 3
+    assert not view.view_.flags.writeable
+    for i in range(len(view)):
+        assert np.array_equal(view[i], copies[i])
+
+    expected = np.stack([copies[i] for i in range(len(copies))])
+    assert np.array_equal(view.patches_view, expected)
+    assert np.array_equal(np.concatenate(list(view.iter_batches(5))), expected)
+
+    batch = view.get_batch(7, 20)
+    assert batch.flags.c_contiguous and np.array_equal(batch, expected[7:])
+
+
+def test_view_does_not_copy_the_cube(cube_img):
+    img, cube = cube_img
+    proc = WN.WNPatchProcessor(img)
+    proc.create_patches([0, 1, 2], 8, 4, True, as_view=True)
+
+    # the overlapping patches hold more values than the scene, in the memory of the scene
+    assert proc.view_.size > cube.size
+    assert np.shares_memory(proc[0], proc[1])
+    assert np.array_equal(proc[4], cube[:, 4:12, 4:12])
+
+
+@pytest.mark.parametrize('ext', ['npy', 'shard'])
+def test_memory_mapped_patches(tmp_path, ext):
+    saved = make_proc(seed=0)
+    saved.save_patches(tmp_path, 'S', ext)
+
+    mapped, copied = load(tmp_path, mmap_mode='r'), load(tmp_path)
+    for i in range(len(saved)):
+        assert np.array_equal(mapped[i], saved[i])
+
+    # the mapped patches are views of the files, the others are in memory
+    assert not mapped[3].flags.owndata and not mapped[3].flags.writeable
+    assert copied[3].flags.writeable
+
+
+def test_patch_cache_evicts_the_least_recently_used():
+    cache = WN.WNPatchCache(max_bytes=3 * 64)
+    loads = []
+
+    def loader(key):
+        loads.append(key)
+        return np.full(8, key, dtype='float64')
+
+    for key in [0, 1, 2, 0, 3, 0, 1]:
+        assert cache.get(key, lambda: loader(key))[0] == key
+
+    # 1 is evicted by 3 (0 was used again), then 2 by 1
+    assert loads == [0, 1, 2, 3, 1]
+    assert (cache.hits, cache.misses) == (2, 5)
+    assert cache.nbytes == 3 * 64 and len(cache) == 3
+    assert not cache.get(0, lambda: None).flags.writeable
+
+    cache.put('big', np.zeros(100))
+    assert 'big' not in cache.items_
+
+
+def test_processors_share_the_cache(tmp_path):
+    make_proc(seed=0).save_patches(tmp_path, 'S', 'shard')
+    cache = WN.WNPatchCache()
+    first, second = load(tmp_path, cache=cache), load(tmp_path, cache=cache)
+
+    assert np.array_equal(first[2], second[2])
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert first[2] is second[2]
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'uint8'])
+def test_quantization_round_trip_within_half_a_step(dtype):
+    patch = np.random.default_rng(0).uniform(-1, 2, (3, 8, 8)).astype('float32')
+    patch[1, :2] = np.nan
+    quantizer = WN.WNQuantizer(dtype, ranges=[(-1, 2), (-1, 2), (-0.5, 2)])
+    quantizer.overflow = 'clip'
+
+    q = quantizer.quantize(patch)
+    assert q.dtype == np.dtype(dtype) and (q[1, :2] == quantizer.sentinel).all()
+
+    restored = quantizer.dequantize(q)
+    error = np.abs(restored - patch).reshape(3, -1)
+    assert np.isnan(restored[1, :2]).all()
+    assert (np.nanmax(error[:2], axis=1) <= quantizer.scale[:2] / 2 + 1e-6).all()
+
+    # the values below the range of the last band are clipped to its minimum
+    assert np.allclose(restored[2][patch[2] < -0.5], -0.5)
+
+
+def test_integral_quantization_is_exact(tmp_path):
+    labels = np.random.default_rng(0).integers(0, 2, (12, 8, 8)).astype('float32')
+    proc = WN.WNPatchProcessor.create_from_patches(labels, 8, 8, patches_per_row=4)
+    proc.save_patches(tmp_path, 'S', 'shard', quantize='uint8')
+
+    quantizer = WN.WNQuantizer.read(tmp_path)
+    assert quantizer.dtype == np.uint8 and (quantizer.scale == 1).all()
+    assert np.array_equal(load(tmp_path).patches_view, labels[:, np.newaxis])
+    assert WN.WNQuantizer.fixed('uint8', integral=True).matches(WN.WNQuantizer('uint8', scale=[1], offset=[0]))
+
+
+def test_calibrated_quantization_of_saved_patches(tmp_path):
+    proc = make_proc(scale=3)
+    proc.save_patches(tmp_path, 'S', 'npy', quantize='uint16')
+
+    quantizer = WN.WNQuantizer.read(tmp_path)
+    loaded = load(tmp_path)
+    assert np.load(loaded.path_patches_[0]).dtype == np.uint16
+    for i in range(len(proc)):
+        assert np.all(np.abs(loaded[i] - proc[i]) <= quantizer.scale[:, None, None] / 2 + 1e-6)
+
+
+def test_shards_roll_over_and_keep_the_patches_aligned(tmp_path):
+    rng = np.random.default_rng(0)
+    patches = [rng.random((2, 5, 5)).astype('float32') for _ in range(5)] + [np.ones((3, 3), dtype='uint8')]
+
+    writer = WN.WNShardWriter(tmp_path, 'S', scene='S', shard_size=500)
+    for idx, patch in enumerate(patches):
+        writer.write(idx, patch)
+    writer.write(2, patches[0])
+    writer.close()
+
+    reader = WN.WNShardReader(tmp_path)
+    assert len(reader) == 6 and len(list(tmp_path.glob('S_*.shard'))) > 1
+    assert all(r['offset'] % WN.WNShardWriter.align == 0 for r in reader.records_)
+
+    expected = patches[:2] + [patches[0]] + patches[3:]
+    for idx, patch in enumerate(expected):
+        assert reader[idx].dtype == patch.dtype and np.array_equal(reader[idx], patch)
+
+    # without copy, the patches are views of the memory mapped shards
+    view = reader.get(4, copy=False)
+    assert not view.flags.owndata and np.array_equal(view, patches[4])
+
+
+def test_shard_reader_orders_and_selects_the_scenes(tmp_path):
+    for scene, values in [('B', [3, 4]), ('A', [1, 2])]:
+        writer = WN.WNShardWriter(tmp_path, scene, scene=scene)
+        for idx in reversed(range(len(values))):
+            writer.write(idx, np.full((2, 2), values[idx], dtype='int16'))
+        writer.close()
+
+    assert [patch[0, 0] for patch in WN.WNShardReader(tmp_path)] == [1, 2, 3, 4]
+    assert [patch[0, 0] for patch in WN.WNShardReader(tmp_path, scenes='B')] == [3, 4]
+    assert [patch[0, 0] for patch in WN.WNShardReader(tmp_path, prefixes=['A'])] == [1, 2]
@@ -0,0 +1,81 @@
+import types
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return torch.nn.Conv2d(2, 3, 3, padding=1)
+
+
+def reference(model, patches):
+    # one patch at a time, as the original predict_patches
+    with torch.no_grad():
+        probs = np.stack([torch.softmax(model(torch.from_numpy(p[np.newaxis])), dim=1)[0].numpy() for p in patches])
+    return probs.argmax(axis=1), probs
+
+
+@pytest.fixture
+def patches():
+    return np.random.default_rng(0).random((10, 2, 8, 8)).astype('float32')
+
+
+@pytest.mark.parametrize('bs', [1, 3, 32])
+def test_batches_match_the_patches_one_by_one(model, patches, bs):
+    proc = WN.WNPatchProcessor.create_from_patches(patches, 8, 8, patches_per_row=5, channels_first=True)
+    masks, probs = WN.predict_patches(proc, model, bs=bs)
+    expected_masks, expected_probs = reference(model, patches)
+
+    assert masks.shape == (10, 8, 8) and masks.dtype == np.uint8
+    assert probs.shape == (10, 3, 8, 8) and probs.flags.c_contiguous
+    assert np.array_equal(masks, expected_masks)
+    assert np.allclose(probs, expected_probs, atol=1e-6)
+
+
+def test_channels_last_patches(model, patches):
+    proc = WN.WNPatchProcessor.create_from_patches(np.moveaxis(patches, 1, -1), 8, 8, patches_per_row=5,
+                                                   channels_first=False)
+    masks, probs = WN.predict_patches(proc, model, bs=4)
+
+    assert np.allclose(probs, reference(model, patches)[1], atol=1e-6)
+
+
+def test_only_the_valid_patches_are_predicted(model, patches):
+    proc = WN.WNPatchProcessor.create_from_patches(patches, 8, 8, patches_per_row=5, channels_first=True)
+    proc.valid_ = np.arange(10) % 3 != 0
+
+    calls = []
+    model.register_forward_hook(lambda module, inputs, output: calls.append(len(inputs[0])))
+    masks, probs = WN.predict_patches(proc, model, bs=4)
+
+    assert sum(calls) == proc.valid_.sum()
+    expected_masks, expected_probs = reference(model, patches)
+    assert np.allclose(probs[proc.valid_], expected_probs[proc.valid_], atol=1e-6)
+    assert (probs[~proc.valid_] == 0).all() and (masks[~proc.valid_] == 0).all()
+
+
+def test_predict_with_and_without_the_number_of_items(model, patches):
+    predictor = WN.WNPredictor(model, bs=4)
+    batches = [patches[i:i + 4] for i in range(0, 10, 4)]
+
+    listed = predictor.predict(iter(batches))
+    allocated = predictor.predict(iter(batches), n=10)
+
+    assert np.array_equal(listed[0], allocated[0]) and np.array_equal(listed[1], allocated[1])
+    assert predictor.predict(iter([])) == (None, None)
+    assert not model.training
+
+
+def test_predict_data_normalizes_the_batches(model, patches, tmp_path):
+    dataset = types.SimpleNamespace(train_dl=None, valid_dl=None, device=torch.device('cpu'), path=tmp_path)
+    learner = WN.WNLearner(dataset, model)
+    items = [(patch, np.zeros((8, 8), dtype='int64')) for patch in patches]
+
+    masks = learner.predict_data(items, bs=4)
+    assert np.array_equal(masks, reference(model, (patches + 1) / 2)[0])
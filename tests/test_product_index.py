@@ -0,0 +1,33 @@
+import pytest
+
+WN = pytest.importorskip('WNInputOutput')
+
+
+@pytest.fixture
+def product(tmp_path):
+    (tmp_path / 'IMG_DATA').mkdir()
+    (tmp_path / 'IMG_DATA' / 'P_SRE_B2.tif').touch()
+    WN.WNProductIndex.clear_cache()
+    yield tmp_path
+    WN.WNProductIndex.clear_cache()
+
+
+def test_persisted_index_is_reused_until_the_product_changes(product):
+    index = WN.WNProductIndex(product, persist=True)
+    assert index.match({'B2': 'SRE_B2'}) == {'B2': product / 'IMG_DATA' / 'P_SRE_B2.tif'}
+    assert index.read_index() is not None
+
+    (product / 'IMG_DATA' / 'P_SRE_B3.tif').touch()
+    assert index.read_index() is None
+
+    WN.WNProductIndex.clear_cache()
+    assert 'IMG_DATA/P_SRE_B3.tif' in WN.WNProductIndex(product, persist=True).files
+
+
+@pytest.mark.parametrize('persist', [False, True])
+def test_files_added_later_are_found(product, persist):
+    index = WN.WNProductIndex(product, persist=persist)
+    assert index.match({'B4': 'SRE_B4'}) == {}
+
+    (product / 'IMG_DATA' / 'P_SRE_B4.tif').touch()
+    assert index.match({'B2': 'SRE_B2', 'B4': 'SRE_B4'})['B4'] == product / 'IMG_DATA' / 'P_SRE_B4.tif'
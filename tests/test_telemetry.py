@@ -0,0 +1,87 @@
+import json
+import types
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+gdal = pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+def test_events_are_kept_written_and_passed_to_the_callbacks(tmp_path):
+    received = []
+    with WN.WNTelemetry(tmp_path / 'logs' / 'events.jsonl', callbacks=[received.append]) as telemetry:
+        telemetry.emit('step', seconds=1., samples=4)
+        telemetry.emit('step', seconds=3., samples=4, value=np.float32(0.5))
+        with telemetry.span('save', scene='S') as fields:
+            fields['patches'] = 10
+
+    lines = [json.loads(line) for line in (tmp_path / 'logs' / 'events.jsonl').read_text().splitlines()]
+    assert [line['event'] for line in lines] == ['step', 'step', 'save']
+    assert lines[1]['value'] == 0.5 and lines[2]['patches'] == 10 and lines[2]['seconds'] >= 0
+    assert received == telemetry.events
+
+    summary = telemetry.summary('step')
+    assert summary['count'] == 2
+    assert summary['total'] == {'seconds': 4., 'samples': 8}
+    assert summary['mean'] == {'seconds': 2., 'samples': 4}
+    assert telemetry.summary('missing')['count'] == 0
+
+
+def test_events_not_kept(tmp_path):
+    telemetry = WN.WNTelemetry(keep=False)
+    assert telemetry.emit('step', seconds=1.)['seconds'] == 1.
+    assert telemetry.events == [] and telemetry.peak_memory() > 0
+
+
+def test_training_steps_and_epochs(tmp_path):
+    x, y = torch.randn(10, 2, 4, 4), torch.randint(0, 2, (10, 4, 4))
+    dl = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(x, y), batch_size=4)
+    dataset = types.SimpleNamespace(train_dl=dl, valid_dl=dl, device=torch.device('cpu'), path=tmp_path)
+
+    telemetry = WN.WNTelemetry()
+    WN.WNLearner(dataset, torch.nn.Conv2d(2, 2, 1)).train(epochs=2, show_each=None, telemetry=telemetry)
+
+    steps = telemetry.select('train_step')
+    assert len(steps) == 2 * 2 * 3
+    assert [step['samples'] for step in steps[:3]] == [4, 4, 2]
+    assert all(step['data_wait'] >= 0 and step['compute'] >= 0 and step['samples_per_s'] > 0 for step in steps)
+
+    epochs = telemetry.select('epoch')
+    assert [(e['epoch'], e['phase'], e['samples']) for e in epochs] == \
+        [(0, 'train', 10), (0, 'valid', 10), (1, 'train', 10), (1, 'valid', 10)]
+
+
+@pytest.fixture
+def scene(tmp_path):
+    array = np.random.default_rng(0).random((2, 30, 30)).astype('float32')
+    WN.array2raster(str(tmp_path / 'img.tif'), array, (0., 10., 0., 300., 0., -10.), '')
+    label = np.random.default_rng(1).integers(0, 2, (30, 30)).astype('uint8')
+    WN.array2raster(str(tmp_path / 'lbl.tif'), label, (0., 10., 0., 300., 0., -10.), '', dtype=gdal.GDT_Byte)
+    return tmp_path
+
+
+@pytest.mark.parametrize('window_rows, windows', [(None, 1), (1, 3)])
+def test_patches_creation_windows(scene, window_rows, windows):
+    telemetry = WN.WNTelemetry()
+    WN.create_train_patches(WN.WNImage(scene / 'img.tif'), WN.WNImage(scene / 'lbl.tif'), scene / 'out', 10, 10,
+                            [0, 1], base_name='S', window_rows=window_rows, telemetry=telemetry)
+
+    events = telemetry.select('patches')
+    assert [e['kind'] for e in events] == ['images'] * windows + ['labels'] * windows
+    assert sum(e['patches'] for e in events) == 2 * 9
+    assert all(e['scene'] == 'S' and e['create'] >= 0 and e['save'] >= 0 for e in events)
+
+
+def test_prediction_windows(scene):
+    telemetry = WN.WNTelemetry()
+    WN.predict_image(WN.WNImage(scene / 'img.tif'), torch.nn.Conv2d(2, 2, 1), [0, 1], 10, 10, window_rows=1,
+                     telemetry=telemetry, skip_invalid=False)
+
+    windows = telemetry.select('predict_window')
+    assert len(windows) == 3 and all(w['patches'] == 3 for w in windows)
+    assert all(w['data_wait'] >= 0 and w['inference'] > 0 for w in windows)
+
+    [image] = telemetry.select('predict_image')
+    assert image['patches'] == 9 and image['patches_per_s'] > 0
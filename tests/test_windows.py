@@ -0,0 +1,252 @@
+import threading
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+# 10m, 20m and 60m bands of a small product (the 20m and 60m grids do not divide the odd offsets)
+band_sizes = {'B2': 66, 'B11': 33, 'B1': 11}
+img_dic = {band: f'SRE_{band}.tif' for band in band_sizes}
+
+
+def write_product(path, nodata_rows=0):
+    # nodata_rows is the fraction of the rows (from the top) with the THEIA nodata
+    rng = np.random.default_rng(0)
+    for band, size in band_sizes.items():
+        res = 660 / size
+        array = rng.integers(0, 10000, (size, size)).astype('int16')
+        array[:int(size * nodata_rows)] = -10000
+        WN.array2raster(str(path / f'P_SRE_{band}.tif'), array, (0., res, 0., 660., 0., -res), '',
+                        nodatavalue=-10000, dtype=gdal.GDT_Int16)
+    WN.WNProductIndex.clear_cache()
+    return path
+
+
+@pytest.fixture
+def product(tmp_path):
+    return write_product(tmp_path)
+
+
+@pytest.fixture
+def nodata_product(tmp_path):
+    return write_product(tmp_path, nodata_rows=0.5)
+
+
+def open_img(product):
+    img = WN.WNSatImage(product, img_dic=img_dic, verbose=False)
+    img.clear()
+    return img
+
+
+@pytest.mark.parametrize('band', list(band_sizes))
+@pytest.mark.parametrize('xoff, yoff, width, height', [(7, 5, 23, 19), (1, 3, 9, 11), (13, 29, 53, 37)])
+def test_window_matches_whole_scene(product, band, xoff, yoff, width, height):
+    whole = open_img(product).get_raster(band)
+    window = open_img(product).window(xoff, yoff, width, height)
+
+    assert np.array_equal(window.get_raster(band), whole[yoff:yoff + height, xoff:xoff + width])
+
+
+@pytest.mark.parametrize('band', list(band_sizes))
+def test_windowed_patches_match_whole_scene(product, band):
+    size, shift = 10, 7
+    whole = WN.create_custom_patches(open_img(product), [band], size, shift)
+
+    img = open_img(product)
+    windowed = []
+    for window in img.iter_patch_windows(size, shift, rows=2):
+        windowed += list(WN.create_custom_patches(window, [band], size, shift))
+
+    assert len(windowed) == len(whole)
+    for a, b in zip(windowed, whole):
+        assert np.array_equal(a, b)
+
+
+def count_reads(monkeypatch):
+    pixels = []
+    read_window = WN.WNImage.read_window
+
+    def counted(self, band, xoff, yoff, width, height, *args, **kwargs):
+        pixels.append(width * height)
+        return read_window(self, band, xoff, yoff, width, height, *args, **kwargs)
+
+    monkeypatch.setattr(WN.WNImage, 'read_window', counted)
+    return pixels
+
+
+def windowed_patches(product, valid):
+    img = open_img(product)
+    maths = {'nd': lambda x: x.normalized_difference('B2', 'B11')}
+    return [WN.create_custom_patches(window, ['B2', 'B1'], 10, 7, maths, valid=valid)
+            for window in img.iter_patch_windows(10, 7, rows=2)]
+
+
+def test_skip_invalid_reads_the_bands_once(nodata_product, monkeypatch):
+    pixels = count_reads(monkeypatch)
+    windowed_patches(nodata_product, None)
+    all_patches = sum(pixels)
+
+    pixels.clear()
+    procs = windowed_patches(nodata_product, True)
+    assert sum(pixels) == all_patches
+
+    # the same mask as the one of the whole scene
+    valid = np.concatenate([proc.valid_ for proc in procs])
+    whole = WN.create_custom_patches(open_img(nodata_product), ['B2', 'B1'], 10, 7,
+                                     {'nd': lambda x: x.normalized_difference('B2', 'B11')}, valid=True)
+    assert np.array_equal(valid, whole.valid_)
+    assert 0 < valid.sum() < len(valid)
+
+
+@pytest.mark.parametrize('window_rows', [None, 2])
+def test_train_patches_skip_invalid_reads_the_bands_once(nodata_product, tmp_path, monkeypatch, window_rows):
+    label = np.random.default_rng(1).integers(0, 2, (66, 66)).astype('uint8')
+    WN.array2raster(str(tmp_path / 'label.tif'), label, (0., 10., 0., 660., 0., -10.), '', dtype=gdal.GDT_Byte)
+    pixels = count_reads(monkeypatch)
+
+    saved = {}
+    for skip_invalid in [False, True]:
+        pixels.clear()
+        out = tmp_path / f'out_{skip_invalid}'
+        WN.create_train_patches(open_img(nodata_product), WN.WNImage(tmp_path / 'label.tif'), out, 10, 7, ['B2'],
+                                window_rows=window_rows, skip_invalid=skip_invalid)
+        saved[skip_invalid] = sum(pixels), len(WN.WNPatchManifest(out / 'images'))
+        assert len(WN.WNPatchManifest(out / 'labels')) == saved[skip_invalid][1]
+
+    assert saved[True][0] == saved[False][0]
+    assert 0 < saved[True][1] < saved[False][1]
+
+
+def test_predict_skip_invalid_reads_the_bands_once(nodata_product, monkeypatch):
+    torch = pytest.importorskip('torch')
+    model = torch.nn.Conv2d(2, 2, 1)
+    pixels = count_reads(monkeypatch)
+
+    reads, masks = [], []
+    for skip_invalid in [False, True]:
+        pixels.clear()
+        masks.append(WN.predict_image(open_img(nodata_product), model, ['B2', 'B11'], 10, 7, window_rows=2,
+                                      skip_invalid=skip_invalid))
+        reads.append(sum(pixels))
+
+    assert reads[0] == reads[1]
+    assert np.array_equal(masks[0][..., 40:, :], masks[1][..., 40:, :])
+    assert (masks[1][..., :20, :] == 0).all()
+
+
+@pytest.mark.parametrize('img_dic, nodata', [(WN.WNSatImage.dicS2_THEIA, -1.), (WN.WNSatImage.dicS2_L1C, 0.),
+                                             (WN.WNSatImage.dicS2_L2A, 0.), (img_dic, -1.),
+                                             ({'B2': '_B02_10m.jp2'}, 0.)])
+def test_nodata_of_the_product_type(img_dic, nodata):
+    assert WN.WNSatImage(None, img_dic=img_dic).nodata == nodata
+    assert WN.WNSatImage(None, img_dic=img_dic, nodata=-2.).nodata == -2.
+
+
+def test_disk_cache_decodes_each_band_once(product, tmp_path, monkeypatch):
+    expected = {band: open_img(product).get_raster(band) for band in band_sizes}
+    cache = WN.WNDiskBandCache(tmp_path / 'cache')
+    reads = count_reads(monkeypatch)
+
+    for _ in range(2):
+        img = WN.WNSatImage(product, img_dic=img_dic, verbose=False, disk_cache=cache)
+        img.clear()
+        for band in band_sizes:
+            assert np.allclose(img.get_raster(band), expected[band])
+            assert np.allclose(img.window(7, 5, 23, 19).get_raster(band), expected[band][5:24, 7:30])
+
+    # the resampled 20m and 60m bands are cached in the 10m shape
+    assert (cache.misses, cache.hits) == (3, 3) and sum(reads) == 3 * 66 * 66
+    assert cache.stats['bands'] == 3 and cache.nbytes == 3 * (66 * 66 * 2 + 128)
+
+    # the windows of an image with no bands loaded are sliced from the cache too
+    window = WN.WNSatImage(product, img_dic=img_dic, verbose=False, disk_cache=cache).window(7, 5, 23, 19)
+    for band in band_sizes:
+        assert np.allclose(window.get_raster(band), expected[band][5:24, 7:30])
+    assert cache.hits == 6 and sum(reads) == 3 * 66 * 66
+
+
+def test_disk_cache_entries_follow_the_source(product, tmp_path):
+    cache = WN.WNDiskBandCache(tmp_path / 'cache', max_bytes=2 * (66 * 66 * 2 + 128))
+    img = WN.WNSatImage(product, img_dic=img_dic, verbose=False, disk_cache=cache)
+    img.clear()
+    for band in band_sizes:
+        img.get_raster(band)
+
+    # the least recently used band is removed to keep the budget
+    assert cache.stats['bands'] == 2
+
+    # a rewritten source is decoded again
+    array = np.zeros((66, 66), dtype='int16')
+    WN.array2raster(str(product / 'P_SRE_B2.tif'), array, (0., 10., 0., 660., 0., -10.), '',
+                    nodatavalue=-10000, dtype=gdal.GDT_Int16)
+    img = WN.WNSatImage(product, img_dic=img_dic, verbose=False, disk_cache=cache)
+    img.clear()
+    assert (img.get_raster('B2') == 0).all()
+
+
+@pytest.mark.parametrize('window_rows', [None, 1, 4])
+def test_streamed_prediction_matches_the_whole_scene(product, tmp_path, window_rows):
+    torch = pytest.importorskip('torch')
+    torch.manual_seed(0)
+    model = torch.nn.Conv2d(2, 3, 3, padding=1)
+    bands, size, shift = ['B2', 'B11'], 10, 7
+
+    # the whole scene at once: patches, predictions and average of the overlapping probabilities
+    proc = WN.create_custom_patches(open_img(product), bands, size, shift)
+    _, probs = WN.predict_patches(proc, model)
+    expected = WN.WNPatchProcessor.create_from_patches(probs, size, shift, proc.format['patches_per_row'],
+                                                       channels_first=True).assembly_patches(dtype='float32')
+
+    streamed = WN.predict_image(open_img(product), model, bands, size, shift, window_rows=window_rows, probs=True,
+                                skip_invalid=False)
+    assert streamed.shape == (3, 66, 66)
+    assert np.allclose(streamed, expected, atol=1e-5)
+
+    mask = WN.predict_image(open_img(product), model, bands, size, shift, window_rows=window_rows,
+                            skip_invalid=False)
+    assert mask.dtype == np.uint8 and np.array_equal(mask, expected.argmax(axis=0))
+
+    out_file = tmp_path / 'mask.tif'
+    assert WN.predict_image(open_img(product), model, bands, size, shift, window_rows=window_rows,
+                            out_file=out_file, skip_invalid=False) == out_file
+    assert np.array_equal(gdal.Open(str(out_file)).ReadAsArray(), mask)
+
+
+def test_bands_are_decoded_concurrently(product, monkeypatch):
+    expected = {band: open_img(product).get_raster(band) for band in band_sizes}
+
+    # the three reads only get through the barrier if they run at the same time
+    barrier, threads = threading.Barrier(3, timeout=10), set()
+    read_window = WN.WNImage.read_window
+
+    def concurrent(self, *args, **kwargs):
+        threads.add(threading.get_ident())
+        barrier.wait()
+        return read_window(self, *args, **kwargs)
+
+    monkeypatch.setattr(WN.WNImage, 'read_window', concurrent)
+    img = open_img(product)
+    img.load_bands(list(band_sizes), workers=3)
+
+    assert len(threads) == 3 and threading.get_ident() not in threads
+    for band in band_sizes:
+        assert img.is_loaded(band) and np.array_equal(img.get_raster(band), expected[band])
+
+
+def test_bands_of_a_shared_dataset_are_read_serially(tmp_path, monkeypatch):
+    array = np.random.default_rng(0).random((3, 12, 10)).astype('float32')
+    WN.array2raster(str(tmp_path / 'bands.tif'), array, (0., 10., 0., 120., 0., -10.), '')
+    img = WN.WNImage(tmp_path / 'bands.tif')
+    img.clear()
+
+    threads = []
+    read_window = WN.WNImage.read_window
+    monkeypatch.setattr(WN.WNImage, 'read_window',
+                        lambda self, *args, **kwargs: threads.append(threading.get_ident()) or
+                        read_window(self, *args, **kwargs))
+
+    img.load_bands([0, 1, 2], workers=3)
+    assert threads == [threading.get_ident()] * 3
+    assert np.array_equal(img.as_cube([0, 1, 2], channels_first=True), array)
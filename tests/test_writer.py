@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('gdal')
+WN = pytest.importorskip('WNInputOutput')
+
+
+def read_bands(fn, n):
+    ds = gdal.Open(str(fn))
+    return np.stack([ds.GetRasterBand(i + 1).ReadAsArray() for i in range(n)])
+
+
+def test_window_writes_build_the_whole_raster(tmp_path):
+    array = np.random.default_rng(0).random((3, 40, 30)).astype('float32')
+    fn = tmp_path / 'out.tif'
+
+    with WN.WNRasterWriter(fn, 40, 30, 3, (0., 10., 0., 400., 0., -10.), '', nodatavalue=-1, block_size=16) as w:
+        for first_row in range(0, 40, 16):
+            w.write(array[:, first_row:first_row + 16], 0, first_row)
+
+    assert np.array_equal(read_bands(fn, 3), array)
+    assert gdal.Open(str(fn)).GetRasterBand(2).GetNoDataValue() == -1
+
+
+def test_single_bands_and_float16_windows(tmp_path):
+    array = np.random.default_rng(1).random((2, 20, 20)).astype('float16')
+    fn = tmp_path / 'out.tif'
+
+    with WN.WNRasterWriter(fn, 20, 20, 2) as writer:
+        writer.write(array[1, :, 10:], 10, 0, band=2)
+        writer.write(array[1, :, :10], 0, 0, band=2)
+        writer.write(array[0])
+
+    assert np.array_equal(read_bands(fn, 2), array.astype('float32'))
+
+
+@pytest.mark.parametrize('dtype, compress, level, expected', [
+    (gdal.GDT_Float32, 'DEFLATE', None, ['COMPRESS=DEFLATE', 'PREDICTOR=3']),
+    (gdal.GDT_Byte, 'DEFLATE', 6, ['PREDICTOR=2', 'ZLEVEL=6']),
+    (gdal.GDT_Int16, 'ZSTD', 9, ['COMPRESS=ZSTD', 'PREDICTOR=2', 'ZSTD_LEVEL=9']),
+])
+def test_creation_options(tmp_path, dtype, compress, level, expected):
+    writer = WN.WNRasterWriter(tmp_path / 'out.tif', 8, 8, dtype=dtype, compress=compress, level=level,
+                               block_size=256)
+    writer.close()
+
+    assert set(expected + ['TILED=YES', 'BLOCKXSIZE=256', 'NUM_THREADS=ALL_CPUS']) <= set(writer.options)
+
+
+def test_no_predictor_without_compression(tmp_path):
+    writer = WN.WNRasterWriter(tmp_path / 'out.tif', 8, 8, compress='NONE', tiled=False, threads=None)
+    writer.close()
+
+    assert writer.options == ['COMPRESS=NONE', 'BIGTIFF=IF_SAFER']
+
+
+def test_overview_levels_down_to_half_a_block(tmp_path):
+    writer = WN.WNRasterWriter(tmp_path / 'out.tif', 2048, 3000, block_size=512)
+    assert writer.overview_levels() == [2, 4, 8]
+    writer.close()
+
+
+def test_cog_is_converted_from_a_temporary_file(tmp_path):
+    array = np.arange(64 * 64, dtype='float32').reshape(64, 64)
+    fn = tmp_path / 'cog.tif'
+    WN.array2raster(str(fn), array, (0., 10., 0., 640., 0., -10.), '', cog=True, block_size=16)
+
+    assert fn.exists() and not (tmp_path / 'cog.tif.tmp.tif').exists()
+    assert np.array_equal(read_bands(fn, 1)[0], array)